@@ -1,18 +1,39 @@
+from concurrent.futures import wait, Future, FIRST_COMPLETED
 import hashlib
-from multiprocessing import Pool
+import json
 import os
-from pathlib import Path
 from typing import List, Tuple, Dict
 
-from algorithms.background import background_task
+from algorithms.background import background_task, JobCancelledException, JOB_CANCELLED_MESSAGE
 from algorithms.base_algorithm import AlgorithmException
+from algorithms.executor import ManagedExecutor
+from algorithms.model_archive import ModelArchive
+from algorithms.model_cache import ModelCache
+from algorithms.model_store import ModelStore
 
+# file in algorithm's directory of saved models containing the archive of users' models
+ARCHIVE_FILE = 'models.pack'
 
-def algorithm_manager_factory(alg_dict, status_updater_factory, name):
+
+def algorithm_manager_factory(alg_dict, status_updater_factory, name, model_cache=None, executor=None,
+                              training_concurrency=None, prediction_batch_size=None, model_store=None,
+                              use_model_archive=False):
     """
     Returns new class deriving after AlgorithmManager.
     :param alg_dict: the new manager will use algorithms from this dict
     :param name: the name of the new manager class, best if unique
+    :param model_cache: ModelCache shared by all instances of the new manager,
+    a new cache with default limits is created if not given
+    :param executor: ManagedExecutor running training and predictions of users' models,
+    if not given they are run inline in the calling thread
+    :param training_concurrency: maximal number of users' models trained at once by one job,
+    the number of executor's workers if not given
+    :param prediction_batch_size: number of samples passed at once to algorithm's predict_batch
+    when testing models, AlgorithmManager.prediction_batch_size if not given
+    :param model_store: ModelStore saving versions of models, a new store with default
+    number of kept versions is created if not given
+    :param use_model_archive: if True, models of not multilabel algorithms are packed into
+    an archive after each training, so they can be loaded with a single read (see pack_models)
     """
     new_class = type(
         name,
@@ -21,9 +42,104 @@ def algorithm_manager_factory(alg_dict, status_updater_factory, name):
     )
     new_class.alg_dict = alg_dict
     new_class.status_updater_factory = status_updater_factory
+    new_class.model_cache = model_cache or ModelCache()
+    new_class.executor = executor or ManagedExecutor(workers=0)
+    new_class.training_concurrency = training_concurrency
+    new_class.model_store = model_store or ModelStore()
+    new_class.use_model_archive = use_model_archive
+    if prediction_batch_size:
+        new_class.prediction_batch_size = prediction_batch_size
     return new_class
 
 
+def _get_fingerprint(algorithm_name: str, parameters: dict, samples: list, labels: list,
+                     preprocessing: dict = None) -> str:
+    """
+    Returns md5 of algorithm's name, parameters, preprocessing settings, ids of samples and their labels,
+    models trained on data with the same fingerprint don't have to be trained again.
+    Samples without id (eg. in tests) are identified by their str.
+    :param preprocessing: dict - settings of samples' preprocessing, as returned by algorithm's get_preprocessing
+    """
+    md5 = hashlib.md5(json.dumps(
+        [algorithm_name, parameters, preprocessing or {}], sort_keys=True, default=str
+    ).encode('utf-8'))
+    for sample, label in zip(samples, labels):
+        md5.update(f'{getattr(sample, "id", sample)}:{label};'.encode('utf-8'))
+    return md5.hexdigest()
+
+
+def _read_fingerprint(model_store: ModelStore, path: str) -> str:
+    """
+    Returns the fingerprint of the model saved in directory `path`, or None if there is none.
+    """
+    manifest = model_store.read_manifest(path)
+    return manifest.get('fingerprint') if manifest else None
+
+
+def _train_user_model(algorithm, parameters: dict, samples: list, labels: list, model_store: ModelStore,
+                      path: str, keep_model: bool, status_updater=None, fingerprint: str = None,
+                      preprocessing: dict = None):
+    """
+    Trains and saves a model of a single user, run by the manager's executor.
+    :param path: str - directory of user's model in `model_store`
+    :param keep_model: bool - if True, the trained model is returned,
+    otherwise it's left on disk only (models don't have to be picklable)
+    :param status_updater: StatusUpdater of the job, models use it to check if the job was cancelled,
+    models of cancelled jobs are not saved
+    :param fingerprint: str - fingerprint of the training data, saved with the model
+    :param preprocessing: dict - preprocessing settings of the algorithm, saved with the model
+    """
+    model = algorithm(parameters=parameters)
+    if status_updater is not None:
+        model.set_status_updater(status_updater)
+    model.train(samples, labels)
+    if status_updater is not None and status_updater.is_cancelled():
+        return None
+    model_store.save(model, path, parameters, fingerprint, preprocessing)
+    return model if keep_model else None
+
+
+def _predict_batches(model, samples: list, batch_size: int) -> list:
+    """
+    Predicts labels of samples using model's predict_batch on batches of `batch_size` samples.
+    """
+    predictions = []
+    for start in range(0, len(samples), batch_size):
+        predictions.extend(pred for pred, _ in model.predict_batch(samples[start:start + batch_size]))
+    return predictions
+
+
+def _load_packed(algorithm, archive: ModelArchive, key: str):
+    """
+    Loads a model from the archive of models with algorithm's load_packed,
+    returns None if the algorithm can't load packed models.
+    """
+    try:
+        return algorithm.load_packed(archive.read(key))
+    except Exception as e:
+        print(f" * #WARNING: could not load packed model of {algorithm.__name__}: {str(e)}")
+        return None
+
+
+def _predict_user_samples(algorithm, model_path: str, samples: list, batch_size: int,
+                          archive_path: str = None, key: str = None) -> list:
+    """
+    Predicts labels of samples with a model of a single user, run by the manager's executor.
+    :param archive_path: if given, the model is loaded from entry `key` of this archive of models,
+    it's loaded from `model_path` if that fails
+    """
+    model = None
+    if archive_path is not None:
+        try:
+            with ModelArchive(archive_path) as archive:
+                model = _load_packed(algorithm, archive, key)
+        except (OSError, ValueError) as e:
+            print(f" * #WARNING: could not open archive of models: {str(e)}")
+    if model is None:
+        model = algorithm(path=model_path)
+    return _predict_batches(model, samples, batch_size)
+
+
 class NotTrainedException(Exception):
     """
     This exception is meant to be throen on models'
@@ -39,6 +155,10 @@ class NotTrainedException(Exception):
     def __str__(self):
         return self.message
 
+    def __reduce__(self):
+        # errors of algorithms run in worker processes are pickled
+        return self.__class__, (self.message,)
+
 
 class AlgorithmManager:
     """
@@ -47,12 +167,17 @@ class AlgorithmManager:
 
     alg_dict = None
     status_updater_factory = None
+    model_cache = None
+    executor = None
+    training_concurrency = None
+    model_store = None
+    use_model_archive = False
+    prediction_batch_size = 64
 
     def __init__(self, algorithm_name):
         self.models = {}
         self.algorithm_name = algorithm_name
         self.algorithm = self.alg_dict[algorithm_name]
-        self.pool = Pool(processes=4)
 
     @property
     def multilabel(self):
@@ -111,29 +236,103 @@ class AlgorithmManager:
         return parameters
 
     @background_task
-    def _train_models(self, samples: dict, labels: dict, parameters: dict, job_id: str):
+    def _train_models(self, samples: dict, labels: dict, parameters: dict, job_id: str, incremental: bool = False):
         """
         Trains a model for each user for a given algorithm,
-        and then saves the model to `saved_models` directory
+        and then saves the model to `saved_models` directory.
+        Models of different users are trained in parallel by the executor,
+        if training of some user fails, models of other users are still trained
+        and the failed users are listed in job's error.
+        If the job is cancelled, no more trainings are started and the running ones
+        are stopped (if the algorithm supports it) without saving the models.
+        If `incremental` is True, users whose saved model was trained on the same samples,
+        labels, parameters and preprocessing settings (same fingerprint) are skipped.
         """
         try:
             status_updater = self.status_updater_factory(job_id=job_id)
-            usernames = list(labels.keys())
+            usernames = [username for username in labels if samples[username]]
             parameters = self._update_parameters(parameters)
-            for i, username in enumerate(usernames):
-                model = self.algorithm(parameters=parameters)
-                if samples[username]:
-                    model.train(samples[username], labels[username])
-                    self.models[username] = model
-                status_updater.update(progress=i/max(len(usernames), 1.))
-            self._save_models()
+            fingerprints = {
+                username: _get_fingerprint(self.algorithm_name, parameters, samples[username], labels[username],
+                                           self.algorithm.get_preprocessing())
+                for username in usernames
+            }
+            to_train = usernames
+            if incremental:
+                to_train = [
+                    username for username in usernames
+                    if _read_fingerprint(self.model_store, self._get_model_path(username)) != fingerprints[username]
+                ]
+            skipped = len(usernames) - len(to_train)
+            failures = {}
+            trainings = self._submit_trainings(to_train, samples, labels, parameters, status_updater, fingerprints)
+            for i, (username, future) in enumerate(trainings, start=skipped):
+                try:
+                    model = future.result()
+                except Exception as e:
+                    failures[username] = str(e)
+                else:
+                    if model is not None:
+                        self.models[username] = model
+                    self.model_cache.invalidate((self.algorithm_name, username))
+                status_updater.update(progress=(i + 1) / len(usernames))
         except AlgorithmException as e:
             status_updater.update(
                 progress=0, finished=True,
                 error=f"There was an error with the algorithm: {str(e)}"
             )
         else:
-            status_updater.update(finished=True, progress=1)
+            if status_updater.is_cancelled():
+                status_updater.update(finished=True, progress=0, error=JOB_CANCELLED_MESSAGE)
+                return
+            if self.use_model_archive:
+                self._pack_models_safely(usernames)
+            error = None
+            if failures:
+                error = f"There was an error with the algorithm for {len(failures)} of {len(to_train)} users: "
+                error += ", ".join(f"{username} ({message})" for username, message in failures.items())
+            status_updater.update(finished=True, progress=1, error=error)
+
+    def _submit_trainings(self, usernames: List[str], samples: dict, labels: dict, parameters: dict,
+                          status_updater, fingerprints: dict):
+        """
+        Submits training of users' models to the executor, keeping at most
+        `training_concurrency` of them in progress at once.
+        No trainings are submitted after the job was cancelled.
+        :param fingerprints: dict - {username: fingerprint of user's training data}
+        :returns: generator of pairs (username, future of _train_user_model),
+        in order of trainings being finished
+        """
+        limit = self.training_concurrency or max(self.executor.workers, 1)
+        waiting = iter(usernames)
+        running = {}
+
+        def submit_next():
+            if status_updater.is_cancelled():
+                return
+            username = next(waiting, None)
+            if username is not None:
+                try:
+                    # samples are prepared here, where preprocessing can run processes of its own
+                    user_samples, user_labels = self.algorithm.preprocess_samples(samples[username], labels[username])
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                else:
+                    future = self.executor.submit(
+                        _train_user_model, self.algorithm, parameters, user_samples, user_labels,
+                        self.model_store, self._get_model_path(username), self.executor.inline, status_updater,
+                        fingerprints[username], self.algorithm.get_preprocessing()
+                    )
+                running[future] = username
+
+        for _ in range(limit):
+            submit_next()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                submit_next()
+                yield running.pop(future), future
 
     def _save_models(self):
         """
@@ -142,43 +341,205 @@ class AlgorithmManager:
         """
         for name in self.models:
             model = self.models[name]
-            md5 = hashlib.md5(name.encode('utf-8'))
-            base_path = f'./algorithms/saved_models/{self.algorithm_name}/' + md5.hexdigest()
-            Path(base_path).mkdir(parents=True, exist_ok=True)
-            model.save(base_path + '/model')
+            self.model_store.save(model, self._get_model_path(name), preprocessing=self.algorithm.get_preprocessing())
+            self.model_cache.invalidate((self.algorithm_name, name))
+
+    def _get_model_path(self, user: str) -> str:
+        """
+        Returns the directory of user's model: saved_models/algorithm_name/md5_of_user_name
+        """
+        md5 = hashlib.md5(user.encode('utf-8'))
+        return f'./algorithms/saved_models/{self.algorithm_name}/{md5.hexdigest()}'
+
+    def _get_multilabel_model_path(self) -> str:
+        """
+        Returns the directory of the multilabel model: saved_models/algorithm_name
+        """
+        return f'./algorithms/saved_models/{self.algorithm_name}'
+
+    def _get_trained_model_path(self, user: str = None) -> str:
+        """
+        Returns the directory of user's model, or of the multilabel model if user is None,
+        raises NotTrainedException if the model wasn't trained, or was trained with
+        other preprocessing settings (eg. before decoding of samples changed).
+        """
+        if user is None:
+            base_path = self._get_multilabel_model_path()
+            if not os.path.isdir(base_path):
+                raise NotTrainedException(f"There is no model of {self.algorithm_name} trained.")
+        else:
+            base_path = self._get_model_path(user)
+            if not os.path.isdir(base_path):
+                raise NotTrainedException(f"There is no model of {self.algorithm_name} trained for {user}.")
+        manifest = self.model_store.read_manifest(base_path) or {}
+        if (manifest.get('preprocessing') or {}) != self.algorithm.get_preprocessing():
+            owner = f" for {user}" if user is not None else ""
+            raise NotTrainedException(
+                f"The model of {self.algorithm_name}{owner} was trained with other preprocessing settings, "
+                f"it has to be trained again."
+            )
+        return base_path
+
+    def _load_from_store(self, user: str = None, archive: ModelArchive = None):
+        """
+        Loads the current version of user's model, or of the multilabel model if user is None,
+        it's taken from the cache if the version didn't change.
+        :param archive: if given and it contains the current version of the model,
+        the model is loaded from it with algorithm's load_packed
+        """
+        base_path = self._get_trained_model_path(user)
+        version = self.model_store.get_version(base_path)
+        path = self.model_store.get_model_path(base_path, version)
+
+        def load():
+            key = os.path.basename(base_path)
+            if archive is not None and key in archive and archive.get_meta(key)['version'] == version:
+                model = _load_packed(self.algorithm, archive, key)
+                if model is not None:
+                    return model
+            return self.algorithm(path=path)
+
+        return self.model_cache.get_or_load(
+            (self.algorithm_name, user), self.model_store.get_version_path(base_path, version), load, version
+        )
+
+    def _get_cached_model(self, user: str):
+        """
+        Returns the current version of user's model if it's in the model cache, None otherwise.
+        """
+        base_path = self._get_trained_model_path(user)
+        return self.model_cache.get((self.algorithm_name, user), self.model_store.get_version(base_path))
+
+    def _get_packed_key(self, archive: ModelArchive, user: str) -> str:
+        """
+        Returns the key of the current version of user's model in the archive, None if it isn't there.
+        """
+        base_path = self._get_trained_model_path(user)
+        key = os.path.basename(base_path)
+        if key in archive and archive.get_meta(key)['version'] == self.model_store.get_version(base_path):
+            return key
+        return None
+
+    def _get_current_model_path(self, user: str) -> str:
+        """
+        Returns the path of the current version of user's model.
+        """
+        base_path = self._get_trained_model_path(user)
+        return self.model_store.get_model_path(base_path, self.model_store.get_version(base_path))
 
     def _load_model(self, user: str):
         """
-        Load user's model from saved_models/algorithm_name/user_name,
+        Load the current version of user's model from saved_models/algorithm_name/user_name,
         using model's __init__ method with path kwarg.
+        Loaded models are cached, until a new version is saved.
         :param user: the name of the user for wich the model should be loaded
         """
-        md5 = hashlib.md5(user.encode('utf-8'))
-        base_path = f'./algorithms/saved_models/{self.algorithm_name}/{md5.hexdigest()}'
-        if not os.path.isdir(base_path):
-            raise NotTrainedException(f"There is no model of {self.algorithm_name} trained for {user}.")
-        path = base_path + '/model'
-        self.models[user] = self.algorithm(path=path)
+        self.models[user] = self._load_from_store(user)
 
     def _load_models(self, users):
         """
-        loads models for a list of users
+        loads models for a list of users, from the archive of models if there is one
+        """
+        archive = self._open_archive()
+        if archive is None:
+            for user in users:
+                self._load_model(user)
+            return
+        with archive:
+            self._load_packed_models(archive, users)
+
+    def _get_archive_path(self) -> str:
+        """
+        Returns the path of the archive of models: saved_models/algorithm_name/models.pack
+        """
+        return f'./algorithms/saved_models/{self.algorithm_name}/{ARCHIVE_FILE}'
+
+    def _open_archive(self) -> ModelArchive:
+        """
+        Returns the archive of algorithm's models, or None if there is none.
         """
+        try:
+            return ModelArchive(self._get_archive_path())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f" * #WARNING: could not open archive of {self.algorithm_name} models: {str(e)}")
+            return None
+
+    def _load_packed_models(self, archive: ModelArchive, users: List[str]):
+        """
+        Loads models of users, in order of their position in the archive so it's read sequentially,
+        models which aren't in the archive (or are outdated) are loaded from their directories.
+        """
+        keys = {user: os.path.basename(self._get_model_path(user)) for user in users}
+
+        def position(user):
+            key = keys[user]
+            return (0, archive.get_offset(key)) if key in archive else (1, 0)
+
+        for user in sorted(users, key=position):
+            self.models[user] = self._load_from_store(user, archive)
+
+    def pack_models(self, users: List[str]):
+        """
+        Packs current versions of users' models into the archive of models,
+        which replaces the previous archive. Users without trained models are skipped.
+        """
+        entries = {}
         for user in users:
-            self._load_model(user)
+            base_path = self._get_model_path(user)
+            version = self.model_store.get_version(base_path)
+            if version is not None:
+                entries[os.path.basename(base_path)] = (
+                    self.model_store.get_version_path(base_path, version), {'user': user, 'version': version}
+                )
+        if entries:
+            ModelArchive.pack(self._get_archive_path(), entries)
+
+    def _pack_models_safely(self, users: List[str]):
+        try:
+            self.pack_models(users)
+        except OSError as e:
+            # models can still be loaded from their directories
+            print(f" * #WARNING: could not pack models of {self.algorithm_name}: {str(e)}")
+
+    def preload_models(self) -> int:
+        """
+        Loads all models from the archive of models into the model cache (eg. at startup),
+        the cache should be big enough to keep them.
+        :returns: number of loaded models
+        """
+        archive = self._open_archive()
+        if archive is None:
+            return 0
+        with archive:
+            users = [archive.get_meta(key)['user'] for key in archive.keys()]
+            self._load_packed_models(archive, users)
+        return len(users)
 
     @background_task
-    def _train_multilabel_model(self, samples: list, labels: list, parameters: dict, job_id: str):
+    def _train_multilabel_model(self, samples: list, labels: list, parameters: dict, job_id: str,
+                                incremental: bool = False):
         """
         Trains one multilabeled model for all users.
+        If `incremental` is True and the saved model was trained on the same samples,
+        labels, parameters and preprocessing settings (same fingerprint), it's not trained again.
         """
         try:
             parameters = self._update_parameters(parameters)
-            self.model = self.algorithm(parameters=parameters)
             self.updater = self.status_updater_factory(job_id=job_id)
+            fingerprint = _get_fingerprint(self.algorithm_name, parameters, samples, labels,
+                                           self.algorithm.get_preprocessing())
+            if incremental and _read_fingerprint(self.model_store, self._get_multilabel_model_path()) == fingerprint:
+                self.updater.update(finished=True, progress=1)
+                return
+            self.model = self.algorithm(parameters=parameters)
             self.model.set_status_updater(self.updater)
             self.model.train(samples, labels)
-            self._save_multilabel_model()
+            if self.updater.is_cancelled():
+                self.updater.update(finished=True, progress=0, error=JOB_CANCELLED_MESSAGE)
+                return
+            self._save_multilabel_model(parameters, fingerprint)
         except AlgorithmException as e:
             self.updater.update(
                 finished=True, progress=0,
@@ -187,26 +548,24 @@ class AlgorithmManager:
         else:
             self.updater.update(finished=True, progress=1)
 
-    def _save_multilabel_model(self):
+    def _save_multilabel_model(self, parameters: dict = None, fingerprint: str = None):
         """
-        Saves multilabeled model to ./saved_algorithms/agorithm_name/algorithm_name,
+        Saves a new version of multilabeled model to ./saved_algorithms/agorithm_name,
         using algorithm's save method.
+        :param parameters: dict - parameters of the model, stored in version's manifest
+        :param fingerprint: str - fingerprint of the training data, stored in version's manifest
         """
-        base_path = f'./algorithms/saved_models/{self.algorithm_name}'
-        Path(base_path).mkdir(parents=True, exist_ok=True)
-        self.model.save(base_path + '/model')
+        self.model_store.save(self.model, self._get_multilabel_model_path(), parameters, fingerprint,
+                              self.algorithm.get_preprocessing())
+        self.model_cache.invalidate((self.algorithm_name, None))
 
     def _load_multilabel_model(self):
         """
-        Loads multilabeled model from ./saved_algorithms/agorithm_name/algorithm_name,
+        Loads the current version of multilabeled model from ./saved_algorithms/agorithm_name,
         using algorithm's __init__ method with "path" kwarg.
+        Loaded model is cached, until a new version is saved.
         """
-
-        base_path = f'./algorithms/saved_models/{self.algorithm_name}'
-        if not os.path.isdir(base_path):
-            raise NotTrainedException(f"There is no model of {self.algorithm_name} trained.")
-        path = base_path + '/model'
-        self.model = self.algorithm(path=path)
+        self.model = self._load_from_store()
 
     def predict(self, user: str, file) -> Tuple[bool, Dict[str, float]]:
         """
@@ -224,7 +583,7 @@ class AlgorithmManager:
             self._load_model(user)
             return self.models[user].predict(file)
 
-    def train(self, samples, labels, parameters, job_id):
+    def train(self, samples, labels, parameters, job_id, incremental=False):
         """
         Trains the model(s) depending on algorithm being multilabel,
         then saves it (them).
@@ -240,49 +599,87 @@ class AlgorithmManager:
         :param parameters: Algorithm parameters of the form
                     {'parameter_name': 'value'},
         where both names and values should agree with get_parameters.
+        :param incremental: if True, models already trained on the same samples
+        and parameters are not trained again (see _train_models)
         """
         if self.algorithm.multilabel:
             return self._train_multilabel_model(
-                                        samples, labels, parameters, job_id
+                                        samples, labels, parameters, job_id, incremental
                                         )
         else:
-            return self._train_models(samples, labels, parameters, job_id)
-
+            return self._train_models(samples, labels, parameters, job_id, incremental)
 
-    def _test_models(self, samples, labels, users):
+    def _test_models(self, samples, labels, users, status_updater=None):
         """
         This method is used by method `test` for algorithms
         that are not multilabel.
-        """
+        Samples of different users are predicted in parallel by the executor, which loads
+        their models from the archive of models (or from their directories).
+        Models which are already loaded in this process (all of them if calls are run inline,
+        cached ones otherwise) are used here, while the executor predicts the rest.
+        """
+        resident = {}
+        futures = {}
+        archive = None if self.executor.inline else self._open_archive()
+        try:
+            for user in users:
+                model = self.models.get(user) if self.executor.inline else self._get_cached_model(user)
+                if model is not None:
+                    resident[user] = model
+                    continue
+                key = self._get_packed_key(archive, user) if archive is not None else None
+                futures[user] = self.executor.submit(
+                    _predict_user_samples, self.algorithm, self._get_current_model_path(user), samples[user],
+                    self.prediction_batch_size, self._get_archive_path() if key else None, key
+                )
+        finally:
+            if archive is not None:
+                archive.close()
         result = []
-        for user in users:
-            for i, sample in enumerate(samples[user]):
-                pred, _ = self.models[user].predict(sample)
+        for done, user in enumerate(users):
+            if user in resident:
+                preds = _predict_batches(resident[user], samples[user], self.prediction_batch_size)
+            else:
+                preds = futures[user].result()
+            for i, pred in enumerate(preds):
                 result.append([user, i, labels[user][i],  pred])
+            if status_updater:
+                if status_updater.is_cancelled():
+                    for future in futures.values():
+                        future.cancel()
+                    raise JobCancelledException()
+                status_updater.update(progress=(done + 1) / len(users))
         return result
 
-    def _test_multilabel_model(self, samples, labels, users, user_numbers):
+    def _test_multilabel_model(self, samples, labels, users, user_numbers, status_updater=None):
         """
         This method is used by method `test` for multilabel algorithms.
         """
-        result = [[0] * (max(user_numbers) + 2) for _ in users]
-        for i, sample in enumerate(samples):
-            if labels[i] not in user_numbers:
-                continue
-            pred, _ = self.model.predict(sample)
-            if pred in user_numbers:
-                result[user_numbers.index(labels[i])][user_numbers.index(pred)] += 1
-            else:
-                result[user_numbers.index(labels[i])][-1] += 1
+        # user numbers can be sparse (after users were deleted), so columns follow positions of users,
+        # the last column counts predictions of users which aren't tested
+        result = [[0] * (len(users) + 1) for _ in users]
+        positions = {num: pos for pos, num in enumerate(user_numbers)}
+        selected = [i for i, label in enumerate(labels) if label in positions]
+        for start in range(0, len(selected), self.prediction_batch_size):
+            batch = selected[start:start + self.prediction_batch_size]
+            preds = _predict_batches(self.model, [samples[i] for i in batch], self.prediction_batch_size)
+            for i, pred in zip(batch, preds):
+                if pred in positions:
+                    result[positions[labels[i]]][positions[pred]] += 1
+                else:
+                    result[positions[labels[i]]][-1] += 1
+            if status_updater:
+                if status_updater.is_cancelled():
+                    raise JobCancelledException()
+                status_updater.update(progress=(start + len(batch)) / len(selected))
         return {
             'users': users,
             'matrix': result
         }
 
-    def test(self, samples, labels, users, user_numbers):
+    def test(self, samples, labels, users, user_numbers, status_updater=None):
         """
-        Tests model(s) depending on algorithm being multilabel,
-        then saves it (them).
+        Tests model(s) depending on algorithm being multilabel.
         :param samples: either a dictionary of the form
                     { 'username': [samples] }
         or a list of the form
@@ -295,10 +692,44 @@ class AlgorithmManager:
         :param users: list of users, whose samples will be used
         :param user_numbers: the numbers of users in an order compatible with
         the order of labels.
+        :param status_updater: if given, progress of testing is reported with it,
+        and JobCancelledException is raised when the job is cancelled
         """
         if self.algorithm.multilabel:
             self._load_multilabel_model()
-            return self._test_multilabel_model(samples, labels, users, user_numbers)
+            return self._test_multilabel_model(samples, labels, users, user_numbers, status_updater)
+        else:
+            if self.executor.inline:
+                self._load_models(users)
+            return self._test_models(samples, labels, users, status_updater)
+
+    def check_trained(self, users: List[str]):
+        """
+        Raises NotTrainedException if model(s) needed to test `users` weren't trained,
+        the models are not loaded.
+        """
+        if self.algorithm.multilabel:
+            self._get_trained_model_path()
+        else:
+            for user in users:
+                self._get_trained_model_path(user)
+
+    @background_task
+    def run_test_job(self, samples, labels, users, user_numbers, job_id: str):
+        """
+        Tests model(s) in the background, as `test` does.
+        The progress is reported in the status of job `job_id`,
+        after the job is finished, the result of `test` is stored in it's status.
+        """
+        status_updater = self.status_updater_factory(job_id=job_id)
+        try:
+            result = self.test(samples, labels, users, user_numbers, status_updater)
+        except JobCancelledException:
+            status_updater.update(progress=0, finished=True, error=JOB_CANCELLED_MESSAGE)
+        except (AlgorithmException, NotTrainedException) as e:
+            status_updater.update(
+                progress=0, finished=True,
+                error=f"There was an error with the algorithm: {str(e)}"
+            )
         else:
-            self._load_models(users)
-            return self._test_models(samples, labels, users)
+            status_updater.update(finished=True, progress=1, result=result)
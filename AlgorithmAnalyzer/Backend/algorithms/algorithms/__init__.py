@@ -1,11 +1,13 @@
 from .simple_nn import SimpleNN
 from .easy_example import EasyExample
 from .multilabel_example import MultilabelExample
+from .mfcc_nearest_mean import MfccNearestMean
 
 ALG_DICT = {
     'Simple Neural Net': SimpleNN,
     'Random': EasyExample,
-    'Multilabel Random': MultilabelExample
+    'Multilabel Random': MultilabelExample,
+    'MFCC Nearest Mean': MfccNearestMean
 }
 
 __all__ = ['ALG_DICT']
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+
+from algorithms.algorithms.preprocessing import read_features
+from algorithms.base_algorithm import Algorithm, AlgorithmException
+from features import NFFT
+
+
+class MfccNearestMean(Algorithm):
+    """
+    Compares average MFCC of a recording with average MFCC of user's real and fake samples,
+    the recording is real if it is closer to the real ones. If the user has no fake samples,
+    the recording is real if it is not farther than the farthest real sample.
+    """
+
+    parameters = {
+        'coefficients': 13
+    }
+
+    def __init__(self, parameters=None, path=None):
+        self.real_mean = None
+        self.fake_mean = None
+        self.real_radius = None
+        if parameters:
+            self.parameters = parameters
+        elif path:
+            self.load(path)
+
+    @classmethod
+    def get_preprocessing(cls):
+        return {'features': 'mfcc', 'nfft': NFFT}
+
+    @classmethod
+    def get_parameters(cls):
+        return {
+            'coefficients': {
+                'description': 'Number of compared MFCC coefficients.',
+                'type': int,
+                'values': [13, 8, 4]
+            }
+        }
+
+    def _get_vectors(self, samples):
+        # features of samples from samplebase are precomputed, so all coefficients are read
+        # and the first ones are used
+        coefficients = self.parameters['coefficients']
+        return np.array([features[:, :coefficients].mean(axis=0) for features in read_features(samples)])
+
+    def train(self, samples, labels):
+        vectors = self._get_vectors(samples)
+        labels = np.array(labels, dtype=bool)
+        if not labels.any():
+            raise AlgorithmException("There are no real samples of the user.")
+        real = vectors[labels]
+        self.real_mean = real.mean(axis=0)
+        self.real_radius = float(np.linalg.norm(real - self.real_mean, axis=1).max())
+        self.fake_mean = vectors[~labels].mean(axis=0) if not labels.all() else None
+
+    def predict(self, data):
+        return self.predict_batch([data])[0]
+
+    def predict_batch(self, samples):
+        if not samples:
+            return []
+        vectors = self._get_vectors(samples)
+        real_distances = np.linalg.norm(vectors - self.real_mean, axis=1)
+        if self.fake_mean is None:
+            return [
+                (bool(distance <= self.real_radius), {"Distance to real samples: ": float(distance)})
+                for distance in real_distances
+            ]
+        fake_distances = np.linalg.norm(vectors - self.fake_mean, axis=1)
+        return [
+            (bool(real_distance <= fake_distance), {
+                "Distance to real samples: ": float(real_distance),
+                "Distance to fake samples: ": float(fake_distance)
+            })
+            for real_distance, fake_distance in zip(real_distances, fake_distances)
+        ]
+
+    def _to_dict(self) -> dict:
+        return {
+            'parameters': self.parameters,
+            'real_mean': self.real_mean.tolist(),
+            'real_radius': self.real_radius,
+            'fake_mean': None if self.fake_mean is None else self.fake_mean.tolist()
+        }
+
+    def _from_dict(self, model: dict):
+        self.parameters = model['parameters']
+        self.real_mean = np.array(model['real_mean'])
+        self.real_radius = model['real_radius']
+        self.fake_mean = None if model['fake_mean'] is None else np.array(model['fake_mean'])
+
+    def save(self, path):
+        with open(path + '.json', 'w') as f:
+            json.dump(self._to_dict(), f)
+
+    def load(self, path):
+        with open(path + '.json') as f:
+            self._from_dict(json.load(f))
+
+    @classmethod
+    def load_packed(cls, files):
+        model = cls()
+        model._from_dict(json.loads(files['model.json'].decode('utf-8')))
+        return model
@@ -1,22 +1,79 @@
 import wave
+from multiprocessing import Pool, RawArray, current_process
+
 import numpy as np
+import scipy.io.wavfile as wav
+
+from features import NFFT, logfbank_batch, mfcc_batch, trim_silence as trim_voiced
+
+
+# version of decoding of wav files, increased when decoded samples change,
+# version 2 scales samples into [-1, 1) instead of keeping raw integer values
+DECODER_VERSION = 2
+
+# sample width in bytes -> dtype of samples in wav's data chunk, wav files are little-endian
+_WAV_DTYPES = {1: np.uint8, 2: np.dtype('<i2'), 4: np.dtype('<i4')}
 
 
-def fast_wav_read(file, chunk_size=64):
-    file = wave.open(file, 'rb')
-    data = []
-    frame = True
-    while frame:
-        frame = file.readframes(chunk_size)
-        tmp_data = np.fromstring(frame, dtype='uint8')
-        data.extend((tmp_data + 128)/255.)
+def _decode_pcm(frames: bytes, sample_width: int) -> np.ndarray:
+    """
+    Interprets raw pcm frames as float32 samples in range [-1, 1).
+    8-bit samples are unsigned, wider ones are signed.
+    """
+    if sample_width == 3:
+        # there is no 24-bit dtype, bytes are shifted into the top of int32
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((len(raw), 4), dtype=np.uint8)
+        padded[:, 1:] = raw
+        samples = padded.view('<i4').ravel()
+        sample_width = 4
+    elif sample_width in _WAV_DTYPES:
+        samples = np.frombuffer(frames, dtype=_WAV_DTYPES[sample_width])
+    else:
+        raise ValueError(f"Unsupported sample width of wav file: {sample_width} bytes")
+
+    data = samples.astype(np.float32)
+    if sample_width == 1:
+        data -= 128
+    data /= 2 ** (8 * sample_width - 1)
     return data
 
 
+def fast_wav_read(file) -> np.ndarray:
+    """
+    Decodes a wav file into a float32 vector of samples in range [-1, 1),
+    channels are averaged into one.
+    The whole data chunk is read at once and interpreted in place,
+    according to the sample width and number of channels from wav's header.
+    :param file: path or file-like object of the wav file
+    """
+    return read_wav(file)[1]
+
+
+def read_wav(file) -> tuple:
+    """
+    Decodes a wav file as fast_wav_read.
+    :returns: (sample rate, float32 vector of samples)
+    """
+    with wave.open(file, 'rb') as wav_file:
+        rate = wav_file.getframerate()
+        channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        frames = wav_file.readframes(wav_file.getnframes())
+    data = _decode_pcm(frames, sample_width)
+    if channels > 1:
+        frames = data[:len(data) - len(data) % channels].reshape(-1, channels)
+        data = frames[:, 0].copy()
+        for channel in range(1, channels):
+            data += frames[:, channel]
+        data /= channels
+    return rate, data
+
+
 def normalize_wav_length(data, length):
     data = data[0: length]
     if len(data) < length:
-        data.extend(np.zeros(length - len(data)))
+        data = np.concatenate([data, np.zeros(length - len(data), dtype=data.dtype)])
     return data
 
 
@@ -24,12 +81,72 @@ def normalize_meanmax(data):
     return (data - np.mean(data)) / np.max(data)
 
 
-def read_sample(sample, normalized_length=0):
-    data = fast_wav_read(sample)
-    if normalized_length:
-        data = normalize_wav_length(data, normalized_length)
-        return normalize_meanmax(np.array(data))
-    return data
+def read_sample_into(sample, out: np.ndarray, trim_silence: bool = False):
+    """
+    Decodes a sample directly into `out` (eg. a row of a batch matrix),
+    truncated or padded with zeros to its length and normalized as by normalize_meanmax.
+    :param trim_silence: bool - if True, leading and trailing silence is removed before
+    (see features.trim_silence), so `out` is filled with speech
+    """
+    if hasattr(sample, 'get_features'):
+        # samples from samplebase have normalized vectors precomputed,
+        # trim is passed only when set, so keys of vectors stored before don't change
+        params = {'trim': True} if trim_silence else {}
+        out[:] = sample.get_features('normalized', length=len(out), **params)
+        return
+    rate, data = read_wav(sample)
+    if trim_silence:
+        data = trim_voiced(data, rate)
+    size = min(len(data), len(out))
+    out[:size] = data[:size]
+    out[size:] = 0
+    mean, maximum = out.mean(), out.max()
+    out -= mean
+    out /= maximum
+
+
+def read_sample(sample, normalized_length=0, trim_silence=False):
+    if not normalized_length:
+        rate, data = read_wav(sample)
+        return trim_voiced(data, rate) if trim_silence else data
+    out = np.empty(normalized_length, dtype=np.float32)
+    read_sample_into(sample, out, trim_silence)
+    return out
+
+
+_MEL_FEATURES = {
+    'mfcc': mfcc_batch,
+    'logfbank': logfbank_batch
+}
+
+
+def read_features(samples, feature_type='mfcc', **params):
+    """
+    Returns mel features of each sample, as matrices of shape (frames, coefficients).
+    Samples from samplebase use their stored features, other samples are decoded
+    and their features are computed in batches of samples with the same rate.
+    :param feature_type: str - 'mfcc' or 'logfbank'
+    :param params: parameters of features.mfcc_batch / features.logfbank_batch, nfft is features.NFFT by default
+    :returns: list of np.ndarray
+    """
+    if feature_type not in _MEL_FEATURES:
+        raise ValueError(f"Unknown feature type '{feature_type}', expected one of: {list(_MEL_FEATURES)}")
+    params = {'nfft': NFFT, **params}
+    result = [None] * len(samples)
+    # rate -> ([index of sample], [signal])
+    batches = {}
+    for num, sample in enumerate(samples):
+        if hasattr(sample, 'get_features'):
+            result[num] = sample.get_features(feature_type, **params)
+            continue
+        rate, signal = wav.read(sample)
+        indexes, signals = batches.setdefault(rate, ([], []))
+        indexes.append(num)
+        signals.append(signal)
+    for rate, (indexes, signals) in batches.items():
+        for num, features in zip(indexes, _MEL_FEATURES[feature_type](signals, rate, **params)):
+            result[num] = features
+    return result
 
 
 def join_samples_dicts(sample_dict, labels_dict):
@@ -47,16 +164,122 @@ def join_samples_dicts(sample_dict, labels_dict):
     return samples, labels, names_dict
 
 
-def read_samples(samples, labels, normalized_length=0, verbose=False):
+def _allocate_samples_matrix(shape: tuple, memmap_path: str = None) -> np.ndarray:
+    if memmap_path is None:
+        return np.empty(shape, dtype=np.float32)
+    # saved as .npy, so it can be opened again with np.load(memmap_path, mmap_mode='r')
+    return np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.float32, shape=shape)
+
+
+# samples matrix shared by worker processes of read_samples, set by _init_reader
+_shared_samples = None
+
+
+def _init_reader(buffer, shape: tuple, memmap_path: str):
+    global _shared_samples
+    if memmap_path is not None:
+        _shared_samples = np.load(memmap_path, mmap_mode='r+')
+    else:
+        _shared_samples = np.frombuffer(buffer, dtype=np.float32).reshape(shape)
+
+
+def _read_shard(shard: tuple) -> tuple:
+    """
+    Decodes a shard of samples into their rows of the shared matrix.
+    :param shard: tuple - (index of shard's first sample, samples, trim_silence)
+    :returns: (index of shard's first sample, [None or error message of each sample])
+    """
+    start, samples, trim_silence = shard
+    errors = []
+    for num, sample in enumerate(samples, start):
+        try:
+            read_sample_into(sample, _shared_samples[num], trim_silence)
+            errors.append(None)
+        except Exception as e:
+            errors.append(str(e))
+    return start, errors
+
+
+def _read_samples_parallel(samples, normalized_length: int, memmap_path: str, workers: int,
+                           verbose: bool = False, trim_silence: bool = False) -> tuple:
+    """
+    Decodes samples into a matrix by a pool of `workers` processes, samples are split into shards
+    and each worker writes rows of its shard directly into the matrix, which is shared
+    (through shared memory or the memory mapped file), so no arrays are pickled back.
+    :returns: X, [None or error message of each sample]
+    """
+    shape = (len(samples), normalized_length)
+    if memmap_path is None:
+        buffer = RawArray('f', shape[0] * shape[1])
+        X = np.frombuffer(buffer, dtype=np.float32).reshape(shape)
+    else:
+        buffer = None
+        X = _allocate_samples_matrix(shape, memmap_path)
+        X.flush()
+    # a few shards per worker, so they're balanced when some samples are slower to read
+    shard_size = -(-len(samples) // (workers * 4))
+    shards = [
+        (start, samples[start:start + shard_size], trim_silence)
+        for start in range(0, len(samples), shard_size)
+    ]
+    errors = [None] * len(samples)
+    with Pool(workers, initializer=_init_reader, initargs=(buffer, shape, memmap_path)) as pool:
+        for start, shard_errors in pool.imap_unordered(_read_shard, shards):
+            errors[start:start + len(shard_errors)] = shard_errors
+            if verbose:
+                print('\b\b=|>', end="", flush=True)
+    return X, errors
+
+
+def read_samples(samples, labels, normalized_length=0, verbose=False, memmap_path=None, workers=None,
+                 trim_silence=False):
+    """
+    Reads samples into a matrix X with a row for each sample, and vector y of their labels,
+    samples which could not be read are skipped.
+    If `normalized_length` is given, X is a float32 matrix of shape (samples, normalized_length),
+    allocated once, samples are decoded and normalized directly into its rows.
+    :param memmap_path: str - if given (with `normalized_length`), X is backed by a memory mapped
+    .npy file at this path, so it can be bigger than the memory
+    :param workers: int - if given (with `normalized_length`), samples are decoded by a pool
+    of this many processes, samples have to be picklable. Daemonic processes (eg. workers
+    of ManagedExecutor) can't start a pool, they decode samples by themselves
+    :param trim_silence: bool - if True, leading and trailing silence of samples is removed
+    :returns: X, y
+    """
     if verbose:
         print('Loading data, found {} samples.'.format(len(samples)))
         print('[|>', end='', flush=True)
-    X, y = [], []
+    if normalized_length and workers and workers > 1 and len(samples) > 1 and not current_process().daemon:
+        X, errors = _read_samples_parallel(samples, normalized_length, memmap_path, workers, verbose,
+                                           trim_silence)
+        y = []
+        for num, (error, label) in enumerate(zip(errors, labels)):
+            if error is not None:
+                print(
+                    '\n file could not have been loaded'
+                    ' because of an exception: ' + error
+                )
+                continue
+            # rows of skipped samples are filled by the following ones, keeping their order
+            if len(y) != num:
+                X[len(y)] = X[num]
+            y.append(label)
+        if verbose:
+            print(']\n', flush=True)
+        return X[:len(y)], np.array(y)
+    if normalized_length:
+        X = _allocate_samples_matrix((len(samples), normalized_length), memmap_path)
+    else:
+        X = []
+    y = []
     verbose_step = len(samples) // 100
     for sample, label in zip(samples, labels):
         try:
             verbose_step -= 1
-            X.append(read_sample(sample, normalized_length))
+            if normalized_length:
+                read_sample_into(sample, X[len(y)], trim_silence)
+            else:
+                X.append(read_sample(sample, trim_silence=trim_silence))
             y.append(label)
             if verbose and verbose_step == 0:
                 print('\b\b=|>', end="", flush=True)
@@ -68,4 +291,6 @@ def read_samples(samples, labels, normalized_length=0, verbose=False):
             )
     if verbose:
         print(']\n', flush=True)
+    if normalized_length:
+        return X[:len(y)], np.array(y)
     return np.array(X), np.array(y)
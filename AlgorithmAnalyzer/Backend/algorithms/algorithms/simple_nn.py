@@ -1,14 +1,34 @@
+import os
+import tempfile
+from io import BytesIO
+
+from tensorflow.python.keras.callbacks import Callback
 from tensorflow.python.keras.layers import Activation, Dropout, Dense, Flatten
 from tensorflow.python.keras.models import Sequential, load_model, save_model
 # from tensorflow.python.keras.utils.np_utils import to_categorical
 from tensorflow.python.keras.backend import clear_session
 from tensorflow import reset_default_graph, get_default_graph
+import h5py
 import numpy as np
 
-from algorithms.algorithms.preprocessing import read_samples, read_sample
+from algorithms.algorithms.preprocessing import DECODER_VERSION, read_samples, read_sample
 from algorithms.base_algorithm import Algorithm, AlgorithmException
 
 
+class StopOnCancel(Callback):
+    """
+    Stops training after the epoch in which the job was cancelled.
+    """
+
+    def __init__(self, status_updater):
+        super().__init__()
+        self.status_updater = status_updater
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.status_updater.is_cancelled():
+            self.model.stop_training = True
+
+
 class SimpleNN(Algorithm):
     tensorflow_graph = get_default_graph()
 
@@ -18,9 +38,18 @@ class SimpleNN(Algorithm):
     }
 
     SAMPLE_LENGTH = 4 * 4096
+    # if set, training data is kept in a memory mapped file in this directory instead of the memory
+    SAMPLES_MEMMAP_DIR = None
+    # number of processes decoding training samples (in the job's process, before they're sent
+    # to the training process), they're decoded by one process if None
+    PREPROCESSING_WORKERS = os.cpu_count()
+    # if True, leading and trailing silence is removed from samples, so SAMPLE_LENGTH is filled with speech,
+    # models trained with and without it aren't compatible
+    TRIM_SILENCE = False
 
     def __init__(self, parameters=None, path=None):
         self.model = None
+        self.status_updater = None
         if(parameters):
             self.parameters = parameters
         elif(path):
@@ -45,6 +74,10 @@ class SimpleNN(Algorithm):
 
         self.model = model
 
+    @classmethod
+    def get_preprocessing(cls):
+        return {'sample_length': cls.SAMPLE_LENGTH, 'trim_silence': cls.TRIM_SILENCE, 'decoder': DECODER_VERSION}
+
     @classmethod
     def get_parameters(cls):
         return {
@@ -60,19 +93,49 @@ class SimpleNN(Algorithm):
             }
         }
 
+    @classmethod
+    def preprocess_samples(cls, samples, labels):
+        if cls.SAMPLES_MEMMAP_DIR:
+            # the memory mapped file is created and removed by the training process
+            return samples, labels
+        return read_samples(samples, labels, normalized_length=cls.SAMPLE_LENGTH,
+                            workers=cls.PREPROCESSING_WORKERS, trim_silence=cls.TRIM_SILENCE)
+
     def train(self, samples, labels):
         print(samples)
         print(labels)  # for some reason gridFS has problems without those prints
-        X, y = read_samples(samples, labels, normalized_length=self.SAMPLE_LENGTH)
-        y = self.to_categorical(y)
-        with SimpleNN.tensorflow_graph.as_default():
-            try:
-                self._prepare_model()
-                self.model.fit(X, y,
-                               epochs=self.parameters['epochs'], validation_split=.25, verbose=self.parameters['verbosity']
-                               )
-            except Exception as e:
-                raise AlgorithmException(str(e))
+        memmap_path = None
+        if self.SAMPLES_MEMMAP_DIR and not isinstance(samples, np.ndarray):
+            fd, memmap_path = tempfile.mkstemp(suffix='.npy', dir=self.SAMPLES_MEMMAP_DIR)
+            os.close(fd)
+        try:
+            if isinstance(samples, np.ndarray):
+                # already decoded by preprocess_samples
+                X, y = samples, labels
+            else:
+                X, y = read_samples(samples, labels, normalized_length=self.SAMPLE_LENGTH, memmap_path=memmap_path,
+                                    workers=self.PREPROCESSING_WORKERS, trim_silence=self.TRIM_SILENCE)
+            y = self.to_categorical(y)
+            with SimpleNN.tensorflow_graph.as_default():
+                try:
+                    self._prepare_model()
+                    callbacks = [StopOnCancel(self.status_updater)] if self.status_updater else []
+                    self.model.fit(X, y,
+                                   epochs=self.parameters['epochs'], validation_split=.25,
+                                   verbose=self.parameters['verbosity'], callbacks=callbacks
+                                   )
+                except Exception as e:
+                    raise AlgorithmException(str(e))
+        finally:
+            if memmap_path:
+                # the file is unmapped when X is garbage collected
+                os.remove(memmap_path)
+        if self.status_updater and self.status_updater.is_cancelled():
+            # the model won't be saved, the graph is shared with other models so it's not cleared
+            self.model = None
+
+    def set_status_updater(self, updater):
+        self.status_updater = updater
 
     def to_categorical(self, y):
         y = np.array(y, dtype='int')
@@ -89,14 +152,24 @@ class SimpleNN(Algorithm):
         return categorical
 
     def predict(self, data):
-        data = read_sample(data, normalized_length=self.SAMPLE_LENGTH)
-        data = data.reshape((1, self.SAMPLE_LENGTH))
+        return self.predict_batch([data])[0]
+
+    def predict_batch(self, samples):
+        if not samples:
+            return []
+        data = np.stack([
+            read_sample(sample, normalized_length=self.SAMPLE_LENGTH, trim_silence=self.TRIM_SILENCE)
+            for sample in samples
+        ])
         with SimpleNN.tensorflow_graph.as_default():
-            preds = self.model.predict(data)
-        return bool(preds[0][1] > preds[0][0]), {
-            "Probability of being real: ": float(preds[0][1]),
-            "Probability of being fake: ": float(preds[0][0])
-        }
+            preds = self.model.predict(data, batch_size=len(samples))
+        return [
+            (bool(pred[1] > pred[0]), {
+                "Probability of being real: ": float(pred[1]),
+                "Probability of being fake: ": float(pred[0])
+            })
+            for pred in preds
+        ]
 
     def save(self, path):
         print(path)
@@ -106,6 +179,14 @@ class SimpleNN(Algorithm):
         except Exception as e:
             raise AlgorithmException(str(e))
 
+    @classmethod
+    def load_packed(cls, files):
+        model = cls()
+        with SimpleNN.tensorflow_graph.as_default():
+            with h5py.File(BytesIO(files['model.h5']), 'r') as f:
+                model.model = load_model(f)
+        return model
+
     def load(self, path):
         # those are needed as tensorflow has some problems
         # see: https://github.com/tensorflow/tensorflow/issues/14356
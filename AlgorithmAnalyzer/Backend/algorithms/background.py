@@ -1,8 +1,17 @@
+import os
+import time
+from datetime import datetime
 from functools import wraps
 from threading import Thread
 
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from pymongo import MongoClient, errors
+from pymongo import ASCENDING, errors
+
+from utils.db_clients import get_client
+
+# error of jobs stopped by the user
+JOB_CANCELLED_MESSAGE = "The job was cancelled."
 
 
 class DatabaseException(Exception):
@@ -10,6 +19,12 @@ class DatabaseException(Exception):
         super().__init__(self, *args, **kwargs)
 
 
+class JobCancelledException(Exception):
+    """
+    Raised inside of a job to stop it, after the user cancelled it.
+    """
+
+
 def database_secure(f):
     """
     Raises DatabaseException when database is unavailable.
@@ -26,38 +41,81 @@ def database_secure(f):
     return inner
 
 
+class BackgroundTask(Thread):
+    """
+    Thread running a background task, an exception raised by the task
+    is kept in `exception`, so whoever waits for the task can report it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exception = None
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            self.exception = e
+            raise
+
+
 def background_task(f):
     @wraps(f)
     def inner(*args, **kwargs):
-        t = Thread(target=f, args=args, kwargs=kwargs)
+        t = BackgroundTask(target=f, args=args, kwargs=kwargs)
         # TODO: change threading to something different because of GIL
         t.start()
         return t
     return inner
 
 
-def get_status_updater_factory(db_url, db_name, show_logs=True):
+def get_status_updater_factory(db_url, db_name, show_logs=True, finished_jobs_ttl=7 * 24 * 3600,
+                               min_interval=1., min_progress_delta=.01):
+    """
+    Returns a function creating StatusUpdaters of jobs, called with kwarg job_id.
+    :param min_interval: minimal number of seconds between two writes of job's progress
+    :param min_progress_delta: minimal change of progress which is written
+    """
+    # one provider is shared by all updaters created in a process
+    providers = {}
+
     def inner(*args, **kwargs):
-        jsp = JobStatusProvider(db_url, db_name, show_logs)
-        return StatusUpdater(kwargs['job_id'], jsp)
+        pid = os.getpid()
+        if pid not in providers:
+            providers.clear()
+            providers[pid] = JobStatusProvider(db_url, db_name, show_logs, finished_jobs_ttl)
+        return StatusUpdater(kwargs['job_id'], providers[pid], min_interval, min_progress_delta)
     return inner
 
 
+# (pid, db_url, db_name) -> JobStatusProvider used by status updaters unpickled in this process
+_unpickled_providers = {}
+
+
+def _get_unpickled_provider(db_url, db_name):
+    key = (os.getpid(), db_url, db_name)
+    if key not in _unpickled_providers:
+        _unpickled_providers[key] = JobStatusProvider(db_url, db_name, show_logs=False)
+    return _unpickled_providers[key]
+
+
 class JobStatusProvider:
     """
     This class serves as a frontend for job statuses.
+    Statuses of finished jobs are removed by the database
+    `finished_jobs_ttl` seconds after the job was finished.
     """
 
-    def __init__(self, db_url: str, db_name: str, show_logs: bool = True):
+    def __init__(self, db_url: str, db_name: str, show_logs: bool = True,
+                 finished_jobs_ttl: int = 7 * 24 * 3600):
         """
         :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
         :param db_name: str - database name
         :param show_logs: bool - used to suppress log messages
+        :param finished_jobs_ttl: int - seconds after which statuses of finished jobs are removed
         """
         self._db_url = db_url
-        self._db_client = MongoClient(db_url, serverSelectionTimeoutMS=5000)
-        self._database = self._db_client[db_name]
-        self._jobs = self._database.jobs
+        self._db_name = db_name
         try:
             self._db_client.server_info()
             if show_logs:
@@ -67,6 +125,39 @@ class JobStatusProvider:
                 f"Could not connect to MongoDB at '{db_url}'"
             )
         self._show_logs = show_logs
+        self._setup_indexes(finished_jobs_ttl)
+
+    # database objects are resolved on each access, so a provider created before fork (eg. in config)
+    # uses the client of current process
+    @property
+    def _db_client(self):
+        return get_client(self._db_url)
+
+    @property
+    def _database(self):
+        return self._db_client[self._db_name]
+
+    @property
+    def _jobs(self):
+        return self._database.jobs
+
+    def _setup_indexes(self, finished_jobs_ttl: int):
+        try:
+            # covers job_with_data_is_running
+            self._jobs.create_index(
+                [('finished', ASCENDING), ('error', ASCENDING), ('data.algorithm', ASCENDING)]
+            )
+            try:
+                self._jobs.create_index('finishedAt', expireAfterSeconds=finished_jobs_ttl)
+            except errors.OperationFailure:
+                # index exists with a different ttl
+                self._database.command(
+                    'collMod', self._jobs.name,
+                    index={'keyPattern': {'finishedAt': 1}, 'expireAfterSeconds': finished_jobs_ttl}
+                )
+        except errors.PyMongoError as e:
+            if self._show_logs:
+                print(f" * #WARNING: could not create indexes of jobs: {str(e)}")
 
     def _job_status_schema(
         self, progress: float, finished: bool = False, error: str = None, data: dict = None
@@ -95,25 +186,63 @@ class JobStatusProvider:
 
         if job_page is not None:
             job_page.pop('_id', None)
+            job_page.pop('finishedAt', None)
         return job_page
 
     @database_secure
     def update_job_status(
-        self, jid: str, progress: float, finished: bool = False, error: str = None
+        self, jid: str, progress: float, finished: bool = False, error: str = None, result=None
     ):
-        old = self.read_job_status(jid)
-        if not old:
+        fields = {
+            'progress': progress,
+            'finished': finished,
+            'error': error
+        }
+        if result is not None:
+            # jobs computing something (eg. testing) store it's result in the status
+            fields['result'] = result
+        self.update_job_fields(jid, fields)
+
+    @database_secure
+    def update_job_fields(self, jid: str, fields: dict):
+        """
+        Sets only given fields of job's status, with a single write.
+        Nothing is done if there is no such job.
+        :param fields: dict - {field name: new value}, eg. {'progress': .5}
+        """
+        try:
+            jid = ObjectId(jid)
+        except (InvalidId, TypeError):
             return
-        self._jobs.update_one(
-            {'_id': ObjectId(jid)}, {
-                '$set': {
-                    'progress': progress,
-                    'finished': finished,
-                    'error': error,
-                    'data': old['data']
-                }
-            }
-        )
+        fields = dict(fields)
+        if fields.get('finished'):
+            # read by the ttl index
+            fields['finishedAt'] = datetime.utcnow()
+        self._jobs.update_one({'_id': jid}, {'$set': fields})
+
+    @database_secure
+    def cancel_job(self, jid: str, finish: bool = True):
+        """
+        Marks the job as cancelled, running jobs check the mark and stop
+        (see StatusUpdater.is_cancelled), then they finish with JOB_CANCELLED_MESSAGE error.
+        :param finish: bool - if True, the job is marked as finished at once,
+        it should be used for jobs which aren't running
+        """
+        fields = {'cancelled': True}
+        if finish:
+            fields.update({'finished': True, 'error': JOB_CANCELLED_MESSAGE})
+        self.update_job_fields(jid, fields)
+
+    @database_secure
+    def is_job_cancelled(self, jid: str) -> bool:
+        """
+        Returns True if the job was cancelled or it's status was deleted.
+        """
+        try:
+            doc = self._jobs.find_one({'_id': ObjectId(jid)}, {'cancelled': 1})
+        except (InvalidId, TypeError):
+            return True
+        return doc is None or doc.get('cancelled', False)
 
     @database_secure
     def delete_job_status(self, jid: str):
@@ -121,21 +250,25 @@ class JobStatusProvider:
 
     @database_secure
     def job_with_data_is_running(self, data: dict) -> bool:
-        # TODO: should we check with full data or only algorithm?
-        docs = self._jobs.find(
+        """
+        Returns the id of a running job of the same algorithm, type and users as in `data`,
+        or False if there is no such job.
+        """
+        # training and testing jobs of the same algorithm are different jobs,
+        # missing type / users match jobs without them
+        doc = self._jobs.find_one(
             {
                 'finished': False,
-                'error': None
-            }
+                'error': None,
+                'data.algorithm': data['algorithm'],
+                'data.type': data.get('type'),
+                'data.users': data.get('users')
+            },
+            {'_id': 1}
         )
-        if docs is None:
+        if doc is None:
             return False
-
-        for doc in docs:
-            if doc and 'data' in doc and doc['data'] and 'algorithm' in doc['data']:
-                if doc['data']['algorithm'] == data['algorithm']:
-                    return str(doc['_id'])
-        return False
+        return str(doc['_id'])
 
     @database_secure
     def get_all_running_jobs(self):
@@ -154,16 +287,99 @@ class StatusUpdater:
     This class can only update statuse.
     It is passed to AlgorithmManager, which in turn passes it to
     algorithms to enable them to update status.
+    Progress updates are coalesced: progress is written at most once per `min_interval`
+    seconds and only if it changed by at least `min_progress_delta`,
+    final states and errors are always written at once.
+    The latest skipped update is kept and written with the next check of cancellation
+    after `min_interval`, or by flush.
+    Only fields which changed since the last write are written.
+    Status updaters can be pickled (eg. to be sent to worker processes),
+    the unpickled updater connects to the same database on its own.
     """
-    def __init__(self, job_id, job_status_provider):
+    def __init__(self, job_id, job_status_provider, min_interval: float = 1., min_progress_delta: float = .01):
         self._jid = job_id
         self._jsp = job_status_provider
+        self._min_interval = min_interval
+        self._min_progress_delta = min_progress_delta
+        # state of a newly created job
+        self._written = {'progress': 0, 'finished': False, 'error': None}
+        self._last_write = None
+        # the latest update skipped by throttling
+        self._pending = None
+        self._cancelled = False
+        self._last_cancel_check = None
+        self._detached = False
 
-    def update(self, progress: float = 0, finished: bool = False, error: str = None):
+    def __getstate__(self) -> dict:
+        return {
+            'job_id': self._jid,
+            'db_location': (self._jsp._db_url, self._jsp._db_name),
+            'min_interval': self._min_interval,
+            'min_progress_delta': self._min_progress_delta
+        }
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['job_id'], _get_unpickled_provider(*state['db_location']),
+                      state['min_interval'], state['min_progress_delta'])
+
+    def is_cancelled(self) -> bool:
+        """
+        Returns True if the user cancelled the job, which should then stop as soon as possible.
+        The database is checked at most once per `min_interval` seconds.
+        """
+        if self._cancelled or self._detached:
+            return True
+        now = time.monotonic()
+        if self._last_cancel_check is None or now - self._last_cancel_check >= self._min_interval:
+            self._last_cancel_check = now
+            if self._pending is not None and now - self._last_write >= self._min_interval:
+                self.flush()
+            try:
+                self._cancelled = self._jsp.is_job_cancelled(self._jid)
+            except Exception as e:
+                print("Read job status exception: " + str(e))
+        return self._cancelled
+
+    def detach(self):
+        """
+        Stops the job run using this updater, eg. after the job was claimed by another worker:
+        the updater doesn't write job's status anymore and reports the job as cancelled.
+        Copies of the updater sent to worker processes are not affected.
+        """
+        self._detached = True
+
+    def flush(self):
+        """
+        Writes the latest update skipped by throttling, if there is one.
+        """
+        if self._pending is not None and not self._detached:
+            return self._write(self._pending)
+
+    def update(self, progress: float = 0, finished: bool = False, error: str = None, result=None):
+        if self._detached:
+            return
+        new = {'progress': progress, 'finished': finished, 'error': error}
+        final = finished or error is not None or result is not None
+        if not final and self._last_write is not None:
+            if time.monotonic() - self._last_write < self._min_interval or \
+                    abs(progress - self._written['progress']) < self._min_progress_delta:
+                # progress equal to the written one needs no write
+                self._pending = new if new != self._written else None
+                return
+        return self._write(new, result)
+
+    def _write(self, new: dict, result=None):
+        fields = {key: value for key, value in new.items() if self._written.get(key) != value}
+        if result is not None:
+            fields['result'] = result
+        # the newest update replaces the skipped one
+        self._pending = None
+        if not fields:
+            return
         try:
-            self._jsp.update_job_status(
-                jid=self._jid, progress=progress, finished=finished, error=error
-            )
+            self._jsp.update_job_fields(self._jid, fields)
         except Exception as e:
             print("Update job status exception: " + str(e))
             return str(e)
+        self._written.update(new)
+        self._last_write = time.monotonic()
@@ -14,6 +14,10 @@ class AlgorithmException(Exception):
     def __str__(self):
         return self.message
 
+    def __reduce__(self):
+        # errors of algorithms run in worker processes are pickled
+        return self.__class__, (self.message,)
+
 
 class Algorithm(metaclass=ABCMeta):
     """
@@ -109,9 +113,57 @@ class Algorithm(metaclass=ABCMeta):
         If such probabilities cannot be given, just return an empty dictionary instead.
         """
 
+    def predict_batch(self, samples):
+        """
+        This method should predict labels of a list of samples,
+        it returns a list of pairs, the same as returned by predict, one for each sample.
+        It's used when testing models on many samples, by default it calls predict
+        for each sample, override it if the algorithm can predict many samples at once
+        (eg. in one forward pass of a network).
+        """
+        return [self.predict(sample) for sample in samples]
+
+    @classmethod
+    def load_packed(cls, files):
+        """
+        This method can be overriden to load a model from an archive of models,
+        packed to load many models with one read (see ModelArchive).
+        `files` is a dictionary of the form
+            {'path relative to model's directory': file's bytes}
+        eg. if the model was saved with save(path) to files `path` and `path + '.json'`,
+        it will contain keys 'model' and 'model.json'.
+        It should return the loaded model, or None if it can't be loaded this way -
+        by default None is returned and the model is loaded with __init__(path=path).
+        """
+        return None
+
+    @classmethod
+    def get_preprocessing(cls):
+        """
+        This method can be overriden to return settings of samples' preprocessing,
+        which aren't parameters selected by the user (eg. class attributes of the algorithm), of the form
+        {
+            'setting_name': value
+        }
+        Models trained with different settings are not trained on the same data,
+        so they're trained again by incremental training. By default an empty dictionary is returned.
+        """
+        return {}
+
+    @classmethod
+    def preprocess_samples(cls, samples, labels):
+        """
+        This method can be overriden to prepare samples of a user before they're passed to train,
+        it's called by the job's process, while train of not multilabel models may be run
+        by a worker process, which can't start processes of its own (eg. to decode samples in parallel).
+        It should return a pair (samples, labels) accepted by train, picklable if models
+        are trained by worker processes. By default samples and labels are returned unchanged.
+        """
+        return samples, labels
+
     def set_status_updater(self, updater):
         """
-        If model is multilabel, this method will be called before training.
+        This method will be called before training.
         It will pass `updater` - an object, that can be used to
         pass the status of training to the user.
         Always training is done in the background and each training 'session' has
@@ -131,12 +183,19 @@ class Algorithm(metaclass=ABCMeta):
                     batches_done = num / len(data_batches)
                     self.status_updater.update(progress=batches_done)
 
-        Object `updater` has only one method:
+        Object `updater` has two methods:
             ok = updater.update(progress: float, finished: bool = False, error: str = None)
             if ok is not None:
                 # there was an error with updating
                 print("Error message: " + str(ok))
-
-        For not multilabel models updates are done authomatically based on number of users.
+        Updates are throttled before being written to the database,
+        so it's fine to call it after every batch.
+            if updater.is_cancelled():
+                # the user cancelled the job, stop training (eg. after current epoch),
+                # the model won't be saved
+                return
+
+        For not multilabel models updates are done authomatically based on number of users,
+        so those models should only use is_cancelled.
         """
         pass
@@ -0,0 +1,82 @@
+import atexit
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from threading import Lock
+
+
+class InlineExecutor(Executor):
+    """
+    Executor running submitted calls immediately in the calling thread,
+    used when no worker processes are configured (eg. in tests).
+    """
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+
+class ManagedExecutor:
+    """
+    Application-level pool of worker processes, shared by all algorithm managers.
+    Workers are started on first use (once per process, so the executor
+    can be created before the app forks) and shut down when the app exits.
+    Calls and their arguments are pickled, so only module level functions
+    and picklable objects can be sent to workers.
+    With workers=0 calls are run inline in the calling thread.
+    """
+
+    def __init__(self, workers: int = None):
+        """
+        :param workers: int - number of worker processes, number of cpus if not given
+        """
+        self.workers = os.cpu_count() if workers is None else workers
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+        atexit.register(self.shutdown)
+
+    @property
+    def inline(self) -> bool:
+        """
+        True if calls are run in the calling process,
+        so their results do not have to be picklable.
+        """
+        return self.workers == 0
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid() or getattr(self._executor, '_broken', False):
+                # pool inherited from the parent process can't be used after fork,
+                # pool with a crashed worker can't be used at all
+                self._executor = InlineExecutor() if self.inline else ProcessPoolExecutor(self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs) on one of the workers.
+        :returns: Future of the call
+        """
+        return self._get_executor().submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        """
+        Like builtin map, but calls are run on the workers.
+        """
+        return self._get_executor().map(fn, *iterables)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the workers, they will be started again on next submit.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pid = self._pid
+        if executor is not None and pid == os.getpid():
+            executor.shutdown(wait=wait)
@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+from typing import Dict
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, errors
+
+from algorithms.background import database_secure
+from utils.db_clients import get_client
+
+''''''''''''''''
+example of single MongoDB document representing a queued job
+
+{
+    "_id" : ObjectId("5c05b2a837aeab2bca848c80"),       // mongo document id
+    "jobId" : "5c05b2a837aeab2bca848c75",               // id of job's status in JobStatusProvider
+    "kind" : "train",                                   // one of JobQueue.KINDS
+    "algorithm" : "Simple Neural Net",                  // name of the algorithm
+    "payload" : {"parameters": {"epochs": 10}},         // arguments of the job, depend on kind
+    "priority" : 0,                                     // jobs with higher priority are run first
+    "state" : "running",                                // one of: queued, running, done, failed, cancelled
+    "attempts" : 1,                                     // how many times the job was claimed
+    "worker" : "host:1234:0",                           // id of worker running the job
+    "leaseExpires" : ISODate("2018-12-03T22:51:20Z"),   // job is requeued if its worker doesn't renew the lease
+    "created" : ISODate("2018-12-03T22:50:20Z"),
+    "finishedAt" : ISODate("2018-12-03T22:55:20Z")      // set when job is done or failed
+}
+'''''''''''''''
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobQueue:
+    """
+    Persistent queue of training and testing jobs, stored in MongoDB.
+    Jobs are claimed by JobWorkers running in separate processes.
+    A claimed job is leased to its worker, which has to renew the lease (heartbeat)
+    while the job is running. Jobs of workers which died (their lease expired)
+    are claimed again by other workers, at most `max_attempts` times.
+    """
+
+    KINDS = ('train', 'test')
+
+    def __init__(self, db_url: str, db_name: str, show_logs: bool = True,
+                 concurrency: Dict[str, int] = None, default_concurrency: int = 1,
+                 lease_seconds: int = 60, max_attempts: int = 3, finished_jobs_ttl: int = 7 * 24 * 3600):
+        """
+        :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
+        :param db_name: str - database name
+        :param show_logs: bool - used to suppress log messages
+        :param concurrency: dict - {algorithm name: maximal number of its jobs running at once}
+        :param default_concurrency: int - limit of running jobs for algorithms not in `concurrency`
+        :param lease_seconds: int - seconds after which a job without heartbeat is requeued
+        :param max_attempts: int - a job claimed this many times is failed instead of being run again
+        :param finished_jobs_ttl: int - seconds after which finished jobs are removed from the queue
+        """
+        self._db_url = db_url
+        self._db_name = db_name
+        self._show_logs = show_logs
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        try:
+            self._queue.create_index([('state', ASCENDING), ('priority', DESCENDING), ('_id', ASCENDING)])
+            self._queue.create_index([('state', ASCENDING), ('leaseExpires', ASCENDING)])
+            self._queue.create_index('jobId')
+            self._queue.create_index('finishedAt', expireAfterSeconds=finished_jobs_ttl)
+        except errors.PyMongoError as e:
+            # database may be unavailable yet, indexes will be created on next start
+            if show_logs:
+                print(f" * #WARNING: could not create indexes of job queue: {str(e)}")
+
+    @property
+    def _queue(self):
+        # resolved on each access, so a queue created before fork uses the client of current process
+        return get_client(self._db_url)[self._db_name].queue
+
+    @database_secure
+    def enqueue(self, job_id: str, kind: str, algorithm: str, payload: dict = None, priority: int = 0) -> str:
+        """
+        Adds a job to the queue.
+        :param job_id: str - id of job's status in JobStatusProvider
+        :param kind: str - one of JobQueue.KINDS
+        :param algorithm: str - name of the algorithm
+        :param payload: dict - arguments of the job, eg. {'parameters': {...}} for training
+        :param priority: int - jobs with higher priority are run first
+        :returns: id of the queued job
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown kind of job '{kind}', valid are {self.KINDS}")
+        doc = {
+            'jobId': job_id,
+            'kind': kind,
+            'algorithm': algorithm,
+            'payload': payload or {},
+            'priority': priority,
+            'state': QUEUED,
+            'attempts': 0,
+            'worker': None,
+            'leaseExpires': None,
+            'created': datetime.utcnow()
+        }
+        return str(self._queue.insert_one(doc).inserted_id)
+
+    def _get_full_algorithms(self, now: datetime) -> list:
+        """
+        returns names of algorithms which have the maximal number of jobs running
+        """
+        running = self._queue.aggregate([
+            {'$match': {'state': RUNNING, 'leaseExpires': {'$gt': now}}},
+            {'$group': {'_id': '$algorithm', 'count': {'$sum': 1}}}
+        ])
+        return [
+            doc['_id'] for doc in running
+            if doc['count'] >= self.concurrency.get(doc['_id'], self.default_concurrency)
+        ]
+
+    @database_secure
+    def claim(self, worker_id: str) -> dict:
+        """
+        Leases the queued job with the highest priority to a worker.
+        Jobs of algorithms running their maximal number of jobs are skipped,
+        (two workers claiming at the same moment may exceed the limit by one),
+        jobs with expired leases are claimed again. If the job was already claimed
+        more than `max_attempts` times, the worker should fail it instead of running it.
+        :param worker_id: str - unique id of the worker
+        :returns: claimed job document or None if there is nothing to run
+        """
+        now = datetime.utcnow()
+        return self._queue.find_one_and_update(
+            {
+                '$or': [
+                    {'state': QUEUED},
+                    {'state': RUNNING, 'leaseExpires': {'$lte': now}}
+                ],
+                'algorithm': {'$nin': self._get_full_algorithms(now)}
+            },
+            {
+                '$set': {
+                    'state': RUNNING,
+                    'worker': worker_id,
+                    'leaseExpires': now + timedelta(seconds=self.lease_seconds)
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('priority', DESCENDING), ('_id', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @database_secure
+    def heartbeat(self, queue_id: ObjectId, worker_id: str) -> bool:
+        """
+        Renews the lease of a running job.
+        :returns: False if the job is no longer leased to the worker
+        """
+        res = self._queue.update_one(
+            {'_id': queue_id, 'worker': worker_id, 'state': RUNNING},
+            {'$set': {'leaseExpires': datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return res.matched_count == 1
+
+    @database_secure
+    def complete(self, queue_id: ObjectId, worker_id: str):
+        """
+        Marks a job run by the worker as done.
+        """
+        self._finish(queue_id, worker_id, DONE)
+
+    @database_secure
+    def fail(self, queue_id: ObjectId, worker_id: str):
+        """
+        Marks a job run by the worker as failed, it won't be run again.
+        """
+        self._finish(queue_id, worker_id, FAILED)
+
+    def _finish(self, queue_id: ObjectId, worker_id: str, state: str):
+        self._queue.update_one(
+            {'_id': queue_id, 'worker': worker_id},
+            {'$set': {'state': state, 'leaseExpires': None, 'finishedAt': datetime.utcnow()}}
+        )
+
+    @database_secure
+    def cancel(self, job_id: str) -> str:
+        """
+        Removes a queued job with given status id from the queue, it won't be run.
+        Running jobs are not affected, they should be cancelled with JobStatusProvider.cancel_job.
+        :returns: state of the job before cancelling, None if there is no such job
+        """
+        doc = self._queue.find_one_and_update(
+            {'jobId': job_id, 'state': QUEUED},
+            {'$set': {'state': CANCELLED, 'finishedAt': datetime.utcnow()}}
+        )
+        if doc is not None:
+            return QUEUED
+        return self.get_state(job_id)
+
+    @database_secure
+    def get_state(self, job_id: str) -> str:
+        """
+        :returns: state of the most recent queued job with given status id, None if there is no such job
+        """
+        doc = self._queue.find_one({'jobId': job_id}, {'state': 1}, sort=[('_id', DESCENDING)])
+        return doc['state'] if doc else None
@@ -0,0 +1,220 @@
+"""
+Runs workers of training and testing jobs queued in JobQueue by the app,
+so that jobs don't compete for the interpreter with handling requests.
+Usage (from ./Backend):
+    python -m algorithms.job_worker --config config.ProductionConfig --processes 2
+"""
+import argparse
+import importlib
+import itertools
+import os
+import signal
+import socket
+import time
+
+from algorithms.background import background_task, JOB_CANCELLED_MESSAGE
+from utils.db_clients import configure_clients, close_clients
+
+# distinguishes workers running in one process
+_worker_numbers = itertools.count()
+
+
+class JobWorker:
+    """
+    Claims jobs from JobQueue and runs them with the algorithm manager,
+    renewing the job's lease until it's finished.
+    Samples of jobs are fetched from the sample manager by the worker.
+    """
+
+    def __init__(self, job_queue, algorithm_manager, sample_manager, worker_id: str = None, show_logs: bool = True):
+        """
+        :param job_queue: JobQueue from which jobs are claimed
+        :param algorithm_manager: class of AlgorithmManager (as created by algorithm_manager_factory)
+        :param sample_manager: SampleManager providing samples for jobs
+        :param worker_id: str - unique id of the worker, generated if not given
+        :param show_logs: bool - used to suppress log messages
+        """
+        self.job_queue = job_queue
+        self.algorithm_manager = algorithm_manager
+        self.sample_manager = sample_manager
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{next(_worker_numbers)}"
+        self.show_logs = show_logs
+        self._stopped = False
+
+    def _start_job(self, job: dict, status_updaters: list):
+        """
+        starts the job with the algorithm manager,
+        :param status_updaters: list to which status updaters created by the job are appended
+        :returns: BackgroundTask running the job
+        """
+        manager = self.algorithm_manager(job['algorithm'])
+        create_status_updater = manager.status_updater_factory
+
+        def status_updater_factory(*args, **kwargs):
+            status_updater = create_status_updater(*args, **kwargs)
+            status_updaters.append(status_updater)
+            return status_updater
+
+        manager.status_updater_factory = status_updater_factory
+        payload = job['payload']
+        if job['kind'] == 'train':
+            samples, labels = self.sample_manager.get_all_samples(
+                purpose='train', multilabel=manager.multilabel, sample_type='wav'
+            )
+            return manager.train(samples, labels, payload['parameters'], job['jobId'],
+                                 payload.get('incremental', False))
+        samples, labels = self.sample_manager.get_all_samples(
+            purpose='test', multilabel=manager.multilabel, sample_type='wav'
+        )
+        return manager.run_test_job(samples, labels, payload['users'], payload['user_numbers'], job['jobId'])
+
+    def _report_error(self, job: dict, error: str):
+        status_updater = self.algorithm_manager.status_updater_factory(job_id=job['jobId'])
+        status_updater.update(progress=0, finished=True, error=error)
+
+    def _is_cancelled(self, job: dict) -> bool:
+        return self.algorithm_manager.status_updater_factory(job_id=job['jobId']).is_cancelled()
+
+    def _renew_lease(self, job: dict) -> bool:
+        """
+        Renews the lease of a running job, a failed renewal (eg. database is unavailable)
+        is retried with the next heartbeat, before the lease expires.
+        :returns: False if the job was claimed by another worker
+        """
+        try:
+            return self.job_queue.heartbeat(job['_id'], self.worker_id)
+        except Exception as e:
+            if self.show_logs:
+                print(f" * #WARNING: worker '{self.worker_id}' could not renew the lease of job '{job['jobId']}': "
+                      f"{str(e)}")
+            return True
+
+    def run_job(self, job: dict):
+        """
+        Runs a claimed job and waits for it to finish, renewing it's lease meanwhile.
+        """
+        if job['attempts'] > self.job_queue.max_attempts:
+            # job was claimed by workers which died before finishing it
+            self.job_queue.fail(job['_id'], self.worker_id)
+            self._report_error(job, f"The job was abandoned after {self.job_queue.max_attempts} attempts.")
+            return
+        if self._is_cancelled(job):
+            # job was cancelled while its previous worker was running it
+            self.job_queue.complete(job['_id'], self.worker_id)
+            self._report_error(job, JOB_CANCELLED_MESSAGE)
+            return
+        status_updaters = []
+        try:
+            thread = self._start_job(job, status_updaters)
+        except Exception as e:
+            error = e
+        else:
+            # job's status is touched only after its thread is finished
+            while thread.is_alive():
+                thread.join(self.job_queue.lease_seconds / 3)
+                if thread.is_alive() and not self._renew_lease(job):
+                    # the job was claimed by another worker, this run is stopped without touching job's status
+                    if self.show_logs:
+                        print(f" * #WARNING: worker '{self.worker_id}' lost the lease of job '{job['jobId']}'")
+                    for status_updater in status_updaters:
+                        status_updater.detach()
+                    thread.join()
+                    return
+            error = thread.exception
+        if error is not None:
+            self.job_queue.fail(job['_id'], self.worker_id)
+            self._report_error(job, f"There was an error with the job: {str(error)}")
+        else:
+            self.job_queue.complete(job['_id'], self.worker_id)
+
+    def run_pending(self) -> int:
+        """
+        Runs queued jobs one by one, until there is no job to claim.
+        :returns: number of jobs run
+        """
+        count = 0
+        while not self._stopped:
+            job = self.job_queue.claim(self.worker_id)
+            if job is None:
+                break
+            self.run_job(job)
+            count += 1
+        return count
+
+    @background_task
+    def run_pending_in_background(self):
+        """
+        run_pending in a thread, used when jobs are run by the app itself
+        """
+        self.run_pending()
+
+    def run_forever(self, poll_interval: float = 1.):
+        """
+        Runs queued jobs, polling the queue every `poll_interval` seconds when it's empty.
+        """
+        if self.show_logs:
+            print(f" * #INFO: worker '{self.worker_id}' started")
+        while not self._stopped:
+            try:
+                ran = self.run_pending()
+            except Exception as e:
+                # eg. database is unavailable
+                print(f" * #WARNING: worker '{self.worker_id}': {str(e)}")
+                ran = 0
+            if not ran:
+                time.sleep(poll_interval)
+
+    def stop(self):
+        """
+        Stops run_forever after the current job is finished.
+        """
+        self._stopped = True
+
+
+def _load_config(name: str):
+    module, cls = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), cls)
+
+
+def _run_worker(config_name: str, poll_interval: float):
+    config = _load_config(config_name)
+    configure_clients(max_pool_size=config.DATABASE_POOL_SIZE,
+                      server_selection_timeout_ms=config.DATABASE_TIMEOUT_MS,
+                      connect_timeout_ms=config.DATABASE_TIMEOUT_MS)
+    try:
+        config.SAMPLE_MANAGER.check_samples_format()
+        worker = JobWorker(config.JOB_QUEUE, config.ALGORITHM_MANAGER, config.SAMPLE_MANAGER)
+        signal.signal(signal.SIGTERM, lambda *args: worker.stop())
+        worker.run_forever(poll_interval)
+    finally:
+        close_clients()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs workers of training and testing jobs.")
+    parser.add_argument('--config', default='config.ProductionConfig', help="config class used by the app")
+    parser.add_argument('--processes', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--poll-interval', type=float, default=1., help="seconds between polls of empty queue")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        _run_worker(args.config, args.poll_interval)
+        return
+
+    from multiprocessing import Process
+    processes = [
+        Process(target=_run_worker, args=(args.config, args.poll_interval))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
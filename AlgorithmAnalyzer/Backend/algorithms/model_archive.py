@@ -0,0 +1,135 @@
+import json
+import mmap
+import os
+import struct
+import uuid
+from typing import Dict, List, Tuple
+
+''''''''''''''''
+layout of an archive file
+
+    b'GBMODELS'                                         // magic
+    <files of all models, one after another>
+    <index>                                             // utf-8 json, see below
+    <offset of index: uint64 little-endian>
+    <length of index: uint64 little-endian>
+    b'GBMODELS'
+
+index:
+{
+    "5f4dcc3b5aa765d61d8327deb882cf99": {               // key, eg. name of user's model directory
+        "meta": {"user": "john", "version": "..."},     // anything given when packing
+        "files": {"model.h5": [8, 1024]}                // path relative to model's directory: [offset, size]
+    }
+}
+'''''''''''''''
+
+MAGIC = b'GBMODELS'
+_FOOTER = struct.Struct('<QQ')
+
+
+class ModelArchive:
+    """
+    Read-only archive of many models' files packed into a single file with an offset index,
+    so all models of an algorithm can be loaded with one sequential read instead of
+    opening hundreds of small files. The archive is read through mmap.
+    Archives are created with ModelArchive.pack, they're replaced atomically,
+    so an archive which is being read is never modified.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: str - path of the archive
+        :raises ValueError: if the file isn't a valid archive
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._index = self._read_index()
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _read_index(self) -> dict:
+        size = len(self._mmap)
+        footer_start = size - _FOOTER.size - len(MAGIC)
+        if footer_start < len(MAGIC) or self._mmap[:len(MAGIC)] != MAGIC or self._mmap[-len(MAGIC):] != MAGIC:
+            raise ValueError(f"'{self.path}' is not a model archive")
+        offset, length = _FOOTER.unpack(self._mmap[footer_start:footer_start + _FOOTER.size])
+        if offset + length != footer_start:
+            raise ValueError(f"'{self.path}' is corrupted")
+        return json.loads(self._mmap[offset:offset + length].decode('utf-8'))
+
+    @staticmethod
+    def pack(path: str, entries: Dict[str, Tuple[str, dict]]):
+        """
+        Packs files of models into a new archive, which replaces the archive at `path`.
+        :param path: str - path of the archive
+        :param entries: dict - {key: (model's directory, meta)}, all files in model's directory
+        are packed, meta is a json-serializable dict stored in the index
+        """
+        index = {}
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as archive:
+                archive.write(MAGIC)
+                for key, (directory, meta) in entries.items():
+                    files = {}
+                    for root, _, names in os.walk(directory):
+                        for name in sorted(names):
+                            file_path = os.path.join(root, name)
+                            with open(file_path, 'rb') as f:
+                                data = f.read()
+                            files[os.path.relpath(file_path, directory)] = [archive.tell(), len(data)]
+                            archive.write(data)
+                    index[key] = {'meta': meta, 'files': files}
+                index_offset = archive.tell()
+                encoded = json.dumps(index).encode('utf-8')
+                archive.write(encoded)
+                archive.write(_FOOTER.pack(index_offset, len(encoded)))
+                archive.write(MAGIC)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def keys(self) -> List[str]:
+        """
+        Returns keys of packed models, in order of their position in the archive.
+        """
+        return sorted(self._index, key=self.get_offset)
+
+    def get_meta(self, key: str) -> dict:
+        return self._index[key]['meta']
+
+    def get_offset(self, key: str) -> int:
+        """
+        Returns the position of model's first file in the archive, reading models
+        sorted by their offsets reads the archive sequentially.
+        """
+        files = self._index[key]['files']
+        return min((offset for offset, _ in files.values()), default=0)
+
+    def read(self, key: str) -> Dict[str, bytes]:
+        """
+        Returns files of a packed model.
+        :returns: dict - {path relative to model's directory: file's bytes}
+        """
+        return {
+            name: self._mmap[offset:offset + size]
+            for name, (offset, size) in self._index[key]['files'].items()
+        }
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
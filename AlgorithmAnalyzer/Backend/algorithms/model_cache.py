@@ -0,0 +1,125 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, Tuple
+
+
+class ModelCache:
+    """
+    Process-wide LRU cache of loaded models, so predictions don't
+    deserialize a model on every request.
+    Each entry remembers the version of model files it was loaded from
+    (given by ModelStore or the newest modification time of the files), so a model
+    saved again by a training job is loaded again on next use.
+    Least recently used models are evicted when there are more than
+    `max_entries` of them or their files take more than `max_bytes`.
+    """
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 1024 ** 3):
+        """
+        :param max_entries: int - maximal number of cached models
+        :param max_bytes: int - maximal total size of cached models' files
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (model, version, size)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get_or_load(self, key: Hashable, path: str, load: Callable[[], object], version: str = None):
+        """
+        get cached model, or load it if it is missing or outdated
+        :param key: key of the model, eg. (algorithm name, username)
+        :param path: str - directory containing model's files
+        :param load: function loading the model
+        :param version: str - version of the model, if not given it's computed
+        from modification times of model's files
+        """
+        size = None
+        if version is None:
+            version, size = self._get_version(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] == version:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        # loading can take a while, other models can be used in the meantime
+        model = load()
+        if size is None:
+            size = self._get_size(path)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (model, version, size)
+            self._size += size
+            self._evict()
+        return model
+
+    def get(self, key: Hashable, version: str):
+        """
+        get cached model without loading it
+        :returns: the model, or None if it is missing or its version is not `version`
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] == version:
+                self._entries.move_to_end(key)
+                return entry[0]
+            return None
+
+    def invalidate(self, key: Hashable):
+        """
+        remove model from the cache, eg. after it was trained again
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry[2]
+
+    def _evict(self):
+        # the newest entry is kept even if it is too big
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+    @staticmethod
+    def _get_size(path: str) -> int:
+        """
+        :returns: total size of files in model's directory
+        """
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, files in os.walk(path) for name in files
+        )
+
+    @staticmethod
+    def _get_version(path: str) -> Tuple[int, int]:
+        """
+        :returns: the newest modification time of model's directory and files in it,
+                  total size of those files
+        """
+        version = os.stat(path).st_mtime_ns
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                version = max(version, stat.st_mtime_ns)
+                size += stat.st_size
+        return version, size
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+''''''''''''''''
+layout of a model's directory (eg. saved_models/<algorithm>/<md5 of username>)
+
+    CURRENT                     // name of the current version
+    versions/
+        1544212345123456-1a2b3c/
+            manifest.json       // {"version": ..., "timestamp": ..., "parameters": {...}, "fingerprint": ...,
+                                //  "preprocessing": {...}}
+            model               // path passed to algorithm's save / __init__
+        1544298745654321-4d5e6f/
+            ...
+'''''''''''''''
+
+CURRENT_FILE = 'CURRENT'
+VERSIONS_DIR = 'versions'
+MANIFEST_FILE = 'manifest.json'
+MODEL_FILE = 'model'
+
+
+class ModelStore:
+    """
+    Versioned storage of saved models.
+    Each save writes the model to a new version directory, with a manifest describing it,
+    and then atomically replaces the CURRENT pointer, so readers never see a half-written model
+    and don't need any locks. Versions older than the newest `keep_versions` ones are removed.
+    Directories saved before models were versioned (with the model directly in them)
+    are still readable, as a model without version.
+    """
+
+    def __init__(self, keep_versions: int = 2):
+        """
+        :param keep_versions: int - number of versions kept in model's directory, at least 2,
+        so a model which is being loaded while a new version is saved isn't removed
+        """
+        self.keep_versions = max(keep_versions, 2)
+
+    def save(self, model, path: str, parameters: dict = None, fingerprint: str = None,
+             preprocessing: dict = None) -> str:
+        """
+        Saves the model as a new version and makes it the current one.
+        :param model: model with algorithm's save method
+        :param path: str - model's directory
+        :param parameters: dict - parameters of the model, stored in the manifest
+        :param fingerprint: str - fingerprint of model's training data, stored in the manifest
+        :param preprocessing: dict - settings of samples' preprocessing used by the model, stored in the manifest
+        :returns: the new version
+        """
+        version = f'{int(time.time() * 1e6):016d}-{uuid.uuid4().hex[:6]}'
+        version_path = os.path.join(path, VERSIONS_DIR, version)
+        Path(version_path).mkdir(parents=True)
+        try:
+            model.save(os.path.join(version_path, MODEL_FILE))
+            manifest = {
+                'version': version,
+                'timestamp': datetime.utcnow().isoformat(),
+                'parameters': parameters,
+                'fingerprint': fingerprint,
+                'preprocessing': preprocessing
+            }
+            with open(os.path.join(version_path, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, default=str)
+        except BaseException:
+            shutil.rmtree(version_path, ignore_errors=True)
+            raise
+
+        # os.replace is atomic, readers see either the old or the new version
+        tmp_path = os.path.join(path, f'{CURRENT_FILE}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(path, CURRENT_FILE))
+
+        self.collect_garbage(path)
+        return version
+
+    def get_version(self, path: str) -> str:
+        """
+        Returns the current version of the model saved in directory `path`,
+        or None if it has no versions.
+        """
+        try:
+            with open(os.path.join(path, CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def get_version_path(self, path: str, version: str = None) -> str:
+        """
+        Returns the directory of model's version, `path` itself if version is None.
+        """
+        if version is None:
+            return path
+        return os.path.join(path, VERSIONS_DIR, version)
+
+    def get_model_path(self, path: str, version: str = None) -> str:
+        """
+        Returns the path of model's version, which should be passed to algorithm's __init__.
+        """
+        return os.path.join(self.get_version_path(path, version), MODEL_FILE)
+
+    def read_manifest(self, path: str) -> dict:
+        """
+        Returns the manifest of the current version of the model, or None if there is none.
+        """
+        version = self.get_version(path)
+        if version is None:
+            return None
+        try:
+            with open(os.path.join(self.get_version_path(path, version), MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def collect_garbage(self, path: str):
+        """
+        Removes versions of the model older than the newest `keep_versions` ones,
+        the current version is never removed.
+        """
+        versions_path = os.path.join(path, VERSIONS_DIR)
+        try:
+            versions = sorted(os.listdir(versions_path), reverse=True)
+        except OSError:
+            return
+        current = self.get_version(path)
+        for version in versions[self.keep_versions:]:
+            if version != current:
+                # files can't be removed while open on some systems, they'll be removed later
+                shutil.rmtree(os.path.join(versions_path, version), ignore_errors=True)
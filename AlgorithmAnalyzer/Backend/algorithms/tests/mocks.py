@@ -1,3 +1,5 @@
+import time
+
 from algorithms.base_algorithm import Algorithm, AlgorithmException
 
 
@@ -7,6 +9,7 @@ class BaseAlgorithmMock(Algorithm):
         self.called_train = False
         self.called_load = False
         self.save_path = None
+        self.batch_sizes = []
 
         if parameters:
             self.parameters = parameters
@@ -20,6 +23,10 @@ class BaseAlgorithmMock(Algorithm):
     def train(self, samples, labels):
         self.called_train = True
 
+    def predict_batch(self, samples):
+        self.batch_sizes.append(len(samples))
+        return super().predict_batch(samples)
+
 
 class AlgorithmMock1(BaseAlgorithmMock):
     """A docstring."""
@@ -98,6 +105,73 @@ class RaisingAlgorithmExceptionMock(BaseAlgorithmMock):
         self.su = updater
 
 
+class PartlyFailingMock(AlgorithmMock1):
+    """Fails to train on samples containing 'fail'."""
+
+    def train(self, samples, labels):
+        super().train(samples, labels)
+        if 'fail' in samples:
+            raise AlgorithmException('train exception')
+
+
+class PreprocessingMock(AlgorithmMock1):
+    """Marks samples as preprocessed before training, fails to preprocess samples containing 'fail'."""
+
+    @classmethod
+    def preprocess_samples(cls, samples, labels):
+        if 'fail' in samples:
+            raise AlgorithmException('preprocess exception')
+        return ['preprocessed'] + samples, [0] + labels
+
+    def train(self, samples, labels):
+        super().train(samples, labels)
+        if samples[:1] != ['preprocessed']:
+            raise AlgorithmException('samples were not preprocessed')
+
+
+class PackingMock(AlgorithmMock1):
+    """Saves the model to a file, can be loaded from an archive of models."""
+
+    packed_files = None
+
+    def save(self, path):
+        super().save(path)
+        with open(path, 'w') as f:
+            f.write('saved model')
+
+    @classmethod
+    def load_packed(cls, files):
+        model = cls()
+        model.packed_files = files
+        return model
+
+
+class CrashingMock(AlgorithmMock2):
+    """Crashes with an unexpected error while training."""
+
+    def train(self, samples, labels):
+        super().train(samples, labels)
+        raise ValueError('unexpected error')
+
+
+class WaitingMock(AlgorithmMock2):
+    """Trains until the job is cancelled (at most 5 seconds)."""
+
+    stopped = False
+
+    def set_status_updater(self, updater):
+        self.su = updater
+
+    def train(self, samples, labels):
+        super().train(samples, labels)
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if self.su.is_cancelled():
+                WaitingMock.stopped = True
+                return
+            time.sleep(.01)
+
+
 TEST_ALG_DICT = {
     'first_mock': AlgorithmMock1,
     'second_mock': AlgorithmMock2,
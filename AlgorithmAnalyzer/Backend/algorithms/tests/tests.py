@@ -1,14 +1,37 @@
 import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
 import unittest
+import wave
+from datetime import datetime, timedelta
+from unittest import mock
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
+
 from algorithms.algorithm_manager import (
     algorithm_manager_factory,
     NotTrainedException
 )
+from algorithms.algorithms.mfcc_nearest_mean import MfccNearestMean
+from algorithms.algorithms.preprocessing import fast_wav_read, read_features, read_sample, read_samples
+from algorithms.background import DatabaseException, StatusUpdater, JOB_CANCELLED_MESSAGE
 from algorithms.base_algorithm import AlgorithmException
-from algorithms.tests.mocks import TEST_ALG_DICT, AlgorithmMock1
+from algorithms.executor import ManagedExecutor
+from algorithms.job_queue import JobQueue
+from algorithms.job_worker import JobWorker
+from algorithms.model_archive import ModelArchive
+from algorithms.model_cache import ModelCache
+from algorithms.model_store import ModelStore
+from algorithms.tests.mocks import (
+    TEST_ALG_DICT, AlgorithmMock1, CrashingMock, PackingMock, PartlyFailingMock, PreprocessingMock, WaitingMock
+)
 from config import TestingConfig
+from features import NFFT, logfbank, mfcc
 
 
 class TestAlgorithmManager(unittest.TestCase):
@@ -39,11 +62,7 @@ class TestAlgorithmManager(unittest.TestCase):
 
     def tearDown(self):
         for alg_name in self.alg_list:
-            path = Path('./algorithms/saved_models/' + alg_name)
-            for subpath in path.rglob('*'):
-                subpath.rmdir()
-            if path.exists():
-                path.rmdir()
+            shutil.rmtree('./algorithms/saved_models/' + alg_name, ignore_errors=True)
 
     def test_get_algorithms(self):
         self.assertEqual(self.am.get_algorithms(), self.full_alg_list)
@@ -100,7 +119,8 @@ class TestAlgorithmManager(unittest.TestCase):
             md5 = hashlib.md5(usr.encode('utf-8'))
             base_path = f'./algorithms/saved_models/first_mock/'
             base_path += md5.hexdigest()
-            self.assertEqual(mdl.save_path, base_path + '/model')
+            version = am.model_store.get_version(base_path)
+            self.assertEqual(mdl.save_path, f'{base_path}/versions/{version}/model')
             self.assertTrue(Path(base_path).exists())
 
     def test_save_models(self):
@@ -119,7 +139,8 @@ class TestAlgorithmManager(unittest.TestCase):
             md5 = hashlib.md5(usrs[i].encode('utf-8'))
             base_path = f'./algorithms/saved_models/first_mock/'
             base_path += md5.hexdigest()
-            self.assertEqual(mdls[i].save_path, base_path + '/model')
+            version = am.model_store.get_version(base_path)
+            self.assertEqual(mdls[i].save_path, f'{base_path}/versions/{version}/model')
             self.assertTrue(Path(base_path).exists())
 
     def test_load_model_should_raise_without_model(self):
@@ -252,7 +273,8 @@ class TestAlgorithmManager(unittest.TestCase):
             md5 = hashlib.md5(usr.encode('utf-8'))
             base_path = f'./algorithms/saved_models/first_mock/'
             base_path += md5.hexdigest()
-            self.assertEqual(mdl.save_path, base_path + '/model')
+            version = am.model_store.get_version(base_path)
+            self.assertEqual(mdl.save_path, f'{base_path}/versions/{version}/model')
             self.assertTrue(Path(base_path).exists())
 
     def test_test_models(self):
@@ -306,7 +328,7 @@ class TestAlgorithmManager(unittest.TestCase):
         )
         expected = {
                 'users': users,
-                'matrix': [[0, 0, 0, 1], [0, 0, 0, 1]]
+                'matrix': [[0, 0, 1], [0, 0, 1]]
         }
         self.assertEqual(res, expected)
 
@@ -362,6 +384,171 @@ class TestAlgorithmManager(unittest.TestCase):
         }
         self.assertEqual(res, expected)
 
+    def test_run_test_job(self):
+        am = self.am('second_mock')
+        am.train(self.samples, self.labels, self.params2, self.jsp.create_job_status()).join()
+        users = ['u0', 'u1', 'u2']
+        jid = self.jsp.create_job_status()
+        am.run_test_job(self.samples, self.labels, users, list(range(len(users))), jid).join()
+        status = self.jsp.read_job_status(jid)
+        self.assertTrue(status['finished'])
+        self.assertIsNone(status['error'])
+        self.assertEqual(status['result'], {
+                'users': users,
+                'matrix': [[2, 0, 0, 0], [1, 0, 0, 0], [1, 0, 0, 0]]
+        })
+
+    def test_check_trained(self):
+        for alg in self.alg_list:
+            with self.assertRaises(NotTrainedException):
+                self.am(alg).check_trained(['user1'])
+        am = self.am('first_mock')
+        am.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+        am.check_trained(['user1', 'user2'])
+        with self.assertRaises(NotTrainedException):
+            am.check_trained(['user1', 'user3'])
+        # models should only be checked, not loaded
+        am = self.am('first_mock')
+        am.check_trained(['user1', 'user2'])
+        self.assertEqual(am.models, {})
+
+    def test_pack_models(self):
+        manager = algorithm_manager_factory(
+            {'packing_mock': PackingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+            '__test__alg__manager', use_model_archive=True
+        )
+        try:
+            am = manager('packing_mock')
+            am.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+            self.assertTrue(Path('./algorithms/saved_models/packing_mock/models.pack').exists())
+
+            am = manager('packing_mock')
+            am._load_models(['user1', 'user2'])
+            for user in ['user1', 'user2']:
+                self.assertFalse(am.models[user].called_load)
+                self.assertEqual(am.models[user].packed_files['model'], b'saved model')
+
+            # a model saved after packing is loaded from its directory
+            am.model_store.save(PackingMock(), am._get_model_path('user1'))
+            am = manager('packing_mock')
+            am._load_models(['user1', 'user2'])
+            self.assertTrue(am.models['user1'].called_load)
+            self.assertIsNone(am.models['user1'].packed_files)
+
+            manager.model_cache.clear()
+            self.assertEqual(manager('packing_mock').preload_models(), 2)
+            self.assertIn(('packing_mock', 'user1'), manager.model_cache)
+            self.assertIn(('packing_mock', 'user2'), manager.model_cache)
+        finally:
+            shutil.rmtree('./algorithms/saved_models/packing_mock', ignore_errors=True)
+
+    def test_incremental_training(self):
+        am = self.am('first_mock')
+        am.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+        for usr in self.user_labels:
+            manifest = am.model_store.read_manifest(am._get_model_path(usr))
+            self.assertIsNotNone(manifest['fingerprint'])
+            self.assertEqual(manifest['parameters'], {'some_name': 2})
+
+        # nothing changed, no model is trained
+        am = self.am('first_mock')
+        jid = self.jsp.create_job_status()
+        am.train(self.user_samples, self.user_labels, self.params1, jid, incremental=True).join()
+        self.assertEqual(am.models, {})
+        status = self.jsp.read_job_status(jid)
+        self.assertTrue(status['finished'])
+        self.assertEqual(status['progress'], 1)
+        self.assertIsNone(status['error'])
+
+        # only models of users with changed samples or labels are trained
+        samples = dict(self.user_samples, user1=[0, 1, 2, 3])
+        labels = dict(self.user_labels, user1=[0, 1, 1, 0])
+        am.train(samples, labels, self.params1, self.jsp.create_job_status(), incremental=True).join()
+        self.assertEqual(list(am.models), ['user1'])
+        labels = dict(labels, user2=[1, 1, 1])
+        am = self.am('first_mock')
+        am.train(samples, labels, self.params1, self.jsp.create_job_status(), incremental=True).join()
+        self.assertEqual(list(am.models), ['user2'])
+
+        # all models are trained with other parameters or without incremental
+        for params, incremental in (({'some_name': '3'}, True), (self.params1, False)):
+            am = self.am('first_mock')
+            am.train(samples, labels, dict(params), self.jsp.create_job_status(), incremental=incremental).join()
+            self.assertEqual(set(am.models), set(self.user_labels))
+
+        # all models are trained with other preprocessing settings
+        with mock.patch.object(AlgorithmMock1, 'get_preprocessing', return_value={'trim_silence': True}):
+            am = self.am('first_mock')
+            am.train(samples, labels, self.params1, self.jsp.create_job_status(), incremental=True).join()
+            self.assertEqual(set(am.models), set(self.user_labels))
+
+    def test_models_with_other_preprocessing_are_rejected(self):
+        am = self.am('first_mock')
+        with mock.patch.object(AlgorithmMock1, 'get_preprocessing', return_value={'decoder': 1}):
+            am.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+            manifest = am.model_store.read_manifest(am._get_model_path('user1'))
+            self.assertEqual(manifest['preprocessing'], {'decoder': 1})
+            am.check_trained(['user1'])
+
+        # models trained before preprocessing changed have to be trained again
+        with mock.patch.object(AlgorithmMock1, 'get_preprocessing', return_value={'decoder': 2}):
+            am = self.am('first_mock')
+            with self.assertRaises(NotTrainedException) as ctx:
+                am.check_trained(['user1'])
+            self.assertEqual(
+                str(ctx.exception),
+                "The model of first_mock for user1 was trained with other preprocessing settings, "
+                "it has to be trained again."
+            )
+            with self.assertRaises(NotTrainedException):
+                am.predict('user1', 'whatever')
+
+    def test_incremental_training_multilabel(self):
+        am = self.am('second_mock')
+        am.train(self.samples, self.labels, self.params2, self.jsp.create_job_status()).join()
+        self.assertIsNotNone(am.model_store.read_manifest('./algorithms/saved_models/second_mock')['fingerprint'])
+
+        am = self.am('second_mock')
+        jid = self.jsp.create_job_status()
+        am.train(self.samples, self.labels, self.params2, jid, incremental=True).join()
+        self.assertFalse(hasattr(am, 'model'))
+        self.assertEqual(self.jsp.read_job_status(jid)['progress'], 1)
+
+        am.train(self.samples + [5], self.labels + [1], self.params2, self.jsp.create_job_status(),
+                 incremental=True).join()
+        self.assertTrue(am.model.called_train)
+
+    def test_cancelled_jobs_stop(self):
+        for executor in (None, ManagedExecutor(workers=2)):
+            am = algorithm_manager_factory(
+                TEST_ALG_DICT, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+                '__test__alg__manager', executor=executor
+            )
+            try:
+                for alg, samples, labels, params in (
+                        ('first_mock', self.user_samples, self.user_labels, self.params1),
+                        ('second_mock', self.samples, self.labels, self.params2)):
+                    jid = self.jsp.create_job_status()
+                    self.jsp.cancel_job(jid, finish=False)
+                    am(alg).train(samples, labels, params, jid).join()
+                    status = self.jsp.read_job_status(jid)
+                    self.assertTrue(status['finished'])
+                    self.assertEqual(status['error'], JOB_CANCELLED_MESSAGE)
+                    # no model should be saved
+                    self.assertFalse(Path('./algorithms/saved_models/' + alg).exists())
+            finally:
+                am.executor.shutdown()
+
+    def test_cancelled_test_job_stops(self):
+        am = self.am('second_mock')
+        am.train(self.samples, self.labels, self.params2, self.jsp.create_job_status()).join()
+        jid = self.jsp.create_job_status()
+        self.jsp.cancel_job(jid, finish=False)
+        am.run_test_job(self.samples, self.labels, ['u0', 'u1', 'u2'], [0, 1, 2], jid).join()
+        status = self.jsp.read_job_status(jid)
+        self.assertEqual(status['error'], JOB_CANCELLED_MESSAGE)
+        self.assertNotIn('result', status)
+
     def test_train_with_raise_mock(self):
         am = self.am(self.raise_alg)
         jid = self.jsp.create_job_status()
@@ -381,3 +568,796 @@ class TestAlgorithmManager(unittest.TestCase):
         with self.assertRaises(AlgorithmException) as ctx:
             am._load_multilabel_model()
         self.assertEqual(str(ctx.exception), 'load exception')
+
+    def test_predict_uses_model_cache(self):
+        am = self.am('first_mock')
+        jid = self.jsp.create_job_status()
+        am.train(self.user_samples, self.user_labels, self.params1, jid).join()
+        user, sample = 'user1', 'whatever'
+        am.predict(user, sample)
+        cached = am.models[user]
+        # new manager should use the model loaded before
+        am = self.am('first_mock')
+        am.predict(user, sample)
+        self.assertIs(am.models[user], cached)
+
+        # model should be loaded again after it was trained again
+        jid = self.jsp.create_job_status()
+        am.train(self.user_samples, self.user_labels, self.params1, jid).join()
+        am = self.am('first_mock')
+        am.predict(user, sample)
+        self.assertIsNot(am.models[user], cached)
+        self.assertTrue(am.models[user].called_load)
+
+    def test_train_and_test_in_worker_processes(self):
+        am = algorithm_manager_factory(
+            TEST_ALG_DICT, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+            '__test__alg__manager', executor=ManagedExecutor(workers=2)
+        )('first_mock')
+        try:
+            jid = self.jsp.create_job_status()
+            am.train(self.user_samples, self.user_labels, self.params1, jid).join()
+            status = self.jsp.read_job_status(jid)
+            self.assertTrue(status['finished'])
+            self.assertIsNone(status['error'])
+            # models are saved by workers and not sent back
+            self.assertEqual(am.models, {})
+            for usr in self.user_labels:
+                md5 = hashlib.md5(usr.encode('utf-8'))
+                self.assertTrue(Path('./algorithms/saved_models/first_mock/' + md5.hexdigest()).exists())
+
+            users = list(self.user_samples.keys())
+            res = am.test(self.user_samples, self.user_labels, users, range(len(users)))
+            expected = [
+                [u, i, self.user_labels[u][i], False]
+                for u in users for i in range(len(self.user_labels[u]))
+            ]
+            self.assertEqual(res, expected)
+        finally:
+            am.executor.shutdown()
+
+    def test_test_in_worker_processes_uses_cached_models(self):
+        manager = algorithm_manager_factory(
+            {'packing_mock': PackingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+            '__test__alg__manager', use_model_archive=True, executor=ManagedExecutor(workers=2)
+        )
+        try:
+            am = manager('packing_mock')
+            am.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+            users = list(self.user_samples.keys())
+            expected = [
+                [u, i, self.user_labels[u][i], False]
+                for u in users for i in range(len(self.user_labels[u]))
+            ]
+
+            # models are loaded by workers, not in this process
+            manager.model_cache.clear()
+            am = manager('packing_mock')
+            self.assertEqual(am.test(self.user_samples, self.user_labels, users, range(len(users))), expected)
+            self.assertEqual(am.models, {})
+            self.assertEqual(len(manager.model_cache), 0)
+
+            # models already loaded in this process are used without sending samples to workers
+            self.assertEqual(manager('packing_mock').preload_models(), 2)
+            am = manager('packing_mock')
+            self.assertEqual(am.test(self.user_samples, self.user_labels, users, range(len(users))), expected)
+            for user in users:
+                model = am._get_cached_model(user)
+                self.assertEqual(model.batch_sizes, [len(self.user_samples[user])])
+        finally:
+            manager.executor.shutdown()
+            shutil.rmtree('./algorithms/saved_models/packing_mock', ignore_errors=True)
+
+    def test_test_predicts_in_batches(self):
+        am = algorithm_manager_factory(
+            TEST_ALG_DICT, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+            '__test__alg__manager', prediction_batch_size=2
+        )
+        users = list(self.user_samples.keys())
+        binary = am('first_mock')
+        binary.train(self.user_samples, self.user_labels, self.params1, self.jsp.create_job_status()).join()
+        res = binary.test(self.user_samples, self.user_labels, users, range(len(users)))
+        self.assertEqual([pred for *_, pred in res], [False] * 6)
+        for user in users:
+            self.assertEqual(binary.models[user].batch_sizes, [2, 1])
+
+        multilabel = am('second_mock')
+        multilabel.train(self.samples, self.labels, self.params2, self.jsp.create_job_status()).join()
+        res = multilabel.test(self.samples, self.labels, ['u0', 'u1', 'u2'], [0, 1, 2])
+        self.assertEqual(res['matrix'], [[2, 0, 0, 0], [1, 0, 0, 0], [1, 0, 0, 0]])
+        self.assertEqual(multilabel.model.batch_sizes, [2, 2])
+
+    def test_train_models_reports_failed_users(self):
+        samples = dict(self.user_samples, bad_user=['fail'], other_bad_user=[1, 'fail'])
+        labels = dict(self.user_labels, bad_user=[1], other_bad_user=[0, 1])
+        for executor in (None, ManagedExecutor(workers=2)):
+            am = algorithm_manager_factory(
+                {'partly_failing_mock': PartlyFailingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+                '__test__alg__manager', executor=executor, training_concurrency=1
+            )('partly_failing_mock')
+            try:
+                jid = self.jsp.create_job_status()
+                am.train(samples, labels, self.params1, jid).join()
+                status = self.jsp.read_job_status(jid)
+                self.assertTrue(status['finished'])
+                self.assertEqual(status['progress'], 1)
+                self.assertTrue(status['error'].startswith(
+                    "There was an error with the algorithm for 2 of 4 users: "))
+                self.assertIn("bad_user (train exception)", status['error'])
+                self.assertIn("other_bad_user (train exception)", status['error'])
+                # models of other users should be trained anyway
+                for usr in samples:
+                    md5 = hashlib.md5(usr.encode('utf-8'))
+                    path = Path('./algorithms/saved_models/partly_failing_mock/' + md5.hexdigest())
+                    self.assertEqual(path.exists(), usr in self.user_samples)
+            finally:
+                am.executor.shutdown()
+                shutil.rmtree('./algorithms/saved_models/partly_failing_mock', ignore_errors=True)
+
+    def test_train_models_preprocesses_samples(self):
+        samples = dict(self.user_samples, bad_user=['fail'])
+        labels = dict(self.user_labels, bad_user=[1])
+        # samples are preprocessed by the job's process, before they're sent to workers
+        for executor in (None, ManagedExecutor(workers=2)):
+            am = algorithm_manager_factory(
+                {'preprocessing_mock': PreprocessingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY,
+                '__test__alg__manager', executor=executor
+            )('preprocessing_mock')
+            try:
+                jid = self.jsp.create_job_status()
+                am.train(samples, labels, self.params1, jid).join()
+                status = self.jsp.read_job_status(jid)
+                self.assertTrue(status['finished'])
+                self.assertEqual(status['error'], "There was an error with the algorithm for 1 of 3 users: "
+                                                  "bad_user (preprocess exception)")
+            finally:
+                am.executor.shutdown()
+                shutil.rmtree('./algorithms/saved_models/preprocessing_mock', ignore_errors=True)
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir, str(i))
+            os.mkdir(path)
+            with open(os.path.join(path, 'model'), 'wb') as f:
+                f.write(b'0' * 100)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_or_load(self):
+        cache = ModelCache()
+        model = cache.get_or_load('a', self.paths[0], lambda: object())
+        self.assertIs(cache.get_or_load('a', self.paths[0], lambda: object()), model)
+
+    def test_reload_after_model_files_changed(self):
+        cache = ModelCache()
+        model = cache.get_or_load('a', self.paths[0], lambda: object())
+        stat = os.stat(os.path.join(self.paths[0], 'model'))
+        os.utime(os.path.join(self.paths[0], 'model'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(cache.get_or_load('a', self.paths[0], lambda: object()), model)
+
+    def test_evict_least_recently_used(self):
+        cache = ModelCache(max_entries=2)
+        cache.get_or_load('a', self.paths[0], lambda: object())
+        cache.get_or_load('b', self.paths[1], lambda: object())
+        cache.get_or_load('a', self.paths[0], lambda: object())
+        cache.get_or_load('c', self.paths[2], lambda: object())
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_evict_by_size(self):
+        cache = ModelCache(max_bytes=250)
+        for key, path in zip('abc', self.paths):
+            cache.get_or_load(key, path, lambda: object())
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+
+
+class TestModelStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'model_dir')
+        self.store = ModelStore(keep_versions=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save(self):
+        model = AlgorithmMock1()
+        version = self.store.save(model, self.path, {'some_name': 1}, 'abc')
+        self.assertEqual(self.store.get_version(self.path), version)
+        self.assertEqual(model.save_path, os.path.join(self.path, 'versions', version, 'model'))
+        self.assertEqual(self.store.get_model_path(self.path, version), model.save_path)
+        manifest = self.store.read_manifest(self.path)
+        self.assertEqual(manifest['version'], version)
+        self.assertEqual(manifest['parameters'], {'some_name': 1})
+        self.assertEqual(manifest['fingerprint'], 'abc')
+        self.assertIn('timestamp', manifest)
+
+    def test_new_version_replaces_current(self):
+        first = self.store.save(AlgorithmMock1(), self.path)
+        second = self.store.save(AlgorithmMock1(), self.path)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.store.get_version(self.path), second)
+        # the previous version is kept for readers which are still loading it
+        self.assertTrue(os.path.isdir(self.store.get_version_path(self.path, first)))
+
+    def test_old_versions_are_removed(self):
+        versions = [self.store.save(AlgorithmMock1(), self.path) for _ in range(4)]
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'versions'))), versions[2:])
+        self.assertEqual(sorted(os.listdir(self.path)), ['CURRENT', 'versions'])
+
+    def test_failed_save_keeps_current_version(self):
+        version = self.store.save(AlgorithmMock1(), self.path)
+        model = AlgorithmMock1()
+        model.save = lambda path: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            self.store.save(model, self.path)
+        self.assertEqual(self.store.get_version(self.path), version)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'versions')), [version])
+
+    def test_unversioned_model(self):
+        os.mkdir(self.path)
+        self.assertIsNone(self.store.get_version(self.path))
+        self.assertIsNone(self.store.read_manifest(self.path))
+        self.assertEqual(self.store.get_model_path(self.path), os.path.join(self.path, 'model'))
+
+    def test_model_cache_uses_version(self):
+        cache = ModelCache()
+        self.store.save(AlgorithmMock1(), self.path)
+        version = self.store.get_version(self.path)
+        path = self.store.get_version_path(self.path, version)
+        model = cache.get_or_load('a', path, object, version)
+        self.assertIs(cache.get_or_load('a', path, object, version), model)
+        version = self.store.save(AlgorithmMock1(), self.path)
+        path = self.store.get_version_path(self.path, version)
+        self.assertIsNot(cache.get_or_load('a', path, object, version), model)
+
+
+class TestModelArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.entries = {}
+        for key, content in (('a', b'first'), ('b', b'second model')):
+            path = os.path.join(self.tmp_dir, key)
+            os.makedirs(os.path.join(path, 'variables'))
+            with open(os.path.join(path, 'model'), 'wb') as f:
+                f.write(content)
+            with open(os.path.join(path, 'variables', 'data'), 'wb') as f:
+                f.write(content * 2)
+            self.entries[key] = (path, {'user': key.upper()})
+        self.archive_path = os.path.join(self.tmp_dir, 'models.pack')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pack_and_read(self):
+        ModelArchive.pack(self.archive_path, self.entries)
+        with ModelArchive(self.archive_path) as archive:
+            self.assertEqual(archive.keys(), ['a', 'b'])
+            self.assertLess(archive.get_offset('a'), archive.get_offset('b'))
+            self.assertIn('a', archive)
+            self.assertNotIn('c', archive)
+            self.assertEqual(archive.get_meta('b'), {'user': 'B'})
+            self.assertEqual(archive.read('b'), {
+                'model': b'second model',
+                os.path.join('variables', 'data'): b'second modelsecond model'
+            })
+
+    def test_pack_replaces_archive(self):
+        ModelArchive.pack(self.archive_path, self.entries)
+        with ModelArchive(self.archive_path) as archive:
+            ModelArchive.pack(self.archive_path, {'b': self.entries['b']})
+            # opened archive can still be read
+            self.assertEqual(archive.read('a')['model'], b'first')
+        with ModelArchive(self.archive_path) as archive:
+            self.assertEqual(archive.keys(), ['b'])
+        self.assertEqual(os.listdir(self.tmp_dir).count('models.pack'), 1)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 3)
+
+    def test_invalid_archive(self):
+        with open(self.archive_path, 'wb') as f:
+            f.write(b'not an archive at all')
+        with self.assertRaises(ValueError):
+            ModelArchive(self.archive_path)
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    @staticmethod
+    def _make_wav(frames: bytes, sample_width: int, channels: int = 1) -> BytesIO:
+        buffer = BytesIO()
+        with wave.open(buffer, 'wb') as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(sample_width)
+            wav_file.setframerate(8000)
+            wav_file.writeframes(frames)
+        buffer.seek(0)
+        return buffer
+
+    def test_fast_wav_read_sample_widths(self):
+        expected = [-1, -.5, 0, .5]
+        frames = {
+            1: bytes([0, 64, 128, 192]),
+            2: np.array([-2 ** 15, -2 ** 14, 0, 2 ** 14], dtype='<i2').tobytes(),
+            3: b''.join(v.to_bytes(3, 'little', signed=True) for v in [-2 ** 23, -2 ** 22, 0, 2 ** 22]),
+            4: np.array([-2 ** 31, -2 ** 30, 0, 2 ** 30], dtype='<i4').tobytes()
+        }
+        for sample_width, data in frames.items():
+            out = fast_wav_read(self._make_wav(data, sample_width))
+            self.assertEqual(out.dtype, np.float32)
+            self.assertEqual(out.tolist(), expected, f"wrong samples of {sample_width}-byte wav")
+
+    def test_fast_wav_read_averages_channels(self):
+        data = np.array([-2 ** 14, 2 ** 14, 2 ** 14, 2 ** 14], dtype='<i2').tobytes()
+        self.assertEqual(fast_wav_read(self._make_wav(data, 2, channels=2)).tolist(), [0, .5])
+
+    def test_read_sample_normalizes_length(self):
+        data = np.array([0, 2 ** 14, -2 ** 14, 2 ** 14], dtype='<i2').tobytes()
+        out = read_sample(self._make_wav(data, 2), normalized_length=6)
+        self.assertEqual(out.shape, (6,))
+        self.assertEqual(out.dtype, np.float32)
+        self.assertEqual(read_sample(self._make_wav(data, 2), normalized_length=2).shape, (2,))
+
+    def test_read_samples(self):
+        data = np.array([0, 2 ** 14, -2 ** 14, 2 ** 14], dtype='<i2').tobytes()
+        samples = [self._make_wav(data, 2), BytesIO(b'not a wav'), self._make_wav(data[:4], 2)]
+        X, y = read_samples(samples, [1, 2, 3], normalized_length=6)
+        self.assertEqual(X.dtype, np.float32)
+        self.assertEqual(X.shape, (2, 6))
+        self.assertEqual(y.tolist(), [1, 3])
+        samples[0].seek(0)
+        self.assertEqual(X[0].tolist(), read_sample(samples[0], normalized_length=6).tolist())
+        # padded with zeros before normalization
+        self.assertEqual(X[1, 2:].tolist(), [X[1, 0]] * 4)
+
+    def test_read_samples_to_memmap(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'samples.npy')
+            data = np.array([0, 2 ** 14, -2 ** 14, 2 ** 14], dtype='<i2').tobytes()
+            X, y = read_samples([self._make_wav(data, 2), self._make_wav(data, 2)], [0, 1],
+                                normalized_length=4, memmap_path=path)
+            self.assertIsInstance(X, np.memmap)
+            X.flush()
+            self.assertEqual(np.load(path, mmap_mode='r').tolist(), X.tolist())
+            del X
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_samples_parallel(self):
+        data = np.array([2 ** 14, -2 ** 14, 2 ** 13, 0], dtype='<i2').tobytes()
+        samples = [self._make_wav(data[:2 * (num % 4 + 1)], 2) for num in range(10)]
+        samples[3] = BytesIO(b'not a wav')
+        labels = list(range(10))
+        X, y = read_samples(samples, labels, normalized_length=6)
+        for sample in samples:
+            sample.seek(0)
+        X_parallel, y_parallel = read_samples(samples, labels, normalized_length=6, workers=3)
+        self.assertEqual(X_parallel.dtype, np.float32)
+        self.assertEqual(y_parallel.tolist(), y.tolist())
+        self.assertEqual(X_parallel.tolist(), X.tolist())
+
+        # daemonic processes (eg. workers of ManagedExecutor) can't start a pool, samples are decoded serially
+        for sample in samples:
+            sample.seek(0)
+        with mock.patch('algorithms.algorithms.preprocessing.current_process') as current_process, \
+                mock.patch('algorithms.algorithms.preprocessing.Pool', side_effect=AssertionError):
+            current_process.return_value.daemon = True
+            X_worker, y_worker = read_samples(samples, labels, normalized_length=6, workers=3)
+        self.assertEqual(y_worker.tolist(), y.tolist())
+        self.assertEqual(X_worker.tolist(), X.tolist())
+
+    def test_read_sample_trim_silence(self):
+        silence = np.zeros(8000, dtype='<i2')
+        speech = (np.sin(np.arange(8000) / 8000 * 2 * np.pi * 200) * 2 ** 14).astype('<i2')
+        data = np.concatenate([silence, speech, silence]).tobytes()
+        out = read_sample(self._make_wav(data, 2), trim_silence=True)
+        # 100ms of silence is kept on both sides
+        self.assertEqual(len(out), 8000 + 2 * 800)
+        np.testing.assert_array_equal(out[800:-800], speech / 2 ** 15)
+
+        X, y = read_samples([self._make_wav(data, 2)], [1], normalized_length=1000, trim_silence=True)
+        self.assertEqual(X[0].tolist(), read_sample(self._make_wav(data[2 * 7200:], 2), normalized_length=1000).tolist())
+
+    def test_read_features(self):
+        class StoredSample:
+            def get_features(self, feature_type, **params):
+                return (feature_type, params)
+
+        signals = [np.random.randint(-2 ** 15, 2 ** 15, size, dtype='<i2') for size in (2000, 333, 4000)]
+        samples = [self._make_wav(signal.tobytes(), 2) for signal in signals]
+        features = read_features(samples[:1] + [StoredSample()] + samples[1:])
+        self.assertEqual(features[1], ('mfcc', {'nfft': NFFT}))
+        for signal, feat in zip(signals, features[:1] + features[2:]):
+            np.testing.assert_allclose(feat, mfcc(signal, 8000, nfft=NFFT))
+        for sample in samples:
+            sample.seek(0)
+        features = read_features(samples, 'logfbank', nfft=512, nfilt=20)
+        for signal, feat in zip(signals, features):
+            np.testing.assert_allclose(feat, logfbank(signal, 8000, nfft=512, nfilt=20))
+        with self.assertRaises(ValueError):
+            read_features(samples, 'normalized')
+
+    def test_read_samples_parallel_to_memmap(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'samples.npy')
+            data = np.array([0, 2 ** 14, -2 ** 14, 2 ** 14], dtype='<i2').tobytes()
+            samples = [BytesIO(b'not a wav'), self._make_wav(data, 2), self._make_wav(data[:4], 2)]
+            X, y = read_samples(samples, [0, 1, 2], normalized_length=4, memmap_path=path, workers=2)
+            self.assertEqual(y.tolist(), [1, 2])
+            samples[1].seek(0)
+            self.assertEqual(X[0].tolist(), read_sample(samples[1], normalized_length=4).tolist())
+            X.flush()
+            self.assertEqual(np.load(path, mmap_mode='r')[:2].tolist(), X.tolist())
+            del X
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestMfccNearestMean(unittest.TestCase):
+
+    @staticmethod
+    def _make_tone(frequency: float) -> BytesIO:
+        t = np.arange(8000) / 8000
+        signal = 10000 * np.sin(2 * np.pi * frequency * t) + np.random.normal(0, 100, len(t))
+        return TestPreprocessing._make_wav(signal.astype('<i2').tobytes(), 2)
+
+    def test_train_and_predict(self):
+        samples = [self._make_tone(f) for f in (300, 320, 340, 2000, 2100)]
+        model = MfccNearestMean(parameters={'coefficients': 13})
+        model.train(samples, [1, 1, 1, 0, 0])
+        predictions = model.predict_batch([self._make_tone(310), self._make_tone(2050)])
+        self.assertEqual([real for real, _ in predictions], [True, False])
+        self.assertEqual(set(predictions[0][1]), {"Distance to real samples: ", "Distance to fake samples: "})
+
+        # without fake samples, recordings far from real ones are fake
+        model = MfccNearestMean(parameters={'coefficients': 8})
+        model.train(samples[:3], [1, 1, 1])
+        self.assertEqual([real for real, _ in model.predict_batch([self._make_tone(2050)])], [False])
+        with self.assertRaises(AlgorithmException):
+            model.train(samples[3:], [0, 0])
+
+    def test_save_and_load(self):
+        samples = [self._make_tone(f) for f in (300, 320, 2000)]
+        model = MfccNearestMean(parameters={'coefficients': 13})
+        model.train(samples, [1, 1, 0])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'model')
+            model.save(path)
+            with open(path + '.json', 'rb') as f:
+                packed = MfccNearestMean.load_packed({'model.json': f.read()})
+            for loaded in (MfccNearestMean(path=path), packed):
+                samples = [self._make_tone(310), self._make_tone(2050)]
+                self.assertEqual(loaded.predict_batch(samples), model.predict_batch(samples))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestJobStatusProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.jsp = TestingConfig.JOB_STATUS_PROVIDER
+        self.jsp._jobs.delete_many({})
+
+    def tearDown(self):
+        self.jsp._jobs.delete_many({})
+
+    def test_job_with_data_is_running(self):
+        train = {'algorithm': 'first_mock', 'parameters': {'some_name': 1}}
+        test = {'algorithm': 'first_mock', 'type': 'test', 'users': ['user1']}
+        self.assertFalse(self.jsp.job_with_data_is_running(train))
+
+        train_jid = self.jsp.create_job_status(data=train)
+        test_jid = self.jsp.create_job_status(data=test)
+        self.assertEqual(self.jsp.job_with_data_is_running({'algorithm': 'first_mock'}), train_jid)
+        self.assertEqual(self.jsp.job_with_data_is_running(test), test_jid)
+        self.assertFalse(self.jsp.job_with_data_is_running(dict(test, users=['user2'])))
+        self.assertFalse(self.jsp.job_with_data_is_running({'algorithm': 'second_mock'}))
+
+        # finished and failed jobs are not running
+        self.jsp.update_job_status(train_jid, progress=1, finished=True)
+        self.jsp.update_job_status(test_jid, progress=0, error='error')
+        self.assertFalse(self.jsp.job_with_data_is_running(train))
+        self.assertFalse(self.jsp.job_with_data_is_running(test))
+
+    def test_finished_jobs_expire(self):
+        indexes = self.jsp._jobs.index_information().values()
+        self.assertIn(
+            [('finished', 1), ('error', 1), ('data.algorithm', 1)], [index['key'] for index in indexes]
+        )
+        ttl = [index for index in indexes if index['key'] == [('finishedAt', 1)]]
+        self.assertEqual(len(ttl), 1)
+        self.assertIn('expireAfterSeconds', ttl[0])
+
+        jid = self.jsp.create_job_status(data={'d': 'somedata'})
+        self.jsp.update_job_status(jid, progress=.5)
+        self.assertNotIn('finishedAt', self.jsp._jobs.find_one())
+        self.jsp.update_job_status(jid, progress=1, finished=True)
+        self.assertIn('finishedAt', self.jsp._jobs.find_one())
+        self.assertNotIn('finishedAt', self.jsp.read_job_status(jid))
+
+    def test_update_job_fields(self):
+        jid = self.jsp.create_job_status(data={'d': 'somedata'})
+        self.jsp.update_job_fields(jid, {'progress': .5})
+        self.assertEqual(
+            self.jsp.read_job_status(jid),
+            {'finished': False, 'progress': .5, 'error': None, 'data': {'d': 'somedata'}}
+        )
+        # updating nonexisting job does nothing
+        self.jsp.update_job_fields('some_nonexisting_job_id', {'progress': .5})
+
+
+class TestStatusUpdater(unittest.TestCase):
+
+    class JobStatusProviderMock:
+        def __init__(self):
+            self.writes = []
+
+        def update_job_fields(self, jid, fields):
+            self.writes.append(fields)
+
+        def is_job_cancelled(self, jid):
+            return False
+
+    def setUp(self):
+        self.jsp = self.JobStatusProviderMock()
+
+    def test_updates_are_throttled(self):
+        updater = StatusUpdater('jid', self.jsp, min_interval=60, min_progress_delta=.1)
+        for i in range(100):
+            updater.update(progress=i / 100)
+        # the first progress is equal to progress of a new job
+        updater = StatusUpdater('jid', self.jsp, min_interval=60, min_progress_delta=.1)
+        updater.update(progress=.5)
+        self.assertEqual(self.jsp.writes, [{'progress': .01}, {'progress': .5}])
+
+    def test_small_progress_changes_are_skipped(self):
+        updater = StatusUpdater('jid', self.jsp, min_interval=0, min_progress_delta=.25)
+        for i in range(1, 6):
+            updater.update(progress=i / 8)
+        self.assertEqual(self.jsp.writes, [{'progress': .125}, {'progress': .375}, {'progress': .625}])
+
+    def test_throttled_updates_are_written_later(self):
+        updater = StatusUpdater('jid', self.jsp, min_interval=60, min_progress_delta=.1)
+        updater.update(progress=.1)
+        updater.update(progress=.2)
+        updater.update(progress=.3)
+        updater.update(progress=.35)
+        self.assertEqual(self.jsp.writes, [{'progress': .1}])
+        # the latest skipped update is written with a check of cancellation after the interval
+        self.assertFalse(updater.is_cancelled())
+        self.assertEqual(len(self.jsp.writes), 1)
+        with mock.patch('algorithms.background.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertFalse(updater.is_cancelled())
+        self.assertEqual(self.jsp.writes, [{'progress': .1}, {'progress': .35}])
+
+        updater.update(progress=.4)
+        updater.flush()
+        updater.flush()
+        self.assertEqual(self.jsp.writes, [{'progress': .1}, {'progress': .35}, {'progress': .4}])
+
+    def test_is_cancelled(self):
+        jsp = TestingConfig.JOB_STATUS_PROVIDER
+        jid = jsp.create_job_status()
+        updater = StatusUpdater(jid, jsp, min_interval=60)
+        self.assertFalse(updater.is_cancelled())
+        jsp.cancel_job(jid)
+        # checked at most once per interval
+        self.assertFalse(updater.is_cancelled())
+        self.assertTrue(StatusUpdater(jid, jsp).is_cancelled())
+        # deleted jobs are cancelled too
+        jsp.delete_job_status(jid)
+        self.assertTrue(StatusUpdater(jid, jsp).is_cancelled())
+
+    def test_pickle(self):
+        jsp = TestingConfig.JOB_STATUS_PROVIDER
+        jid = jsp.create_job_status()
+        updater = pickle.loads(pickle.dumps(StatusUpdater(jid, jsp, min_interval=0)))
+        updater.update(progress=.5)
+        self.assertEqual(jsp.read_job_status(jid)['progress'], .5)
+        jsp.delete_job_status(jid)
+
+    def test_final_states_are_written(self):
+        updater = StatusUpdater('jid', self.jsp, min_interval=60, min_progress_delta=.1)
+        updater.update(progress=.5)
+        updater.update(progress=.5, error='error')
+        updater.update(progress=1, finished=True, error='error', result=[1])
+        self.assertEqual(self.jsp.writes, [
+            {'progress': .5},
+            {'error': 'error'},
+            {'progress': 1, 'finished': True, 'result': [1]}
+        ])
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = TestingConfig.JOB_QUEUE
+        self.queue._queue.delete_many({})
+
+    def tearDown(self):
+        self.queue._queue.delete_many({})
+        self.queue.concurrency = {}
+
+    def test_claim_by_priority(self):
+        self.queue.concurrency = {'a': 3}
+        self.queue.enqueue('1', 'train', 'a')
+        self.queue.enqueue('2', 'test', 'a', priority=1)
+        self.queue.enqueue('3', 'train', 'a')
+        claimed = [self.queue.claim('worker')['jobId'] for _ in range(3)]
+        self.assertEqual(claimed, ['2', '1', '3'])
+        self.assertIsNone(self.queue.claim('worker'))
+
+    def test_concurrency_limit(self):
+        self.queue.concurrency = {'b': 2}
+        for jid in '1234':
+            self.queue.enqueue(jid, 'train', 'a' if jid in '12' else 'b')
+        job = self.queue.claim('worker')
+        # only one job of 'a' can run at once
+        self.assertEqual([self.queue.claim('worker')['jobId'] for _ in range(2)], ['3', '4'])
+        self.assertIsNone(self.queue.claim('worker'))
+        self.queue.complete(job['_id'], 'worker')
+        self.assertEqual(self.queue.get_state('1'), 'done')
+        self.assertEqual(self.queue.claim('worker')['jobId'], '2')
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.enqueue('1', 'train', 'a')
+        job = self.queue.claim('dead worker')
+        self.assertTrue(self.queue.heartbeat(job['_id'], 'dead worker'))
+        self.assertIsNone(self.queue.claim('worker'))
+
+        self.queue._queue.update_one(
+            {'_id': job['_id']}, {'$set': {'leaseExpires': datetime.utcnow() - timedelta(seconds=1)}}
+        )
+        job = self.queue.claim('worker')
+        self.assertEqual((job['jobId'], job['attempts']), ('1', 2))
+        self.assertFalse(self.queue.heartbeat(job['_id'], 'dead worker'))
+
+    def test_unknown_kind(self):
+        self.assertRaises(ValueError, self.queue.enqueue, '1', 'cook', 'a')
+
+
+class TestJobWorker(unittest.TestCase):
+
+    class SampleManagerMock:
+        def __init__(self, samples, labels):
+            self.samples, self.labels = samples, labels
+
+        def get_all_samples(self, purpose, multilabel, sample_type):
+            return self.samples, self.labels
+
+    def setUp(self):
+        self.queue = TestingConfig.JOB_QUEUE
+        self.queue._queue.delete_many({})
+        self.jsp = TestingConfig.JOB_STATUS_PROVIDER
+        self.am = algorithm_manager_factory(
+            TEST_ALG_DICT, TestingConfig.JOB_STATUS_UPDATER_FACTORY, '__test__alg__manager'
+        )
+        self.samples, self.labels = [1, 2, 3, 4], [0, 1, 2, 0]
+        self.worker = JobWorker(self.queue, self.am, self.SampleManagerMock(self.samples, self.labels),
+                                show_logs=False)
+
+    def tearDown(self):
+        self.queue._queue.delete_many({})
+        shutil.rmtree('./algorithms/saved_models/second_mock', ignore_errors=True)
+
+    def test_run_train_and_test_jobs(self):
+        train_jid = self.jsp.create_job_status()
+        self.queue.enqueue(train_jid, 'train', 'second_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        self.assertEqual(self.worker.run_pending(), 1)
+        self.assertEqual(self.queue.get_state(train_jid), 'done')
+        self.assertTrue(self.jsp.read_job_status(train_jid)['finished'])
+
+        test_jid = self.jsp.create_job_status()
+        self.queue.enqueue(test_jid, 'test', 'second_mock', {'users': ['u0', 'u1', 'u2'], 'user_numbers': [0, 1, 2]})
+        self.assertEqual(self.worker.run_pending(), 1)
+        self.assertEqual(
+            self.jsp.read_job_status(test_jid)['result']['matrix'], [[2, 0, 0, 0], [1, 0, 0, 0], [1, 0, 0, 0]]
+        )
+
+    def test_failing_job(self):
+        jid = self.jsp.create_job_status()
+        # missing parameters
+        self.queue.enqueue(jid, 'train', 'second_mock', {})
+        self.worker.run_pending()
+        self.assertEqual(self.queue.get_state(jid), 'failed')
+        status = self.jsp.read_job_status(jid)
+        self.assertTrue(status['finished'])
+        self.assertTrue(status['error'].startswith('There was an error with the job: '))
+
+    def test_crashing_job(self):
+        self.worker.algorithm_manager = algorithm_manager_factory(
+            {'crashing_mock': CrashingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY, '__test__alg__manager'
+        )
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'crashing_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        self.worker.run_pending()
+        # error raised in the job's thread should fail the job
+        self.assertEqual(self.queue.get_state(jid), 'failed')
+        status = self.jsp.read_job_status(jid)
+        self.assertTrue(status['finished'])
+        self.assertEqual(status['error'], 'There was an error with the job: unexpected error')
+
+    def test_lost_lease_stops_job(self):
+        queue = JobQueue(self.queue._db_url, self.queue._db_name, show_logs=False, lease_seconds=.3)
+        worker = JobWorker(queue, algorithm_manager_factory(
+            {'waiting_mock': WaitingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY, '__test__alg__manager'
+        ), self.SampleManagerMock(self.samples, self.labels), show_logs=False)
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'waiting_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        WaitingMock.stopped = False
+        thread = worker.run_pending_in_background()
+        # the job is claimed by another worker while it's running
+        while self.queue.get_state(jid) != 'running':
+            pass
+        self.queue._queue.update_one({'jobId': jid}, {'$set': {'worker': 'other worker'}})
+        thread.join()
+        self.assertTrue(WaitingMock.stopped)
+        # job's status and queue entry now belong to the other worker
+        self.assertEqual(self.queue.get_state(jid), 'running')
+        status = self.jsp.read_job_status(jid)
+        self.assertFalse(status['finished'])
+        self.assertIsNone(status['error'])
+
+    def test_failed_heartbeat(self):
+        queue = JobQueue(self.queue._db_url, self.queue._db_name, show_logs=False, lease_seconds=.3)
+        worker = JobWorker(queue, algorithm_manager_factory(
+            {'waiting_mock': WaitingMock}, TestingConfig.JOB_STATUS_UPDATER_FACTORY, '__test__alg__manager'
+        ), self.SampleManagerMock(self.samples, self.labels), show_logs=False)
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'waiting_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        heartbeats = []
+
+        def failing_heartbeat(queue_id, worker_id):
+            heartbeats.append(self.queue.get_state(jid))
+            if len(heartbeats) == 3:
+                # the job finishes after a few failed renewals
+                self.jsp.cancel_job(jid, finish=False)
+            raise DatabaseException("database is unavailable")
+
+        with mock.patch.object(queue, 'heartbeat', side_effect=failing_heartbeat):
+            worker.run_pending()
+        # unavailable database should not fail the job while it's running
+        self.assertEqual(heartbeats[:3], ['running'] * 3)
+        self.assertEqual(self.queue.get_state(jid), 'done')
+
+    def test_cancelled_job(self):
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'second_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        self.assertEqual(self.queue.cancel(jid), 'queued')
+        self.assertEqual(self.worker.run_pending(), 0)
+        self.assertEqual(self.queue.get_state(jid), 'cancelled')
+
+        # job claimed again after its worker died
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'second_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        self.queue.claim('dead worker')
+        self.assertEqual(self.queue.cancel(jid), 'running')
+        self.jsp.cancel_job(jid, finish=False)
+        self.queue._queue.update_one({'jobId': jid}, {'$set': {'leaseExpires': datetime.utcnow()}})
+        self.worker.run_pending()
+        self.assertEqual(self.jsp.read_job_status(jid)['error'], JOB_CANCELLED_MESSAGE)
+        self.assertFalse(Path('./algorithms/saved_models/second_mock').exists())
+
+    def test_abandoned_job(self):
+        jid = self.jsp.create_job_status()
+        self.queue.enqueue(jid, 'train', 'second_mock', {'parameters': {'param1': '1', 'param2': 'c'}})
+        self.queue._queue.update_one({'jobId': jid}, {'$set': {'attempts': self.queue.max_attempts}})
+        self.worker.run_pending()
+        self.assertEqual(self.queue.get_state(jid), 'failed')
+        self.assertEqual(
+            self.jsp.read_job_status(jid)['error'],
+            f"The job was abandoned after {self.queue.max_attempts} attempts."
+        )
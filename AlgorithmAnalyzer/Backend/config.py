@@ -2,7 +2,12 @@ from algorithms.algorithm_manager import algorithm_manager_factory
 from algorithms.tests.mocks import TEST_ALG_DICT
 from algorithms.algorithms import ALG_DICT
 from algorithms.background import get_status_updater_factory, JobStatusProvider
+from algorithms.executor import ManagedExecutor
+from algorithms.job_queue import JobQueue
+from algorithms.model_cache import ModelCache
+from algorithms.model_store import ModelStore
 from sample_manager.SampleManager import SampleManager
+from utils.speech_recognition_wrapper.recognizers import OnlineSpeechRecognizer, StaticSpeechRecognizer
 
 # this file provides configs for Backend Flask's app (db settings, global singletons)
 # Configs can be loaded like this: app.config.from_object('config.YourConfig')
@@ -43,21 +48,82 @@ class BaseConfig(object):
     ALLOWED_FILES_TO_GET = {'audio': ['wav', 'webm'],
                             'json': ['json']}
 
+    # limits of files uploaded at once to /audio/<type>/bulk (files in zip archives are counted one by one),
+    # sizes of archive's files are checked before they're extracted
+    BULK_UPLOAD_MAX_FILES = 500
+    BULK_UPLOAD_MAX_FILE_SIZE = 50 * 1024 ** 2
+    BULK_UPLOAD_MAX_TOTAL_SIZE = 500 * 1024 ** 2
+
     # MongoDB database settings
     DATABASE_URL = "127.0.0.1"
     DATABASE_PORT = "27017"
     DATABASE_NAME = "samplebase"
     JOBS_DATABASE = "jobsbase"
 
+    # all storage classes share one pool of connections per database url,
+    # clients are configured when the app or a job worker starts
+    DATABASE_POOL_SIZE = 50
+    DATABASE_TIMEOUT_MS = 5000
+
+    # engine recognizing speech of new samples in the background,
+    # use StaticSpeechRecognizer for deployments without access to online services
+    SPEECH_RECOGNIZER = OnlineSpeechRecognizer()
+
     # sample manager
-    SAMPLE_MANAGER = SampleManager(f"{DATABASE_URL}:{DATABASE_PORT}", DATABASE_NAME)
+    SAMPLE_MANAGER = SampleManager(
+        f"{DATABASE_URL}:{DATABASE_PORT}", DATABASE_NAME, speech_recognizer=SPEECH_RECOGNIZER
+    )
+
+    # statuses of finished jobs are removed after this many seconds
+    FINISHED_JOBS_TTL = 7 * 24 * 3600
+    # progress of jobs is written at most once per interval (seconds), if it changed by at least delta
+    STATUS_UPDATE_INTERVAL = 1.
+    STATUS_UPDATE_PROGRESS_DELTA = .01
+
+    JOB_STATUS_PROVIDER = JobStatusProvider(
+        f"{DATABASE_URL}:{DATABASE_PORT}", JOBS_DATABASE, finished_jobs_ttl=FINISHED_JOBS_TTL
+    )
+
+    # training and testing jobs are queued and run by workers started with
+    #   python -m algorithms.job_worker --config config.ProductionConfig
+    # if RUN_JOBS_IN_APP is True, the app runs them in its own threads instead
+    RUN_JOBS_IN_APP = False
+    # maximal number of running jobs of an algorithm: {algorithm name: limit}, default is 1
+    ALGORITHM_CONCURRENCY = {}
+    JOB_QUEUE = JobQueue(
+        f"{DATABASE_URL}:{DATABASE_PORT}", JOBS_DATABASE, concurrency=ALGORITHM_CONCURRENCY,
+        finished_jobs_ttl=FINISHED_JOBS_TTL
+    )
 
-    JOB_STATUS_PROVIDER = JobStatusProvider(f"{DATABASE_URL}:{DATABASE_PORT}", JOBS_DATABASE)
+    # limits of cache of models loaded for predictions
+    MODEL_CACHE_ENTRIES = 32
+    MODEL_CACHE_BYTES = 1024 ** 3
+    # number of versions of each model kept on disk
+    MODEL_STORE_KEEP_VERSIONS = 2
+    # pack models of users into one archive per algorithm after training, to load them with a single read
+    USE_MODEL_ARCHIVE = False
+    # load packed models into the cache when the app starts
+    PRELOAD_MODELS = False
+
+    # number of processes training and testing users' models, all cpus if None
+    ALGORITHM_WORKERS = None
+    # number of users' models trained at once by a single job, ALGORITHM_WORKERS if None
+    TRAINING_CONCURRENCY = None
+    # number of samples predicted at once when testing models
+    PREDICTION_BATCH_SIZE = 64
 
     ALGORITHM_MANAGER = algorithm_manager_factory(
         ALG_DICT,
-        get_status_updater_factory(f"{DATABASE_URL}:{DATABASE_PORT}", JOBS_DATABASE),
-        '__base_algorithm_manager'
+        get_status_updater_factory(f"{DATABASE_URL}:{DATABASE_PORT}", JOBS_DATABASE,
+                                   finished_jobs_ttl=FINISHED_JOBS_TTL, min_interval=STATUS_UPDATE_INTERVAL,
+                                   min_progress_delta=STATUS_UPDATE_PROGRESS_DELTA),
+        '__base_algorithm_manager',
+        ModelCache(MODEL_CACHE_ENTRIES, MODEL_CACHE_BYTES),
+        ManagedExecutor(ALGORITHM_WORKERS),
+        TRAINING_CONCURRENCY,
+        PREDICTION_BATCH_SIZE,
+        ModelStore(MODEL_STORE_KEEP_VERSIONS),
+        USE_MODEL_ARCHIVE
     )
 
 
@@ -73,6 +139,7 @@ class DevelopmentConfig(BaseConfig):
     This config is used during the development of the app on localhost
     """
     DEBUG = True
+    RUN_JOBS_IN_APP = True
 
 
 class TestingConfig(BaseConfig):
@@ -82,14 +149,23 @@ class TestingConfig(BaseConfig):
     TESTING = True
     DATABASE_NAME = f"{BaseConfig.DATABASE_NAME}_test"
     JOBS_DATABASE = "jobsbase_test"
+    # local stand-in for online speech recognition
+    SPEECH_RECOGNIZER = StaticSpeechRecognizer("trzynaście")
+
     SAMPLE_MANAGER = SampleManager(
-        f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}", DATABASE_NAME, show_logs="False"
+        f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}", DATABASE_NAME, show_logs="False",
+        speech_recognizer=SPEECH_RECOGNIZER
     )
 
     JOB_STATUS_PROVIDER = JobStatusProvider(
         f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}", JOBS_DATABASE, show_logs=False
     )
 
+    RUN_JOBS_IN_APP = True
+    JOB_QUEUE = JobQueue(
+        f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}", JOBS_DATABASE, show_logs=False
+    )
+
     JOB_STATUS_UPDATER_FACTORY = get_status_updater_factory(
             f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}", JOBS_DATABASE, show_logs=False
         )
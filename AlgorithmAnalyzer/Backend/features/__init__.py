@@ -0,0 +1,5 @@
+from .mel import NFFT, delta, get_filterbank, logfbank, logfbank_batch, mfcc, mfcc_batch
+from .vad import find_voiced_range, trim_silence
+
+__all__ = ['NFFT', 'delta', 'find_voiced_range', 'get_filterbank', 'logfbank', 'logfbank_batch', 'mfcc', 'mfcc_batch',
+           'trim_silence']
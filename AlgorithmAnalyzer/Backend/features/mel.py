@@ -0,0 +1,159 @@
+import math
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+from scipy.fftpack import dct
+
+''''''''''''''''
+Mel features of many signals at once, computed the same way as by python_speech_features
+(so features stored before are still valid), but:
+    - frames of all signals are stacked into one matrix, transformed with a single batched FFT
+      and multiplied by the filterbank at once,
+    - mel filterbanks are built without loops and cached per (samplerate, nfft, nfilt, lowfreq, highfreq).
+All signals of a batch must have the same samplerate, parameters are named as in python_speech_features.
+'''''''''''''''
+
+# fft size of features stored by FeatureStore and plotted, 25ms frames of 48kHz recordings have 1200 samples
+NFFT = 1250
+
+
+def hz2mel(hz):
+    return 2595 * np.log10(1 + hz / 700.)
+
+
+def mel2hz(mel):
+    return 700 * (10 ** (mel / 2595.0) - 1)
+
+
+@lru_cache(maxsize=64)
+def get_filterbank(samplerate: int, nfft: int = 512, nfilt: int = 26, lowfreq: float = 0,
+                   highfreq: float = None) -> np.ndarray:
+    """
+    Returns a (read-only) matrix of shape (nfilt, nfft // 2 + 1) with triangular mel filters in rows.
+    """
+    highfreq = highfreq or samplerate / 2
+    if highfreq > samplerate / 2:
+        raise ValueError("highfreq is greater than samplerate/2")
+    melpoints = np.linspace(hz2mel(lowfreq), hz2mel(highfreq), nfilt + 2)
+    bins = np.floor((nfft + 1) * mel2hz(melpoints) / samplerate)
+    left, center, right = bins[:-2, None], bins[1:-1, None], bins[2:, None]
+    i = np.arange(nfft // 2 + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rising = np.where((left <= i) & (i < center), (i - left) / (center - left), 0)
+        falling = np.where((center <= i) & (i < right), (right - i) / (right - center), 0)
+    filterbank = rising + falling
+    filterbank.flags.writeable = False
+    return filterbank
+
+
+def _round_half_up(number: float) -> int:
+    return int(math.floor(number + .5))
+
+
+def frame_signals(signals: List[np.ndarray], samplerate: int, winlen: float = 0.025, winstep: float = 0.01,
+                  preemph: float = 0.97) -> Tuple[np.ndarray, List[int]]:
+    """
+    Applies the preemphasis filter and splits signals into overlapping frames,
+    the last frame of each signal is padded with zeros.
+    :returns: (matrix with frames of all signals in rows, number of frames of each signal)
+    """
+    frame_len = _round_half_up(winlen * samplerate)
+    frame_step = _round_half_up(winstep * samplerate)
+    counts, padded = [], []
+    for signal in signals:
+        if len(signal) <= frame_len:
+            count = 1
+        else:
+            count = 1 + int(math.ceil((len(signal) - frame_len) / frame_step))
+        emphasized = np.empty((count - 1) * frame_step + frame_len)
+        emphasized[:1] = signal[:1]
+        emphasized[1:len(signal)] = signal[1:] - preemph * signal[:-1]
+        emphasized[len(signal):] = 0
+        counts.append(count)
+        padded.append(emphasized)
+    offsets = np.cumsum([0] + [len(signal) for signal in padded[:-1]])
+    starts = np.concatenate([
+        offset + np.arange(count) * frame_step for offset, count in zip(offsets, counts)
+    ])
+    frames = np.concatenate(padded)[starts[:, None] + np.arange(frame_len)]
+    return frames, counts
+
+
+def fbank_batch(signals: List[np.ndarray], samplerate: int = 16000, winlen: float = 0.025, winstep: float = 0.01,
+                nfilt: int = 26, nfft: int = 512, lowfreq: float = 0, highfreq: float = None,
+                preemph: float = 0.97) -> Tuple[np.ndarray, np.ndarray, List[int]]:
+    """
+    Computes mel filterbank energies of frames of all signals.
+    :returns: (filterbank energies of shape (frames, nfilt), total energy of each frame,
+    number of frames of each signal)
+    """
+    frames, counts = frame_signals(signals, samplerate, winlen, winstep, preemph)
+    power = np.square(np.abs(np.fft.rfft(frames, nfft))) / nfft
+    energy = power.sum(axis=1)
+    energy[energy == 0] = np.finfo(float).eps
+    feat = power.dot(get_filterbank(samplerate, nfft, nfilt, lowfreq, highfreq).T)
+    feat[feat == 0] = np.finfo(float).eps
+    return feat, energy, counts
+
+
+def _split(feat: np.ndarray, counts: List[int]) -> List[np.ndarray]:
+    return np.split(feat, np.cumsum(counts[:-1]))
+
+
+def logfbank_batch(signals: List[np.ndarray], samplerate: int = 16000, winlen: float = 0.025, winstep: float = 0.01,
+                   nfilt: int = 26, nfft: int = 512, lowfreq: float = 0, highfreq: float = None,
+                   preemph: float = 0.97) -> List[np.ndarray]:
+    """
+    Computes log mel filterbank energies of signals,
+    :returns: list with a matrix of shape (frames, nfilt) for each signal
+    """
+    feat, _, counts = fbank_batch(signals, samplerate, winlen, winstep, nfilt, nfft, lowfreq, highfreq, preemph)
+    return _split(np.log(feat), counts)
+
+
+def mfcc_batch(signals: List[np.ndarray], samplerate: int = 16000, winlen: float = 0.025, winstep: float = 0.01,
+               numcep: int = 13, nfilt: int = 26, nfft: int = 512, lowfreq: float = 0, highfreq: float = None,
+               preemph: float = 0.97, ceplifter: int = 22, appendEnergy: bool = True) -> List[np.ndarray]:
+    """
+    Computes mfcc of signals,
+    :param appendEnergy: bool - if True, the first cepstral coefficient is replaced with log of frame's energy
+    :returns: list with a matrix of shape (frames, numcep) for each signal
+    """
+    feat, energy, counts = fbank_batch(signals, samplerate, winlen, winstep, nfilt, nfft, lowfreq, highfreq, preemph)
+    feat = dct(np.log(feat), type=2, axis=1, norm='ortho')[:, :numcep]
+    if ceplifter > 0:
+        feat *= 1 + (ceplifter / 2.) * np.sin(np.pi * np.arange(feat.shape[1]) / ceplifter)
+    if appendEnergy:
+        feat[:, 0] = np.log(energy)
+    return _split(feat, counts)
+
+
+def mfcc(signal: np.ndarray, samplerate: int = 16000, **params) -> np.ndarray:
+    """
+    Computes mfcc of a single signal, see mfcc_batch.
+    """
+    return mfcc_batch([signal], samplerate, **params)[0]
+
+
+def logfbank(signal: np.ndarray, samplerate: int = 16000, **params) -> np.ndarray:
+    """
+    Computes log mel filterbank energies of a single signal, see logfbank_batch.
+    """
+    return logfbank_batch([signal], samplerate, **params)[0]
+
+
+def delta(feat: np.ndarray, N: int = 2) -> np.ndarray:
+    """
+    Computes delta features of a sequence of feature vectors (eg. mfcc),
+    using `N` preceding and following frames, edge frames are repeated.
+    :returns: matrix of the same shape as `feat`
+    """
+    if N < 1:
+        raise ValueError("N must be an integer >= 1")
+    length = len(feat)
+    padded = np.pad(feat, ((N, N), (0, 0)), mode='edge')
+    result = np.zeros(feat.shape)
+    for n in range(1, N + 1):
+        result += n * (padded[N + n:N + n + length] - padded[N - n:N - n + length])
+    return result / (2 * sum(n ** 2 for n in range(1, N + 1)))
@@ -0,0 +1,54 @@
+import os
+import unittest
+
+import numpy as np
+import python_speech_features as psf
+import scipy.io.wavfile as wav
+
+from features import delta, get_filterbank, logfbank, logfbank_batch, mfcc, mfcc_batch
+
+
+class TestMelFeatures(unittest.TestCase):
+    """ Unit tests comparing batched mel features with python_speech_features """
+
+    @classmethod
+    def setUpClass(self):
+        audio_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))),
+                                  "plots", "tests", "1.wav")
+        (self.rate, self.signal) = wav.read(audio_path)
+        random = np.random.RandomState(0)
+        self.signals = [self.signal, random.randint(-2 ** 15, 2 ** 15, 300).astype(np.int16),
+                        random.randn(1000), np.zeros(5000)]
+
+    def test_filterbank(self):
+        for nfft, nfilt in [(512, 26), (1250, 26), (1251, 40)]:
+            filterbank = get_filterbank(self.rate, nfft, nfilt)
+            np.testing.assert_allclose(filterbank, psf.get_filterbanks(nfilt, nfft, self.rate))
+        self.assertIs(get_filterbank(self.rate, 512, 26), get_filterbank(self.rate, 512, 26))
+        self.assertFalse(filterbank.flags.writeable)
+
+    def test_mfcc(self):
+        features = mfcc_batch(self.signals, self.rate, nfft=1250)
+        self.assertEqual(len(features), len(self.signals))
+        for signal, feat in zip(self.signals, features):
+            np.testing.assert_allclose(feat, psf.mfcc(signal, self.rate, nfft=1250), rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(mfcc(self.signal, self.rate, numcep=20, nfilt=40, appendEnergy=False),
+                                   psf.mfcc(self.signal, self.rate, numcep=20, nfilt=40, appendEnergy=False),
+                                   rtol=1e-6, atol=1e-8)
+
+    def test_logfbank(self):
+        for signal, feat in zip(self.signals, logfbank_batch(self.signals, self.rate)):
+            np.testing.assert_allclose(feat, psf.logfbank(signal, self.rate), rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(logfbank(self.signal, self.rate, nfft=1250),
+                                   psf.logfbank(self.signal, self.rate, nfft=1250), rtol=1e-6, atol=1e-8)
+
+    def test_delta(self):
+        feat = mfcc(self.signal, self.rate)
+        for N in [1, 2, 3]:
+            np.testing.assert_allclose(delta(feat, N), psf.delta(feat, N), rtol=1e-6, atol=1e-8)
+        with self.assertRaises(ValueError):
+            delta(feat, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
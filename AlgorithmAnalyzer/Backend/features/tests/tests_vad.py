@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+from features import find_voiced_range, trim_silence
+
+
+class TestVoiceActivityDetection(unittest.TestCase):
+    """ Unit tests for finding speech between leading and trailing silence """
+
+    RATE = 8000
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        time = np.arange(self.RATE) / self.RATE
+        # 1s of silence with faint noise, 1s of a tone, .5s of silence, .5s of quieter noise (like 's'), 1s of silence
+        self.speech = np.concatenate([
+            np.sin(2 * np.pi * 200 * time) * .5,
+            np.zeros(self.RATE // 2),
+            random.uniform(-.005, .005, self.RATE // 2)
+        ])
+        self.signal = np.concatenate([np.zeros(self.RATE), self.speech, np.zeros(self.RATE)])
+        self.signal += random.uniform(-1e-4, 1e-4, len(self.signal))
+
+    def test_find_voiced_range(self):
+        start, end = find_voiced_range(self.signal, self.RATE, padding_ms=0)
+        self.assertEqual((start, end), (self.RATE, 3 * self.RATE))
+
+        start, end = find_voiced_range(self.signal, self.RATE, padding_ms=100)
+        self.assertEqual((start, end), (self.RATE - self.RATE // 10, 3 * self.RATE + self.RATE // 10))
+
+    def test_quiet_frames_without_crossings_are_silence(self):
+        # the noise isn't loud enough without its zero crossings
+        start, end = find_voiced_range(self.signal, self.RATE, padding_ms=0, zcr_threshold=1)
+        self.assertEqual((start, end), (self.RATE, 2 * self.RATE))
+
+    def test_trim_silence(self):
+        trimmed = trim_silence(self.signal, self.RATE, padding_ms=0)
+        np.testing.assert_array_equal(trimmed, self.signal[self.RATE:3 * self.RATE])
+
+    def test_signal_without_speech(self):
+        self.assertEqual(find_voiced_range(np.zeros(1000), self.RATE), (0, 1000))
+        self.assertEqual(find_voiced_range(np.zeros(0), self.RATE), (0, 0))
+        # shorter than a frame
+        self.assertEqual(find_voiced_range(np.ones(10), self.RATE), (0, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
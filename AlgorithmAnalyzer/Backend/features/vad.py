@@ -0,0 +1,60 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+''''''''''''''''
+Voice activity detection based on energy and zero-crossing rate of short frames.
+A frame is voiced if its energy is close to the energy of the loudest frame,
+quieter frames with many zero crossings (unvoiced consonants, eg. 's', 'f') are treated as speech too,
+while quiet frames with few crossings are silence. Only leading and trailing silence is found,
+pauses inside of the recording are kept.
+'''''''''''''''
+
+
+def frame_energy_and_zcr(signal: np.ndarray, frame_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits the signal into non-overlapping frames (the last one padded with zeros).
+    :returns: (energy of each frame in dB, fraction of consecutive samples of each frame with different signs)
+    """
+    count = int(math.ceil(len(signal) / frame_len))
+    frames = np.zeros((count, frame_len), dtype=np.float64)
+    frames.ravel()[:len(signal)] = signal
+    energy = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-12)
+    signs = np.signbit(frames)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1) if frame_len > 1 else np.zeros(count)
+    return energy, zcr
+
+
+def find_voiced_range(signal: np.ndarray, samplerate: int, frame_ms: float = 20, threshold_db: float = 35,
+                      unvoiced_threshold_db: float = 45, zcr_threshold: float = .3,
+                      padding_ms: float = 100) -> Tuple[int, int]:
+    """
+    Finds the part of the signal between the first and the last frame with speech.
+    :param frame_ms: float - length of frames in milliseconds
+    :param threshold_db: float - frames quieter than the loudest one by less than this are voiced
+    :param unvoiced_threshold_db: float - frames quieter by less than this are speech, if their zero-crossing
+    rate is above `zcr_threshold`
+    :param padding_ms: float - silence kept before and after speech, so its beginning and end aren't cut
+    :returns: (first sample, last sample + 1), the whole signal if no frame is louder than others
+    """
+    frame_len = max(1, int(samplerate * frame_ms / 1000))
+    if len(signal) == 0:
+        return 0, 0
+    energy, zcr = frame_energy_and_zcr(signal, frame_len)
+    loudest = energy.max()
+    speech = (energy > loudest - threshold_db) | ((energy > loudest - unvoiced_threshold_db) & (zcr > zcr_threshold))
+    frames = np.flatnonzero(speech)
+    padding = int(math.ceil(padding_ms / frame_ms))
+    start = max(0, (frames[0] - padding) * frame_len)
+    end = min(len(signal), (frames[-1] + 1 + padding) * frame_len)
+    return int(start), int(end)
+
+
+def trim_silence(signal: np.ndarray, samplerate: int, **params) -> np.ndarray:
+    """
+    Returns the part of the signal with speech, without leading and trailing silence,
+    see find_voiced_range for parameters.
+    """
+    start, end = find_voiced_range(signal, samplerate, **params)
+    return signal[start:end]
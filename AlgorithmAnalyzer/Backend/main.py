@@ -1,7 +1,10 @@
+import atexit
 import io
 import urllib
 import json
+import zipfile
 from io import BytesIO
+from mimetypes import guess_type
 
 from flask import request, current_app, send_file, jsonify
 from flask_api import FlaskAPI, status
@@ -10,8 +13,10 @@ from functools import wraps
 
 from algorithms.algorithm_manager import NotTrainedException
 from algorithms.base_algorithm import AlgorithmException
+from algorithms.job_worker import JobWorker
 from sample_manager.SampleManager import SampleManager, UsernameException, DatabaseException
 from utils import convert_audio
+from utils.db_clients import configure_clients, close_clients
 
 app = FlaskAPI(__name__)
 
@@ -37,6 +42,53 @@ def requires_db_connection(f):
     return wrapped
 
 
+def start_job(job_id: str, kind: str, algorithm_name: str, payload: dict, priority: int):
+    """
+    queues a job, which will be run by job workers,
+    or by the app itself in a thread if RUN_JOBS_IN_APP is set
+    """
+    app.config['JOB_QUEUE'].enqueue(job_id, kind, algorithm_name, payload, priority)
+    if app.config['RUN_JOBS_IN_APP']:
+        JobWorker(
+            app.config['JOB_QUEUE'], app.config['ALGORITHM_MANAGER'], app.config['SAMPLE_MANAGER'],
+            show_logs=not app.config['TESTING']
+        ).run_pending_in_background()
+
+
+def get_job_priority():
+    """
+    returns priority of a job from optional field 'priority' of request's body (0 by default),
+    or None if it's not an integer
+    """
+    try:
+        return int(request.data.get('priority', 0))
+    except (ValueError, TypeError):
+        return None
+
+
+def requeue_pending_recognitions():
+    """
+    queues recognition of samples left pending (eg. by a previous run of the app),
+    it's done only by the app, not by every process using the sample manager (eg. job workers)
+    """
+    count = app.config['SAMPLE_MANAGER'].speech_recognition_queue.requeue_pending()
+    if count:
+        print(f" * #INFO: queued speech recognition of {count} samples")
+
+
+def preload_models():
+    """
+    loads packed models of all algorithms into the model cache, if PRELOAD_MODELS is set
+    """
+    if not app.config['PRELOAD_MODELS']:
+        return
+    alg_manager = app.config['ALGORITHM_MANAGER']
+    for name in alg_manager.get_algorithms():
+        count = alg_manager(name).preload_models()
+        if count:
+            print(f" * #INFO: preloaded {count} models of {name}")
+
+
 @app.route("/", methods=['GET'])
 def landing_documentation_page():
     """ Landing page for browsable API """
@@ -121,6 +173,10 @@ def train_algorithm(name):
         {'parameter_name': 'value'}
     Where the paremeter names and values should agree with the
     output of GET /algorithm/parameters/<string:name>.
+    Optional field 'priority' (integer, 0 by default) sets the priority of the job,
+    jobs with higher priority are run first.
+    Optional field 'incremental' (boolean, false by default) - if true, only models
+    of users whose samples changed since their last training are trained.
     """
     if 'parameters' not in request.data:
         return 'Missing "params" field in request body.', status.HTTP_400_BAD_REQUEST
@@ -146,7 +202,13 @@ def train_algorithm(name):
     if any(params_types[key](params[key]) not in params_legend[key]['values'] for key in params):
         return 'At least one parameter has bad value.', status.HTTP_400_BAD_REQUEST
 
-    alg_manager = app.config['ALGORITHM_MANAGER'](name)
+    priority = get_job_priority()
+    if priority is None:
+        return 'Priority should be an integer.', status.HTTP_400_BAD_REQUEST
+
+    incremental = request.data.get('incremental', False)
+    if not isinstance(incremental, bool):
+        return 'Incremental should be a boolean.', status.HTTP_400_BAD_REQUEST
 
     data = {'algorithm': name, 'parameters': params}
 
@@ -154,18 +216,8 @@ def train_algorithm(name):
     if job_status:
         return {'job_id': job_status, 'message': 'There is allready such job.'}, status.HTTP_200_OK
 
-    samples, labels = app.config['SAMPLE_MANAGER'].get_all_samples(
-        purpose='train',
-        multilabel=alg_manager.multilabel,
-        sample_type='wav'
-    )
-
     job_id = app.config['JOB_STATUS_PROVIDER'].create_job_status(data=data)
-
-    try:
-        app.config['ALGORITHM_MANAGER'](name).train(samples, labels, params, job_id)
-    except AlgorithmException as e:
-        return f"There was an exception within the algorithm: {str(e)}", status.HTTP_503_SERVICE_UNAVAILABLE
+    start_job(job_id, 'train', name, {'parameters': params, 'incremental': incremental}, priority)
     return {'job_id': job_id, 'message': "Job started successfully."}, status.HTTP_200_OK
 
 
@@ -251,23 +303,27 @@ def job_status_endpoint(jid: str):
                     { 'param name': param value }
             }
         }
-    If the job is finished, deletes it's status entry.
+    Statuses of finished jobs are kept until they expire (see FINISHED_JOBS_TTL in config),
+    so they can be read many times, eg. by clients polling again after a lost response.
+    DELETE cancels the job if it's not finished: queued job won't be run,
+    running job stops as soon as possible, then it finishes with an error
+    and field 'cancelled': true. DELETE of finished job deletes it's status entry.
     """
     if request.method == 'DELETE':
-        try:
+        job_status = app.config['JOB_STATUS_PROVIDER'].read_job_status(jid)
+        if job_status is None:
+            return "There is no job with this job_id.", status.HTTP_404_NOT_FOUND
+        if job_status['finished']:
             app.config['JOB_STATUS_PROVIDER'].delete_job_status(jid)
             return "Job deleted.", status.HTTP_200_OK
-        except Exception as e:
-            print(str(e))
-            return "There is no job with this job_id.", status.HTTP_404_NOT_FOUND
+        # running job is finished by it's worker after it stops
+        queue_state = app.config['JOB_QUEUE'].cancel(jid)
+        app.config['JOB_STATUS_PROVIDER'].cancel_job(jid, finish=queue_state != 'running')
+        return "Job cancelled.", status.HTTP_200_OK
     else:
         job_status = app.config['JOB_STATUS_PROVIDER'].read_job_status(jid)
         if job_status is None:
             return "There is no job with this job_id.", status.HTTP_404_NOT_FOUND
-
-        if job_status['finished']:
-            app.config['JOB_STATUS_PROVIDER'].delete_job_status(jid)
-
         return job_status, status.HTTP_200_OK
 
 
@@ -275,12 +331,16 @@ def job_status_endpoint(jid: str):
 @requires_db_connection
 def test_algorithm(algorithm_name):
     """
-    Creates the confussion matrix of an algorithm with name <string:algorithm_name>.
+    Starts a job computing the confussion matrix of an algorithm with name <string:algorithm_name>.
     Optionally, request's body may contain field 'users' with a list of usernames,
-    for which to compute the matrix.
-    If algorithm is not multilabel, returns a list lists:
+    for which to compute the matrix, and field 'priority' - the priority of the job.
+    Returns
+        {"job_id": job_id, "message": message}
+    the progress of the job can be checked at /jobs/<job_id>, when it's finished
+    field 'result' of the job status contains the result of testing.
+    If algorithm is not multilabel, the result is a list lists:
         [[username, sample_number, fake (T/F), prediction (T/F)]]
-    If algorithm is multilabel, returns:
+    If algorithm is multilabel, the result is:
         {
             'users': [list of usernames],
             'matrix': [[matrix as lists of lists]]
@@ -299,20 +359,25 @@ def test_algorithm(algorithm_name):
     except ValueError:
         return "Incorrect username!", status.HTTP_400_BAD_REQUEST
 
-    alg_manager = app.config['ALGORITHM_MANAGER'](algorithm_name)
-
-    samples, labels = app.config['SAMPLE_MANAGER'].get_all_samples(
-        purpose='test',
-        multilabel=alg_manager.multilabel,
-        sample_type='wav'
-    )
+    priority = get_job_priority()
+    if priority is None:
+        return 'Priority should be an integer.', status.HTTP_400_BAD_REQUEST
 
+    alg_manager = app.config['ALGORITHM_MANAGER'](algorithm_name)
     try:
-        result = alg_manager.test(samples, labels, users, numbers)
+        alg_manager.check_trained(users)
     except NotTrainedException as e:
         return str(e), 422
 
-    return result, status.HTTP_200_OK
+    data = {'algorithm': algorithm_name, 'type': 'test', 'users': users}
+
+    job_status = app.config['JOB_STATUS_PROVIDER'].job_with_data_is_running(data)
+    if job_status:
+        return {'job_id': job_status, 'message': 'There is allready such job.'}, status.HTTP_200_OK
+
+    job_id = app.config['JOB_STATUS_PROVIDER'].create_job_status(data=data)
+    start_job(job_id, 'test', algorithm_name, {'users': users, 'user_numbers': numbers}, priority)
+    return {'job_id': job_id, 'message': "Job started successfully."}, status.HTTP_200_OK
 
 
 @app.route("/audio/<string:type>", methods=['POST'])
@@ -326,6 +391,8 @@ def handling_audio_endpoint(type):
     <string:type> should be either 'train' or 'test';
     Requests body should contain 'username' and optionally 'fake'.
     The last should be true/false depending on the sample being real.
+    Speech is recognized in the background, response contains
+    recognized_speech 'pending', the result can be checked later.
     """
     if type not in ['train', 'test']:
         return [f"Unexpected type '{type}' requested"], status.HTTP_400_BAD_REQUEST
@@ -353,11 +420,88 @@ def handling_audio_endpoint(type):
     app.logger.info(f"new sample added successfully")
     return {"username": username,
             "text": f"Uploaded file for {username}, "
-                    f"recognized: '{recognized_speech}'",
+                    f"speech recognition: '{recognized_speech}'",
             "recognized_speech": recognized_speech
             }, status.HTTP_201_CREATED
 
 
+@app.route("/audio/<string:type>/bulk", methods=['POST'])
+@requires_db_connection
+def handling_bulk_audio_endpoint(type):
+    """
+    POST to send many audio files of one user at once
+    <string:type> should be either 'train' or 'test';
+    Requests body should contain 'username', optionally 'fake'
+    and any number of 'file' parts, each of them can be an audio file
+    or a zip archive with audio files.
+    Returns result of saving every file.
+    """
+    if type not in ['train', 'test']:
+        return [f"Unexpected type '{type}' requested"], status.HTTP_400_BAD_REQUEST
+
+    if 'file' not in request.files:
+        return ['No file part'], status.HTTP_400_BAD_REQUEST
+
+    if 'username' not in request.data:
+        return ["Missing 'username' field in request body"], status.HTTP_400_BAD_REQUEST
+
+    username = request.data.get('username')
+    fake = False
+    if 'fake' in request.data:
+        fake = request.data['fake']
+
+    max_files = app.config['BULK_UPLOAD_MAX_FILES']
+    max_file_size = app.config['BULK_UPLOAD_MAX_FILE_SIZE']
+    max_total_size = app.config['BULK_UPLOAD_MAX_TOTAL_SIZE']
+    too_many_files = [f"At most {max_files} files can be uploaded at once"], status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    too_large_total = [f"Uploaded files can have at most {max_total_size} bytes in total"],\
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+    files = []
+    total_size = 0
+    for file in request.files.getlist('file'):
+        if file.mimetype in ['application/zip', 'application/x-zip-compressed'] or file.filename.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(BytesIO(file.read())) as archive:
+                    members = [member for member in archive.infolist() if not member.is_dir()]
+                    if len(files) + len(members) > max_files:
+                        return too_many_files
+                    # sizes are read from archive's directory, zipfile never extracts more than declared
+                    for member in members:
+                        if member.file_size > max_file_size:
+                            return [f"File '{member.filename}' is larger than {max_file_size} bytes"],\
+                                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                        total_size += member.file_size
+                    if total_size > max_total_size:
+                        return too_large_total
+                    for member in members:
+                        content_type, _ = guess_type(member.filename)
+                        files.append((member.filename, archive.read(member), content_type))
+            except zipfile.BadZipFile:
+                return [f"File '{file.filename}' is not a valid zip archive"], status.HTTP_400_BAD_REQUEST
+        else:
+            if len(files) + 1 > max_files:
+                return too_many_files
+            file_bytes = file.read()
+            total_size += len(file_bytes)
+            if total_size > max_total_size:
+                return too_large_total
+            files.append((file.filename, file_bytes, file.mimetype))
+
+    app.logger.info(f"try to add {len(files)} new samples to {type} set")
+    try:
+        results = app.config['SAMPLE_MANAGER'].save_new_samples(username, type, files, fake=fake)
+    except UsernameException:
+        return ['Provided username contains special characters'], status.HTTP_400_BAD_REQUEST
+
+    saved = sum(1 for result in results if not result['error'])
+    app.logger.info(f"{saved} of {len(results)} new samples added successfully")
+    return {"username": username,
+            "text": f"Uploaded {saved} of {len(results)} files for {username}",
+            "samples": results
+            }, status.HTTP_201_CREATED if saved else status.HTTP_400_BAD_REQUEST
+
+
 @app.route("/audio/<string:type>/<string:username>", methods=['GET'])
 @requires_db_connection
 def handle_list_samples_for_user(type, username):
@@ -429,6 +573,24 @@ def handle_get_file(sampletype, username, samplename):
     return send_file(BytesIO(file_mp3.read()), mimetype=file.content_type)
 
 
+@app.route("/audio/<string:sampletype>/<string:username>/<string:samplename>/recognized_speech", methods=['GET'])
+@requires_db_connection
+def handle_get_recognized_speech(sampletype, username, samplename):
+    """
+    GET speech recognized from audio sample,
+    it is 'pending' until the sample is recognized in the background
+
+    :param sampletype: sample set type 'train' or 'test'
+    :param username: full or normalized username eg. 'Hugo Kołątaj', 'Stanisław', 'hugo_kolataj'
+    :param samplename: full name of requested sample eg. '1.wav', '150.wav'
+    """
+    try:
+        recognized_speech = app.config['SAMPLE_MANAGER'].get_recognized_speech(username, sampletype, samplename)
+    except ValueError as e:
+        return [str(e)], status.HTTP_400_BAD_REQUEST
+    return {"recognized_speech": recognized_speech}, status.HTTP_200_OK
+
+
 @app.route("/plot/<string:sampletype>/<string:username>/<string:samplename>",
            methods=['GET'])
 @requires_db_connection
@@ -673,4 +835,11 @@ def handle_tags_summary():
 
 if __name__ == "__main__":
     app.config.from_object('config.DevelopmentConfig')
+    configure_clients(max_pool_size=app.config['DATABASE_POOL_SIZE'],
+                      server_selection_timeout_ms=app.config['DATABASE_TIMEOUT_MS'],
+                      connect_timeout_ms=app.config['DATABASE_TIMEOUT_MS'])
+    atexit.register(close_clients)
+    app.config['SAMPLE_MANAGER'].check_samples_format()
+    requeue_pending_recognitions()
+    preload_models()
     app.run()
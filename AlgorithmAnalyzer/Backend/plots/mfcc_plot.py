@@ -4,8 +4,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib import cm
 import scipy.io.wavfile as wav
-from python_speech_features import mfcc
 
+from features import NFFT, mfcc
 from plots.save_plot import save_matplotlib_figure
 
 # this file handles plotting and saving mfcc plots
@@ -19,7 +19,7 @@ def _plot_mfcc_color_boxes(audio_path: str) -> plt.Figure:
     :return: plt.Figure containing the MFCC colored boxes plot
     """
     (rate, sig) = wav.read(audio_path)
-    mfcc_features_lines = mfcc(sig, rate, nfft=1250)
+    mfcc_features_lines = mfcc(sig, rate, nfft=NFFT)
     figure, axis = plt.subplots()
     mfcc_data = np.swapaxes(mfcc_features_lines, 0, 1)
     axis.set_title("MFCC")
@@ -37,7 +37,17 @@ def _plot_mfcc_color_boxes_from_bytes(audio_bytes: bytes) -> plt.Figure:
     :return: plt.Figure containing the MFCC colored boxes plot
     """
     (rate, sig) = wav.read(audio_bytes)
-    mfcc_features_lines = mfcc(sig, rate, nfft=1250)
+    mfcc_features_lines = mfcc(sig, rate, nfft=NFFT)
+    return _plot_mfcc_color_boxes_from_features(mfcc_features_lines)
+
+
+def _plot_mfcc_color_boxes_from_features(mfcc_features_lines: np.ndarray) -> plt.Figure:
+    """
+    Plots a MFCC figure from already computed MFCC features
+
+    :param mfcc_features_lines: np.ndarray of shape (frames, cepstrum coefficients)
+    :return: plt.Figure containing the MFCC colored boxes plot
+    """
     figure, axis = plt.subplots()
     mfcc_data = np.swapaxes(mfcc_features_lines, 0, 1)
     axis.set_title("MFCC")
@@ -61,4 +71,22 @@ def plot_save_mfcc_color_boxes_BytesIO(file_bytes: bytes,
     """
     figure = _plot_mfcc_color_boxes_from_bytes(file_bytes)
     file_io = save_matplotlib_figure(figure, file_name, saved_format)
-    return file_io
\ No newline at end of file
+    return file_io
+
+
+def plot_save_mfcc_features_BytesIO(mfcc_features: np.ndarray,
+                                    file_name: str, saved_format: str = "pdf") -> BytesIO:
+    """
+    Creates a MFCC colored boxes plot from precomputed MFCC features
+    (eg. from FeatureStore) and saves it to a BytesIO object
+    with the given name and format (pdf or png)
+
+    :param mfcc_features: np.ndarray of shape (frames, cepstrum coefficients)
+    :param file_name: name of the file (without the extension)
+    :param saved_format: str type of plot image to be saved, png or pdf,
+    defaults to pdf (vector format)
+    :return file_io: BytesIO containing the requested plot
+    """
+    figure = _plot_mfcc_color_boxes_from_features(mfcc_features)
+    file_io = save_matplotlib_figure(figure, file_name, saved_format)
+    return file_io
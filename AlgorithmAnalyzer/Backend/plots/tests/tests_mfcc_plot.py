@@ -2,7 +2,14 @@
 import unittest
 
 import matplotlib.pyplot as plt
-from plots.mfcc_plot import plot_save_mfcc_color_boxes_BytesIO
+import numpy as np
+import scipy.io.wavfile as wav
+
+from features import mfcc
+from plots.mfcc_plot import (
+    _plot_mfcc_color_boxes_from_bytes, _plot_mfcc_color_boxes_from_features,
+    plot_save_mfcc_color_boxes_BytesIO, plot_save_mfcc_features_BytesIO
+)
 from plots.save_plot import save_matplotlib_figure
 
 
@@ -59,6 +66,30 @@ class TestMfccPlotting(unittest.TestCase):
         os.remove(test_in_memory_plot_path)
 
 
+    def test_plot_mfcc_from_features_same_as_from_audio(self):
+        """
+        plot created from precomputed features should not differ
+        from the one computed from audio
+        """
+        (rate, sig) = wav.read(self.AUDIO_1_PATH)
+        features = mfcc(sig, rate, nfft=1250)
+        # the same data is plotted
+        figure_from_features = _plot_mfcc_color_boxes_from_features(features)
+        figure_from_audio = _plot_mfcc_color_boxes_from_bytes(self.AUDIO_1_PATH)
+        plotted = figure_from_features.axes[0].images[0].get_array()
+        np.testing.assert_array_equal(plotted, features.T)
+        np.testing.assert_array_equal(figure_from_audio.axes[0].images[0].get_array(), plotted)
+        plt.close(figure_from_features)
+        plt.close(figure_from_audio)
+
+        # and the rendered images have the same pixels
+        plot_from_features = plot_save_mfcc_features_BytesIO(features, self.DIRECTORY_TEST, "png")
+        plot_from_audio = plot_save_mfcc_color_boxes_BytesIO(self.AUDIO_1_PATH, self.DIRECTORY_TEST, "png")
+        plot_from_features.seek(0)
+        plot_from_audio.seek(0)
+        np.testing.assert_array_equal(plt.imread(plot_from_features), plt.imread(plot_from_audio),
+                                      "MFCC plot from precomputed features differs from plot from audio")
+
     def test_plot_save_mfcc_color_boxed_fail_wrong_extension_exception(self):
         # check for exception for bad extension
         with self.assertRaises(ValueError, msg="No or bad exception thrown"
@@ -0,0 +1,172 @@
+import json
+import wave
+from io import BytesIO
+
+import gridfs
+import numpy as np
+import scipy.io.wavfile as wav
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, errors
+
+from algorithms.algorithms.preprocessing import read_sample
+from features import NFFT, logfbank, mfcc
+from utils.db_clients import get_client, get_file_storage
+
+# version of features' extraction, a part of features' key, so features computed
+# by older versions are computed again, it has to be increased when extraction changes
+# (eg. with DECODER_VERSION of preprocessing)
+FEATURE_VERSION = 2
+
+''''''''''''''''
+example of single MongoDB document representing features of a single sample
+
+{
+    "_id" : ObjectId("5c05b2a837aeab2bca848c80"),      // mongo document id
+    "fileId" : ObjectId("5c05b2a837aeab2bca848c75"),   // id of sample's audio file in GridFS
+    "type" : "mfcc",                                   // feature type, one of FeatureStore.EXTRACTORS
+    "paramsKey" : "2:{\"nfft\": 1250}",                // FEATURE_VERSION and canonical form of parameters used
+    "params" : {"nfft": 1250},                         // parameters used to compute the features
+    "dtype" : "float32",                               // numpy dtype of stored array
+    "shape" : [99, 13],                                // shape of stored array
+    "data" : BinData(...)                              // raw array bytes
+}
+'''''''''''''''
+
+
+def _extract_mfcc(file_bytes: bytes, **params) -> np.ndarray:
+    (rate, signal) = wav.read(BytesIO(file_bytes))
+    return mfcc(signal, rate, **params)
+
+
+def _extract_logfbank(file_bytes: bytes, **params) -> np.ndarray:
+    (rate, signal) = wav.read(BytesIO(file_bytes))
+    return logfbank(signal, rate, **params)
+
+
+def _extract_normalized(file_bytes: bytes, length: int, trim: bool = False) -> np.ndarray:
+    return read_sample(BytesIO(file_bytes), normalized_length=length, trim_silence=trim)
+
+
+class FeatureStore:
+    """
+    Persistent store of features computed from samples' audio.
+    Features are computed once (at sample ingest or on first request)
+    and saved next to the samples, keyed by the audio file id,
+    feature type and parameters used, so changing parameters
+    recomputes only the features which are stale.
+    """
+
+    # feature type -> function computing it from wav bytes
+    EXTRACTORS = {
+        'mfcc': _extract_mfcc,
+        'logfbank': _extract_logfbank,
+        'normalized': _extract_normalized
+    }
+
+    # features computed for every new sample
+    DEFAULT_FEATURES = {
+        'mfcc': {'nfft': NFFT},
+        'logfbank': {'nfft': NFFT},
+        'normalized': {'length': 4 * 4096}
+    }
+
+    def __init__(self, db_url: str, db_name: str, show_logs: bool = True):
+        """
+        :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
+        :param db_name: str - name of database with samples, features are stored in its 'features' collection
+        :param show_logs: bool - used to suppress log messages
+        """
+        self.db_url = db_url
+        self.db_name = db_name
+        self.show_logs = show_logs
+        try:
+            self.db_features.create_index(
+                [('fileId', ASCENDING), ('type', ASCENDING), ('paramsKey', ASCENDING)],
+                unique=True
+            )
+        except errors.PyMongoError:
+            # database may be unavailable yet, index will be created on next start
+            pass
+
+    # collections are resolved on each access, so a store created before fork uses the client of current process
+    @property
+    def db_features(self):
+        return get_client(self.db_url)[self.db_name].features
+
+    @property
+    def db_file_storage(self) -> gridfs.GridFS:
+        return get_file_storage(self.db_url, self.db_name)
+
+    def compute_features(self, file_id: ObjectId, file_bytes: bytes):
+        """
+        computes and saves all default features of a sample,
+        called when a new sample is added to samplebase
+        :param file_id: ObjectId - id of sample's audio file in GridFS
+        :param file_bytes: bytes - sample's audio as wav
+        """
+        for feature_type, params in self.DEFAULT_FEATURES.items():
+            try:
+                self._compute_and_save(file_id, feature_type, file_bytes, params)
+            except (wave.Error, EOFError, ValueError) as e:
+                # features will be computed again on first request
+                if self.show_logs:
+                    print(f" * #WARNING: could not compute '{feature_type}' for file '{file_id}': {str(e)}")
+
+    def get_features(self, file_id: ObjectId, feature_type: str, **params) -> np.ndarray:
+        """
+        get features of a sample, computes and saves them if they are missing
+        :param file_id: ObjectId - id of sample's audio file in GridFS
+        :param feature_type: str - one of EXTRACTORS keys, eg. 'mfcc'
+        :param params: parameters of feature extraction, missing ones are taken
+                       from DEFAULT_FEATURES, eg. nfft=1250
+        :returns features: np.ndarray
+        """
+        if feature_type not in self.EXTRACTORS:
+            raise ValueError(f"Unknown feature type '{feature_type}', expected one of: {list(self.EXTRACTORS)}")
+        params = {**self.DEFAULT_FEATURES.get(feature_type, {}), **params}
+        doc = self.db_features.find_one(
+            {'fileId': file_id, 'type': feature_type, 'paramsKey': self._get_params_key(params)})
+        if doc:
+            return self._decode_array(doc)
+
+        file_bytes = self.db_file_storage.get(file_id).read()
+        return self._compute_and_save(file_id, feature_type, file_bytes, params)
+
+    def delete_features(self, file_id: ObjectId):
+        """
+        delete all features computed for a sample
+        :param file_id: ObjectId - id of sample's audio file in GridFS
+        """
+        self.db_features.delete_many({'fileId': file_id})
+
+    def _compute_and_save(self, file_id: ObjectId, feature_type: str,
+                          file_bytes: bytes, params: dict) -> np.ndarray:
+        """
+        computes features and upserts them into the store
+        """
+        features = np.asarray(self.EXTRACTORS[feature_type](file_bytes, **params), dtype=np.float32)
+        params_key = self._get_params_key(params)
+        self.db_features.update_one(
+            {'fileId': file_id, 'type': feature_type, 'paramsKey': params_key},
+            {'$set': {'params': params,
+                      'dtype': str(features.dtype),
+                      'shape': list(features.shape),
+                      'data': Binary(features.tobytes())}},
+            upsert=True
+        )
+        return features
+
+    @staticmethod
+    def _get_params_key(params: dict) -> str:
+        """
+        canonical representation of parameters prefixed with FEATURE_VERSION, used as a part of cache key
+        """
+        return f'{FEATURE_VERSION}:{json.dumps(params, sort_keys=True)}'
+
+    @staticmethod
+    def _decode_array(doc: dict) -> np.ndarray:
+        """
+        recreates numpy array from stored feature document
+        """
+        return np.frombuffer(doc['data'], dtype=doc['dtype']).reshape(doc['shape'])
@@ -0,0 +1,80 @@
+import os
+from io import BytesIO
+from typing import Tuple
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from sample_manager.FeatureStore import FeatureStore
+from utils.db_clients import get_file_storage
+
+# (pid, db_url, db_name) -> (GridFS, FeatureStore) used by handles unpickled in this process
+_storages = {}
+
+
+def _get_storages(db_url: str, db_name: str) -> tuple:
+    key = (os.getpid(), db_url, db_name)
+    if key not in _storages:
+        _storages[key] = (get_file_storage(db_url, db_name), FeatureStore(db_url, db_name, show_logs=False))
+    return _storages[key]
+
+
+class SampleHandle:
+    """
+    Lightweight file-like handle of a single sample from samplebase.
+    It is passed to algorithms instead of raw GridFS files.
+    Audio bytes are fetched from GridFS only on first read,
+    precomputed features are served from the FeatureStore
+    without decoding the audio again.
+    Handles can be pickled (eg. to be sent to worker processes),
+    the unpickled handle connects to the same database on its own.
+    """
+
+    def __init__(self, file_id: ObjectId, file_storage, feature_store, file_bytes: bytes = None,
+                 db_location: Tuple[str, str] = None):
+        """
+        :param file_id: ObjectId - id of sample's audio file in GridFS
+        :param file_storage: GridFS containing the audio file
+        :param feature_store: FeatureStore containing sample's features
+        :param file_bytes: bytes - audio bytes, if they were already fetched
+        :param db_location: (db_url, db_name) of the database containing the sample,
+                            required to pickle the handle
+        """
+        self.id = file_id
+        self._file_storage = file_storage
+        self._feature_store = feature_store
+        self._buffer = BytesIO(file_bytes) if file_bytes is not None else None
+        self._db_location = db_location
+
+    def __getstate__(self) -> dict:
+        if self._db_location is None:
+            raise TypeError("can't pickle SampleHandle without db_location")
+        return {
+            'id': self.id,
+            'db_location': self._db_location,
+            'file_bytes': self._buffer.getvalue() if self._buffer is not None else None
+        }
+
+    def __setstate__(self, state: dict):
+        file_storage, feature_store = _get_storages(*state['db_location'])
+        self.__init__(state['id'], file_storage, feature_store, state['file_bytes'], state['db_location'])
+
+    def _get_buffer(self) -> BytesIO:
+        if self._buffer is None:
+            self._buffer = BytesIO(self._file_storage.get(self.id).read())
+        return self._buffer
+
+    def read(self, size: int = -1) -> bytes:
+        return self._get_buffer().read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._get_buffer().seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._get_buffer().tell()
+
+    def get_features(self, feature_type: str, **params) -> np.ndarray:
+        """
+        get precomputed features of this sample, see FeatureStore.get_features
+        """
+        return self._feature_store.get_features(self.id, feature_type, **params)
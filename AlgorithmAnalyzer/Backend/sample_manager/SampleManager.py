@@ -1,39 +1,58 @@
 import datetime
+import hashlib
 import io
 import re
 import unicodedata
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Tuple, Optional, Dict, List
+from typing import Tuple, Optional, Dict, List, Iterator
 
 import gridfs
 from werkzeug.utils import secure_filename
 from mimetypes import guess_type
-from pymongo import MongoClient, errors
+from pymongo import MongoClient, ReturnDocument, ASCENDING, errors
+from bson.binary import Binary
 from bson.objectid import ObjectId
 from gridfs import GridOut
+from gridfs.errors import NoFile
 
+from algorithms.algorithms.preprocessing import read_wav
+from features import find_voiced_range
 from utils import convert_audio
-from utils.speech_recognition_wrapper import speech_to_text_wrapper
+from utils.db_clients import get_client, get_file_storage
+from utils.speech_recognition_wrapper.recognizers import SpeechRecognizer, OnlineSpeechRecognizer
 from plots import mfcc_plot, spectrogram_plot
+from sample_manager.FeatureStore import FeatureStore
+from sample_manager.SampleHandle import SampleHandle
+from sample_manager.SpeechRecognitionQueue import SpeechRecognitionQueue, RECOGNITION_PENDING
 
 ''''''''''''''''
-example of single MongoDB document representing single 'user'
+example of single MongoDB document representing single 'user' (collection 'users')
 
 {
     "_id" : ObjectId("5c05b2a837aeab2bca848c74"),      // mongo document id
     "name" : "Test Test",                              // base username, set during new user creation
     "nameNormalized" : "test_test",                   // normalized name, unique for every user
     "created" : ISODate("2018-12-03T22:48:08.449Z"),   // creation timestamp
-    "samples" : {                                      // here store samples
-        "train" : [
-            { "filename" : "1.wav", "id" : ObjectId("5c05b2a837aeab2bca848c75"), recognizedSpeech: "" },  //single sample document
-            { "filename" : "2.wav", "id" : ObjectId("5c05b7ae37aeab2f3e779659"), recognizedSpeech: "" }
-                  ]
-        "test" : [
-            { "filename" : "1.wav", "id" : ObjectId("5c05c17c37aeab3cf2e5cb76"), recognizedSpeech: "" },
-                 ]
-    },
-    "tags" : {"gender": "male", "age": "20-29"}        // all user-specific tags
+    "tags" : {"gender": "male", "age": "20-29"},       // all user-specific tags
+    "userNumber" : 0,                                  // stable number of the user, used as multilabel label
+    "sampleCounters" : {"train": 2, "test": 1}         // number of the last sample name reserved in each set
+}
+
+example of single MongoDB document representing single sample (collection 'samples')
+
+{
+    "_id" : ObjectId("5c05b2a837aeab2bca848c76"),      // mongo document id
+    "userId" : ObjectId("5c05b2a837aeab2bca848c74"),   // id of the user document
+    "setType" : "train",                               // one of available sample classes from config
+    "filename" : "1.wav",                              // unique in user's set
+    "id" : ObjectId("5c05b2a837aeab2bca848c75"),       // id of sample's audio file in GridFS
+    "fake" : false,
+    "recognizedSpeech" : "pending",                    // recognized text, "pending" until it is recognized
+    "recognitionLease" : ISODate("2018-12-03T22:53:08.449Z"),  // set while a process recognizes the speech
+    "voiced" : {"start": 4800, "end": 52800,           // part of the audio with speech, found by voice activity
+                "totalLength": 96000, "rate": 48000}   // detection (in audio samples), null if it couldn't be decoded
 }
 '''''''''''''''
 
@@ -43,20 +62,33 @@ class SampleManager:
     ALLOWED_PLOT_FILE_EXTENSIONS = ['pdf', 'png']
     ALLOWED_PLOT_TYPES_FROM_SAMPLES = ['mfcc', 'spectrogram']
     ALLOWED_SAMPLE_CONTENT_TYPE = ['audio/wav', 'audio/x-wav']
-
-    def __init__(self, db_url: str, db_name: str, show_logs: bool = True):
+    # content type of stored samples, uploaded files are always converted to wav
+    STORED_CONTENT_TYPE = 'audio/wav'
+    # number of samples fetched from database in a single round trip
+    SAMPLE_BATCH_SIZE = 100
+    # number of threads converting files uploaded in bulk
+    BULK_UPLOAD_WORKERS = 4
+    # number of threads recognizing speech of new samples in the background
+    SPEECH_RECOGNITION_WORKERS = 2
+    # size of GridFS chunks written in bulk, the same as GridFS default
+    FILE_CHUNK_SIZE = 255 * 1024
+
+    def __init__(self, db_url: str, db_name: str, show_logs: bool = True,
+                 speech_recognizer: SpeechRecognizer = None):
         """
         :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
         :param db_name: str - database name
         :param show_logs: bool - used to suppress log messages
+        :param speech_recognizer: SpeechRecognizer - engine used to recognize speech of new samples,
+                                  OnlineSpeechRecognizer by default
         """
         # setup MongoDB database connection
         self.db_url = db_url
-        self.db_client = MongoClient(db_url, serverSelectionTimeoutMS=5000)
-        self.db_database = self.db_client[db_name]
-        self.db_collection = self.db_database.samples
-        self.db_tags = self.db_database.tags
-        self.db_file_storage = gridfs.GridFS(self.db_database)
+        self.db_name = db_name
+        self.feature_store = FeatureStore(db_url, db_name, show_logs)
+        self.speech_recognition_queue = SpeechRecognitionQueue(
+            db_url, db_name, speech_recognizer or OnlineSpeechRecognizer(),
+            self.SPEECH_RECOGNITION_WORKERS, show_logs)
         try:
             if show_logs:
                 print(f" * #INFO: testing db connection: '{db_url}'...")
@@ -67,6 +99,45 @@ class SampleManager:
 
         self.show_logs = show_logs
 
+        # in-process cache of bidirectional mapping between user numbers and usernames
+        self._user_numbers_cache = None
+        if self._has_embedded_samples():
+            print(" * #WARNING: samples are stored in the old format, "
+                  "run 'python scripts/migrate_samples.py' to convert the database")
+        else:
+            self._setup_samples_collection()
+        self._setup_user_numbers()
+
+    # database objects are resolved on each access, so a manager created before fork
+    # (eg. in config) uses the client of current process
+    @property
+    def db_client(self) -> MongoClient:
+        return get_client(self.db_url)
+
+    @property
+    def db_database(self):
+        return self.db_client[self.db_name]
+
+    @property
+    def db_collection(self):
+        return self.db_database.users
+
+    @property
+    def db_samples(self):
+        return self.db_database.samples
+
+    @property
+    def db_tags(self):
+        return self.db_database.tags
+
+    @property
+    def db_counters(self):
+        return self.db_database.counters
+
+    @property
+    def db_file_storage(self) -> gridfs.GridFS:
+        return get_file_storage(self.db_url, self.db_name)
+
     def is_db_available(self) -> bool:
         """
         check database connection
@@ -111,8 +182,15 @@ class SampleManager:
         :param set_type: str - one of avalible sample classes from config
         :param samplename str - eg. '1.wav'
         """
-        sample_list = self.get_user_sample_list(username, set_type)
-        return samplename in sample_list
+        user_id = self._get_user_mongo_id(username)
+        if not user_id:
+            return False
+        try:
+            out = self.db_samples.find_one(
+                {'userId': user_id, 'setType': set_type, 'filename': samplename}, {'_id': 1})
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+        return bool(out)
 
     def create_user(self, username: str) -> ObjectId:
         """
@@ -126,7 +204,10 @@ class SampleManager:
                 raise UsernameException(
                     f"Can't create new user '{username}', it already exists in samplebase")
             new_sample = self._get_sample_class_document_template(username)
+            new_sample['userNumber'] = self._get_next_user_number()
+            new_sample['sampleCounters'] = {'train': 0, 'test': 0}
             id = self.db_collection.insert_one(new_sample).inserted_id
+            self._invalidate_user_numbers()
         except errors.PyMongoError as e:
             raise DatabaseException(e)
         return id
@@ -138,13 +219,14 @@ class SampleManager:
         :param set_type: str - one of available sample classes from config
         """
         id = self._get_user_mongo_id(username)
-        doc = self.db_collection.find_one(
-            {'_id': id}, {f"samples.{set_type}.filename": 1, '_id': 0})
-        if not doc:
+        if not id:
             return []
-        sample_names = []
-        for sample in doc['samples'][set_type]:
-            sample_names.append(sample['filename'])
+        try:
+            docs = self.db_samples.find(
+                {'userId': id, 'setType': set_type}, {'filename': 1, '_id': 0}).sort('_id', 1)
+            sample_names = [doc['filename'] for doc in docs]
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
         return sample_names
 
     def save_new_sample(
@@ -159,40 +241,102 @@ class SampleManager:
         :param file_bytes: bytes - audio file as bytes
         :param content_type: str - type of provided file, eg: 'audio/wav', 'audio/webm'
         :param fake: bool, True if sample belongs to the user, false if it's fake
-        :param recognize: bool - indicates if speech from sample have to be recognized
-                                 saved into samplebase and returned
-        :returns recognized_speech: Optional[str] - recognized speech from provided audio sample
-                                                    if recognized param is set to True
+        :param recognize: bool - indicates if speech from sample have to be recognized,
+                                 it is recognized in the background and saved into samplebase
+        :returns recognized_speech: Optional[str] - RECOGNITION_PENDING if recognized param is set to True
         """
         if not self.user_exists(username):
             self.create_user(username)
 
-        if(self.is_allowed_file_extension(content_type)):
-            wav_bytesIO = BytesIO(file_bytes)
-        else:
-            webm_bytesIO = BytesIO(file_bytes)
-            wav_bytesIO = convert_audio.convert_audio_to_format(
-                webm_bytesIO,  "wav")
+        wav_bytesIO = self._convert_to_wav(file_bytes, content_type)
 
-        recognized_speech = None
-        if recognize:
-            recognized_speech = speech_to_text_wrapper.recognize_speech_from_bytesIO(
-                BytesIO(wav_bytesIO.getvalue()))
+        recognized_speech = RECOGNITION_PENDING if recognize else None
 
         try:
             filename = self._get_next_filename(username, set_type)
             user_id = self._get_user_mongo_id(username)
+            wav_bytes = wav_bytesIO.getvalue()
             file_id = self._save_file_to_db(
-                filename, file_bytes=wav_bytesIO.read(), content_type=content_type)
+                filename, file_bytes=wav_bytes, content_type=self.STORED_CONTENT_TYPE)
             new_file_doc = self._get_sample_file_document_template(
                 filename, file_id, fake=fake, rec_speech=recognized_speech)
-            self.db_collection.update_one(
-                {'_id': user_id}, {'$push': {f'samples.{set_type}': new_file_doc}})
+            new_file_doc.update({'userId': user_id, 'setType': set_type,
+                                 'voiced': self._get_voiced_range(wav_bytes)})
+            sample_id = self.db_samples.insert_one(new_file_doc).inserted_id
+            if recognize:
+                self.speech_recognition_queue.submit(sample_id, file_id, wav_bytes)
+            self.feature_store.compute_features(file_id, wav_bytes)
         except errors.PyMongoError as e:
             raise DatabaseException(e)
 
         return recognized_speech
 
+    def save_new_samples(
+            self, username: str, set_type: str, files: List[Tuple[str, bytes, str]],
+            fake: bool, recognize=True,
+            ) -> List[dict]:
+        """
+        saves many samples of one user in samplebase at once, creates new user
+        if it wasn't created yet, files are converted in parallel
+        and written to database in batches
+        :param username: str - eg. 'Hugo Kołątaj'
+        :param set_type: str - one of available sample classes from config
+        :param files: list of tuples (name of uploaded file, audio file as bytes, content type)
+        :param fake: bool, True if sample belongs to the user, false if it's fake
+        :param recognize: bool - indicates if speech from samples have to be recognized,
+                                 it is recognized in the background
+        :returns results: list of dicts, one for each file in the same order:
+                          {'file': name of uploaded file, 'filename': name of saved sample or None,
+                           'recognized_speech': RECOGNITION_PENDING or None, 'error': error message or None}
+        """
+        if not self.user_exists(username):
+            self.create_user(username)
+
+        def prepare(file):
+            name, file_bytes, content_type = file
+            result = {'file': name, 'filename': None, 'recognized_speech': None, 'error': None}
+            try:
+                wav_bytes = self._convert_to_wav(file_bytes, content_type).getvalue()
+                if recognize:
+                    result['recognized_speech'] = RECOGNITION_PENDING
+            except Exception as e:
+                result['error'] = f"Could not process file '{name}': {str(e)}"
+                wav_bytes = None
+            return result, wav_bytes
+
+        with ThreadPoolExecutor(max_workers=self.BULK_UPLOAD_WORKERS) as executor:
+            prepared = list(executor.map(prepare, files))
+        to_save = [(result, wav_bytes) for result, wav_bytes in prepared if wav_bytes is not None]
+        if not to_save:
+            return [result for result, _ in prepared]
+
+        try:
+            user_id = self._get_user_mongo_id(username)
+            first_number = self._reserve_sample_numbers(user_id, set_type, count=len(to_save))
+            for i, (result, _) in enumerate(to_save):
+                result['filename'] = f"{first_number + i}.wav"
+
+            file_ids = self._save_files_to_db(
+                [(result['filename'], wav_bytes, self.STORED_CONTENT_TYPE) for result, wav_bytes in to_save])
+
+            new_file_docs = []
+            for (result, wav_bytes), file_id in zip(to_save, file_ids):
+                new_file_doc = self._get_sample_file_document_template(
+                    result['filename'], file_id, fake=fake, rec_speech=result['recognized_speech'])
+                new_file_doc.update({'userId': user_id, 'setType': set_type,
+                                     'voiced': self._get_voiced_range(wav_bytes)})
+                new_file_docs.append(new_file_doc)
+            sample_ids = self.db_samples.insert_many(new_file_docs).inserted_ids
+
+            for (_, wav_bytes), file_id, sample_id in zip(to_save, file_ids, sample_ids):
+                if recognize:
+                    self.speech_recognition_queue.submit(sample_id, file_id, wav_bytes)
+                self.feature_store.compute_features(file_id, wav_bytes)
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+
+        return [result for result, _ in prepared]
+
     def get_plot_for_sample(self, plot_type: str, set_type: str,
                             username: str, sample_name: str,
                             file_extension: str="png", **parameters) -> Tuple[Optional[BytesIO], str]:
@@ -215,12 +359,16 @@ class SampleManager:
         if audio_file_obj is None:
             return None
 
-        audio_bytes = BytesIO(audio_file_obj.read())
         if plot_type == "mfcc":
-            file_io = mfcc_plot.plot_save_mfcc_color_boxes_BytesIO(
-                audio_bytes, sample_name, file_extension)
+            try:
+                mfcc_features = self.feature_store.get_features(audio_file_obj._id, 'mfcc')
+            except errors.PyMongoError as e:
+                raise DatabaseException(e)
+            file_io = mfcc_plot.plot_save_mfcc_features_BytesIO(
+                mfcc_features, sample_name, file_extension)
             file_bytes = file_io.getvalue()
         elif plot_type == "spectrogram":
+            audio_bytes = BytesIO(audio_file_obj.read())
             file_io = spectrogram_plot.plot_save_spectrogram_BytesIO(audio_bytes, sample_name, file_extension)
             file_bytes = file_io.getvalue()
         else:
@@ -240,25 +388,37 @@ class SampleManager:
                                     it contains content_type and file_name
         """
         user_id = self._get_user_mongo_id(username)
-
-        # aggregation query to find file id
-        aggregation_pipeline = [
-            {'$match': {'_id': user_id}},
-            {'$project': {f"samples.{set_type}": 1, '_id': 0}},
-            {'$unwind': f"$samples.{set_type}"},
-            {'$match': {f"samples.{set_type}.filename": samplename}},
-            {'$project': {"id": f"$samples.{set_type}.id"}}
-        ]
+        if not user_id:
+            return None
         try:
-            temp_doc = list(self.db_collection.aggregate(aggregation_pipeline))
-            if not temp_doc:
+            sample_doc = self.db_samples.find_one(
+                {'userId': user_id, 'setType': set_type, 'filename': samplename}, {'id': 1})
+            if not sample_doc:
                 return None
-            id = list(temp_doc)[0]['id']
-            fileObj = self.db_file_storage.get(id)
+            fileObj = self.db_file_storage.get(sample_doc['id'])
         except errors.PyMongoError as e:
             raise DatabaseException(e)
         return fileObj
 
+    def get_recognized_speech(self, username: str, set_type: str, samplename: str) -> Optional[str]:
+        """
+        get speech recognized from sample
+        :param username: str - eg. 'Hugo Kołątaj'
+        :param set_type: str - one of avalible sample classes from config
+        :param samplename: str - eg. '1.wav'
+        :returns recognized_speech: Optional[str] - recognized text, RECOGNITION_PENDING
+                                                    if it is not recognized yet or None
+        """
+        user_id = self._get_user_mongo_id(username)
+        try:
+            sample_doc = self.db_samples.find_one(
+                {'userId': user_id, 'setType': set_type, 'filename': samplename}, {'recognizedSpeech': 1})
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+        if not sample_doc:
+            raise ValueError(f"Could not find sample '{samplename}' from set '{set_type}' in user '{username}' samplebase")
+        return sample_doc.get('recognizedSpeech')
+
     def add_tag_to_user(self, username: str, tag_name: str, value: str):
         """
         add tag to users' tag list
@@ -397,12 +557,13 @@ class SampleManager:
                'created': user_doc['created'],
                'tags': self.get_user_tags(username)}
 
-        # aggregation query
-        aggregation_pipeline = [
-            {'$match': {'_id': user_id}},
-            {'$project': {"train": {'$size': "$samples.train"}, "test": {"$size": "$samples.test"}, '_id': 0}},
-        ]
-        out['samples'] = list(self.db_collection.aggregate(aggregation_pipeline))
+        try:
+            out['samples'] = [{
+                set_type: self.db_samples.count_documents({'userId': user_id, 'setType': set_type})
+                for set_type in ['train', 'test']
+            }]
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
 
         return out
 
@@ -453,17 +614,19 @@ class SampleManager:
             raise ValueError(f"User '{username}' does not exist")
 
         # delete users' sample files
-        for set_type in ['test', 'train']:
-            for samplename in self.get_user_sample_list(username, set_type):
-                try:
-                    self.delete_sample(username, set_type, samplename)
-                except ValueError as e:
-                    print(str(e))
-                    continue
+        user_id = self._get_user_mongo_id(username)
+        try:
+            for sample_doc in self.db_samples.find({'userId': user_id}, {'id': 1}):
+                self.db_file_storage.delete(sample_doc['id'])
+                self.feature_store.delete_features(sample_doc['id'])
+            self.db_samples.delete_many({'userId': user_id})
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
 
         # delete users' document
         try:
-            self.db_collection.delete_one({'_id': self._get_user_mongo_id(username)})
+            self.db_collection.delete_one({'_id': user_id})
+            self._invalidate_user_numbers()
         except errors.PyMongoError as e:
             raise DatabaseException(e)
 
@@ -475,20 +638,14 @@ class SampleManager:
         :params samplename: str - eg. '1.wav'
         '''
         user_id = self._get_user_mongo_id(username)
-        aggregation_pipeline = [
-                {'$match': {'_id': user_id}},
-                {'$project': {'samples': f'$samples.{set_type}', '_id': 0}},
-                {'$unwind': '$samples'},
-                {'$match': {'samples.filename': samplename}},
-                {'$project': {'id': '$samples.id'}}
-            ]
         try:
-            out = list(self.db_collection.aggregate(aggregation_pipeline))
+            out = self.db_samples.find_one_and_delete(
+                {'userId': user_id, 'setType': set_type, 'filename': samplename}, {'id': 1})
             if not out:
                 raise ValueError(f"Could not find sample '{samplename}' from set '{set_type}' in user '{username}' samplebase")
-            file_id = out[0]['id']
-            self.db_collection.update_one({'_id': user_id}, {'$pull': {f'samples.{set_type}': {'id': file_id}}})
+            file_id = out['id']
             self.db_file_storage.delete(file_id)
+            self.feature_store.delete_features(file_id)
         except errors.PyMongoError as e:
             raise DatabaseException(e)
 
@@ -550,6 +707,14 @@ class SampleManager:
 
     #     return file_path, file_io.getvalue()
 
+    def _convert_to_wav(self, file_bytes: bytes, content_type: str) -> BytesIO:
+        """
+        converts audio file to wav, unless it already has allowed content type
+        """
+        if(self.is_allowed_file_extension(content_type)):
+            return BytesIO(file_bytes)
+        return convert_audio.convert_audio_to_format(BytesIO(file_bytes), "wav")
+
     def _get_plot_for_sample_file(self, audio_path: str, plot_type: str,
                                   file_extension: str = "png") -> Tuple[str, bytes]:
         """
@@ -605,7 +770,6 @@ class SampleManager:
         return {"name": username,
                 "nameNormalized": self._get_normalized_username(username),
                 "created": datetime.datetime.utcnow(),
-                "samples": {"train": [], "test": []},
                 "tags": []
                 }
 
@@ -617,6 +781,22 @@ class SampleManager:
         """
         return {"filename": filename, "id": id, "fake": fake, "recognizedSpeech": rec_speech}
 
+    def _get_voiced_range(self, wav_bytes: bytes) -> Optional[dict]:
+        """
+        finds the part of sample's audio with speech, without leading and trailing silence
+        :returns: {'start': first audio sample, 'end': last audio sample + 1,
+                   'totalLength': number of audio samples, 'rate': sample rate},
+                  None if the audio couldn't be decoded
+        """
+        try:
+            rate, data = read_wav(BytesIO(wav_bytes))
+        except (wave.Error, EOFError, ValueError) as e:
+            if self.show_logs:
+                print(f" * #WARNING: could not detect voice in a sample: {str(e)}")
+            return None
+        start, end = find_voiced_range(data, rate)
+        return {'start': start, 'end': end, 'totalLength': len(data), 'rate': rate}
+
     def _get_user_mongo_id(self, username: str) -> ObjectId:
         """
         needed when we want to refer to db document via mongo _id
@@ -645,6 +825,36 @@ class SampleManager:
 
         return id
 
+    def _save_files_to_db(self, files: List[Tuple[str, bytes, str]]) -> List[ObjectId]:
+        """
+        save many files to GridFS with one insert for files' documents
+        and one for all their chunks, files are stored in the same format
+        as written by GridFS.put
+        :param files: list of tuples (filename, file bytes, content type)
+        :returns: list of ids of saved files
+        """
+        file_docs, chunk_docs = [], []
+        for filename, file_bytes, content_type in files:
+            file_id = ObjectId()
+            for n, start in enumerate(range(0, len(file_bytes), self.FILE_CHUNK_SIZE)):
+                chunk_docs.append({'files_id': file_id, 'n': n,
+                                   'data': Binary(file_bytes[start:start + self.FILE_CHUNK_SIZE])})
+            file_docs.append({'_id': file_id,
+                              'filename': filename,
+                              'contentType': content_type,
+                              'length': len(file_bytes),
+                              'chunkSize': self.FILE_CHUNK_SIZE,
+                              'uploadDate': datetime.datetime.utcnow(),
+                              'md5': hashlib.md5(file_bytes).hexdigest()})
+        try:
+            # chunks go first, so a file is never visible without its content
+            if chunk_docs:
+                self.db_database.fs.chunks.insert_many(chunk_docs)
+            self.db_database.fs.files.insert_many(file_docs)
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+        return [file_doc['_id'] for file_doc in file_docs]
+
     def _get_file_from_db(self, id: ObjectId):
         """
         get file-like object from database
@@ -657,29 +867,65 @@ class SampleManager:
 
         return fileObj
 
+    def _get_sample_handle(self, id: ObjectId) -> SampleHandle:
+        """
+        get lazy, file-like handle of a sample, which gives access
+        to sample's precomputed features
+        """
+        return SampleHandle(id, self.db_file_storage, self.feature_store,
+                            db_location=(self.db_url, self.db_database.name))
+
     def _get_next_filename(self, username: str, set_type: str) -> str:
         """
-        get next valid name for new file
+        reserve next valid name for new file, it is never given twice,
+        even for concurrent uploads
         eg. if user has files '1.wav', '2.wav' in samplebase it will return '3.wav'
 
         :param username:str - eg. 'Stanisław Gołębiewski'
         :param set_type:str - 'test' or 'train'
         """
-        all_files = self.get_user_sample_list(username, set_type)
-        if not all_files:
+        user_id = self._get_user_mongo_id(username)
+        if not user_id:
             return '1.wav'
-        all_filenames = self.get_user_sample_list(username, set_type)
-        all_filenames_numbers = []
-        for filename in all_filenames:
+        try:
+            next_number = self._reserve_sample_numbers(user_id, set_type)
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+        return f"{next_number}.wav"
+
+    def _reserve_sample_numbers(self, user_id: ObjectId, set_type: str, count: int = 1) -> int:
+        """
+        atomically reserves `count` consecutive sample numbers in user's set
+        :returns: first of reserved numbers
+        """
+        counter_field = f'sampleCounters.{set_type}'
+        user_doc = self.db_collection.find_one_and_update(
+            {'_id': user_id, counter_field: {'$exists': True}}, {'$inc': {counter_field: count}},
+            projection={counter_field: 1}, return_document=ReturnDocument.AFTER)
+        if not user_doc:
+            # counter is missing for users created before counters were introduced,
+            # it is initialized once from the names of existing samples
+            self.db_collection.update_one(
+                {'_id': user_id, counter_field: {'$exists': False}},
+                {'$set': {counter_field: self._get_last_sample_number(user_id, set_type)}})
+            user_doc = self.db_collection.find_one_and_update(
+                {'_id': user_id}, {'$inc': {counter_field: count}},
+                projection={counter_field: 1}, return_document=ReturnDocument.AFTER)
+        return user_doc['sampleCounters'][set_type] - count + 1
+
+    def _get_last_sample_number(self, user_id: ObjectId, set_type: str) -> int:
+        """
+        get the biggest number used in names of user's samples, 0 if there are none
+        """
+        all_filenames_numbers = [0]
+        for sample_doc in self.db_samples.find({'userId': user_id, 'setType': set_type}, {'filename': 1}):
+            filename = sample_doc['filename']
             regex = re.match('(.+)\.(.+$)', filename)
             if not regex or not regex.group(1).isdigit():
                 raise ValueError(
                     f"Invalid filename retrived from database: {filename}, should be: '<number>.wav'")
-
             all_filenames_numbers.append(int(regex.group(1)))
-        last_file = max(all_filenames_numbers)
-        next_number = last_file + 1
-        return f"{next_number}.wav"
+        return max(all_filenames_numbers)
 
     # def file_has_proper_extension(self, filename: str, allowed_extensions: list) -> typing.Tuple[bool, str]:
     #     """
@@ -731,62 +977,294 @@ class SampleManager:
         :param multilabel: true for multilabel algorithms, false for yes/no models
         :returns: If multilabel is false, returns two dicts:
             {'username': [samplelist]}, {'username': [0/1 label list (real/fake)]}.
+        Each sample is a SampleHandle - file-like object giving access to sample's features,
+        its audio is fetched from database on first read.
         If multilabel is true, returns two lists
             [sample_list], [label_list],
         each label is the user's number (int) and won't change after the user is created.
         """
-        # TODO(mikra): return a generator object instead of a list (memory efficiency)
         if multilabel:
             samples, labels = [], []
         else:
-            samples, labels = {}, {}
+            # users without samples are also listed
+            all_usernames = self.get_all_usernames()
+            samples = {username: [] for username in all_usernames}
+            labels = {username: [] for username in all_usernames}
+
+        for username, sample, label in self.iter_samples(purpose, multilabel, preload=False):
+            if multilabel:
+                samples.append(sample)
+                labels.append(label)
+            else:
+                samples.setdefault(username, []).append(sample)
+                labels.setdefault(username, []).append(label)
+        return samples, labels
 
+    def iter_samples(self, purpose: str, multilabel: bool,
+                     batch_size: int = None, preload: bool = True) -> Iterator[Tuple[str, SampleHandle, int]]:
+        """
+        Lazily iterate over all samples from the database.
+        Samples are read with a projected, indexed cursor, samples' audio is fetched
+        in bulk, `batch_size` files per query, so memory usage does not grow
+        with the size of samplebase.
+        :param purpose: either "train" for training samples or "test" for testing
+        :param multilabel: true for multilabel algorithms, false for yes/no models,
+                           labels are created as in get_all_samples
+        :param batch_size: number of samples fetched in one database round trip,
+                           defaults to SAMPLE_BATCH_SIZE
+        :param preload: if false, audio is not fetched at all,
+                        handles will fetch it on first read
+        :returns: generator of tuples (username, SampleHandle, label)
+        """
+        batch_size = batch_size or self.SAMPLE_BATCH_SIZE
         try:
-            user_docs = self.db_collection.find({}).sort('id', 1)
-            # ^this effectively sorts all docs by timestamp created,
-            # so each user will have the same number each time
+            users = {
+                user_doc['_id']: user_doc
+                for user_doc in self.db_collection.find({}, {'name': 1, 'userNumber': 1})
+            }
+            sample_docs = self.db_samples.find(
+                {'setType': purpose}, {'userId': 1, 'id': 1, 'fake': 1}
+            ).sort([('userId', 1), ('_id', 1)]).batch_size(batch_size)
+
+            batch = []
+            for sample_doc in sample_docs:
+                user_doc = users.get(sample_doc['userId'])
+                if not user_doc:
+                    continue
+                _, labels = self._label_sample_dicts(user_doc['userNumber'], [sample_doc], multilabel)
+                if not labels:
+                    continue
+                batch.append((user_doc['name'], sample_doc['id'], labels[0]))
+                if len(batch) >= batch_size:
+                    yield from self._get_sample_handles_batch(batch, preload)
+                    batch = []
+            yield from self._get_sample_handles_batch(batch, preload)
         except errors.PyMongoError as e:
             raise DatabaseException(e)
 
-        for num, user_doc in enumerate(user_docs):
-            if not user_doc or 'samples' not in user_doc:
-                continue
-            username = user_doc['name']
-            user_samples = user_doc['samples'][purpose] if purpose in user_doc['samples'] else []
-            user_samples, user_labels = self._label_sample_dicts(num, user_samples, multilabel)
-            if multilabel:
-                samples.extend([self._get_file_from_db(sample['id']) for sample in user_samples])
-                labels.extend(user_labels)
-            else:
-                samples[username] = [self._get_file_from_db(sample['id']) for sample in user_samples]
-                labels[username] = user_labels
-        return samples, labels
+    def _get_sample_handles_batch(self, batch: List[tuple], preload: bool) -> List[Tuple[str, SampleHandle, int]]:
+        """
+        creates sample handles for a batch of (username, file id, label) tuples,
+        if `preload` is true, audio of all files is fetched with a single query
+        """
+        if not batch:
+            return []
+        files_bytes = self._get_files_bytes_from_db([file_id for _, file_id, _ in batch]) if preload else {}
+        return [
+            (username, SampleHandle(file_id, self.db_file_storage, self.feature_store,
+                                    file_bytes=files_bytes.get(file_id),
+                                    db_location=(self.db_url, self.db_database.name)), label)
+            for username, file_id, label in batch
+        ]
+
+    def _get_files_bytes_from_db(self, ids: List[ObjectId]) -> Dict[ObjectId, bytes]:
+        """
+        get contents of many GridFS files with a single query for their chunks
+        :param ids: list of GridFS file ids
+        :returns: dict {file id: file bytes}
+        """
+        chunks = self.db_database.fs.chunks.find(
+            {'files_id': {'$in': ids}}, {'files_id': 1, 'data': 1, '_id': 0}
+        ).sort([('files_id', 1), ('n', 1)])
+        out = {file_id: [] for file_id in ids}
+        for chunk in chunks:
+            out[chunk['files_id']].append(chunk['data'])
+        return {file_id: b''.join(data) for file_id, data in out.items()}
 
     def user_numbers_to_usernames(self, numbers: List[int]) -> List[str]:
         """
         Returns list of usernames of users with numbers given.
-        The ordering is based on creation timestamp (Mongo ID).
+        Each user gets a number on creation and keeps it until deleted.
         :param numbers: list of numbers to convert.
+        :raises IndexError: if there is no user with some of the numbers
         """
+        numbers_to_usernames, _ = self._get_user_numbers_map()
         try:
-            usernames = self.db_collection.find({}, ['name']).sort('id', 1)
-        except errors.PyMongoError as e:
-            raise DatabaseException(e)
-        return [usernames[num]['name'] for num in numbers]
+            return [numbers_to_usernames[num] for num in numbers]
+        except KeyError as e:
+            raise IndexError(f"There is no user with number {e}")
 
     def usernames_to_user_numbers(self, usernames: List[str]) -> List[int]:
         """
-        Returns list of positions in the list of all users,
-        for users sorted by time created.
+        Returns list of stable numbers of users with usernames given,
+        those numbers are used as labels for multilabel algorithms.
         :param usernames: list of usernames to convert.
+        :raises ValueError: if some of the users does not exist
+        """
+        _, usernames_to_numbers = self._get_user_numbers_map()
+        try:
+            return [usernames_to_numbers[username] for username in usernames]
+        except KeyError as e:
+            raise ValueError(f"User {e} does not exist")
+
+    def _get_user_numbers_map(self) -> Tuple[Dict[int, str], Dict[str, int]]:
+        """
+        get cached bidirectional mapping between user numbers and usernames,
+        the cache is loaded with a single query and reloaded when users' version changes,
+        so users created or deleted by other processes are seen too
+        :returns: two dicts: {number: username}, {username: number}
+        """
+        try:
+            version = self._get_users_version()
+            cache = self._user_numbers_cache
+            if cache is None or cache[0] != version:
+                # version is read first, so users changed meanwhile only cause another reload
+                user_docs = self.db_collection.find({}, {'name': 1, 'userNumber': 1, '_id': 0})
+                numbers_to_usernames = {doc['userNumber']: doc['name'] for doc in user_docs}
+                usernames_to_numbers = {name: num for num, name in numbers_to_usernames.items()}
+                cache = (version, numbers_to_usernames, usernames_to_numbers)
+                self._user_numbers_cache = cache
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+        return cache[1], cache[2]
+
+    def _get_users_version(self) -> int:
+        """
+        version of users collection, increased by every process which creates or deletes users
+        """
+        counter = self.db_counters.find_one({'_id': 'usersVersion'})
+        return counter['value'] if counter else 0
+
+    def _invalidate_user_numbers(self):
+        """
+        marks cached user numbers of all processes as outdated
+        """
+        self._user_numbers_cache = None
+        self.db_counters.update_one({'_id': 'usersVersion'}, {'$inc': {'value': 1}}, upsert=True)
+
+    def _get_next_user_number(self) -> int:
+        """
+        atomically reserves next free user number, numbers are never reused
+        """
+        counter = self.db_counters.find_one_and_update(
+            {'_id': 'userNumber'}, {'$inc': {'value': 1}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return counter['value'] - 1
+
+    def _setup_user_numbers(self):
+        """
+        creates indexes used by user lookups and assigns numbers
+        to users created before user numbers were introduced
         """
         try:
-            all_usernames = self.db_collection.find({}, ['name']).sort('id', 1)
+            self.db_collection.create_index([('nameNormalized', ASCENDING)])
+            self.db_collection.create_index([('userNumber', ASCENDING)], unique=True, sparse=True)
+            users_without_number = self.db_collection.find(
+                {'userNumber': {'$exists': False}}, {'_id': 1}).sort('_id', 1)
+            numbered = 0
+            for user_doc in users_without_number:
+                res = self.db_collection.update_one(
+                    {'_id': user_doc['_id'], 'userNumber': {'$exists': False}},
+                    {'$set': {'userNumber': self._get_next_user_number()}})
+                numbered += res.modified_count
+            if numbered:
+                self._invalidate_user_numbers()
         except errors.PyMongoError as e:
             raise DatabaseException(e)
 
-        all_usernames = [username['name'] for username in all_usernames]
-        return [all_usernames.index(user) for user in usernames]
+    def check_samples_format(self):
+        """
+        raises DatabaseException if samples are still stored in the old format,
+        app and job workers refuse to serve such a database until it is migrated
+        """
+        if self._has_embedded_samples():
+            raise DatabaseException(
+                "samples are stored in the old format, "
+                "run 'python scripts/migrate_samples.py' to convert the database")
+
+    def migrate_embedded_samples(self) -> int:
+        """
+        converts database from the old format, where samples were embedded
+        in users' documents stored in 'samples' collection, to separate
+        'users' and 'samples' collections, it is safe to run it many times,
+        voiced ranges are detected for samples which don't have them yet
+        :returns: number of migrated samples
+        """
+        migrated = 0
+        try:
+            if self._has_old_samples_collection():
+                if self.db_collection.find_one({}, {'_id': 1}):
+                    raise DatabaseException(
+                        "Both 'users' and old-format 'samples' collections contain users, can't migrate")
+                # 'users' collection is empty, but could be created along with its indexes
+                self.db_samples.rename('users', dropTarget=True)
+                self._invalidate_user_numbers()
+                if self.show_logs:
+                    print(" * #INFO: renamed old 'samples' collection to 'users'")
+            self._setup_samples_collection()
+
+            users = self.db_collection.find({'samples': {'$exists': True}}, {'samples': 1})
+            for user_doc in users:
+                for set_type, sample_docs in user_doc['samples'].items():
+                    for sample_doc in sample_docs:
+                        new_doc = self._get_sample_file_document_template(
+                            sample_doc['filename'], sample_doc['id'],
+                            fake=sample_doc.get('fake', False),
+                            rec_speech=sample_doc.get('recognizedSpeech', ""))
+                        self.db_samples.update_one(
+                            {'userId': user_doc['_id'], 'setType': set_type, 'filename': sample_doc['filename']},
+                            {'$setOnInsert': new_doc}, upsert=True)
+                        migrated += 1
+                self.db_collection.update_one({'_id': user_doc['_id']}, {'$unset': {'samples': ""}})
+                if self.show_logs:
+                    print(f" * #INFO: migrated samples of user '{user_doc['_id']}'")
+            self._backfill_voiced_ranges()
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+
+        self._setup_user_numbers()
+        return migrated
+
+    def _backfill_voiced_ranges(self):
+        """
+        sets 'voiced' field of samples saved before voice activity was detected (eg. migrated ones)
+        """
+        backfilled = 0
+        for sample_doc in self.db_samples.find({'voiced': {'$exists': False}}, {'id': 1}):
+            try:
+                voiced = self._get_voiced_range(self.db_file_storage.get(sample_doc['id']).read())
+            except NoFile:
+                voiced = None
+            self.db_samples.update_one({'_id': sample_doc['_id']}, {'$set': {'voiced': voiced}})
+            backfilled += 1
+        if backfilled and self.show_logs:
+            print(f" * #INFO: detected voiced ranges of {backfilled} samples")
+
+    def _has_embedded_samples(self) -> bool:
+        """
+        check if database still stores samples embedded in users' documents
+        """
+        try:
+            return self._has_old_samples_collection() or bool(
+                self.db_collection.find_one({'samples': {'$exists': True}}, {'_id': 1}))
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
+
+    def _has_old_samples_collection(self) -> bool:
+        """
+        check if 'samples' collection contains users' documents,
+        documents in a collection are never mixed, so it is enough to check the first one
+        """
+        doc = self.db_samples.find_one({}, {'nameNormalized': 1})
+        return bool(doc) and 'nameNormalized' in doc
+
+    def _setup_samples_collection(self):
+        """
+        creates indexes used by samples' lookups,
+        and GridFS index needed by files saved in bulk
+        """
+        try:
+            self.db_database.fs.chunks.create_index(
+                [('files_id', ASCENDING), ('n', ASCENDING)], unique=True)
+            self.db_samples.create_index(
+                [('userId', ASCENDING), ('setType', ASCENDING), ('filename', ASCENDING)], unique=True)
+            self.db_samples.create_index(
+                [('setType', ASCENDING), ('userId', ASCENDING), ('_id', ASCENDING)])
+            self.db_samples.create_index(
+                [('recognizedSpeech', ASCENDING)],
+                partialFilterExpression={'recognizedSpeech': RECOGNITION_PENDING})
+        except errors.PyMongoError as e:
+            raise DatabaseException(e)
 
 
 class UsernameException(Exception):
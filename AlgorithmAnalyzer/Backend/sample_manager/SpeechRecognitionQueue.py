@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from threading import Lock
+
+import gridfs
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+from pymongo import errors
+
+from utils.db_clients import get_client, get_file_storage
+from utils.speech_recognition_wrapper.recognizers import SpeechRecognizer
+
+# value of 'recognizedSpeech' field of samples waiting for recognition
+RECOGNITION_PENDING = "pending"
+
+
+class SpeechRecognitionQueue:
+    """
+    Pool of background threads filling 'recognizedSpeech' field of samples,
+    so uploads don't wait for (slow, external) speech recognition.
+    Samples waiting for recognition have the field set to RECOGNITION_PENDING.
+    Before a sample is recognized it's claimed with a lease ('recognitionLease' field),
+    so when many processes queue the same sample, it's recognized only once.
+    """
+
+    def __init__(self, db_url: str, db_name: str, recognizer: SpeechRecognizer,
+                 workers: int = 2, show_logs: bool = True, lease_seconds: int = 300):
+        """
+        :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
+        :param db_name: str - name of database with samples
+        :param recognizer: SpeechRecognizer - engine used to recognize speech
+        :param workers: int - number of recognizing threads
+        :param show_logs: bool - used to suppress log messages
+        :param lease_seconds: int - after this many seconds a claimed sample, which still isn't recognized
+                              (eg. its process died), can be claimed again
+        """
+        self.db_url = db_url
+        self.db_name = db_name
+        self.recognizer = recognizer
+        self.show_logs = show_logs
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = set()
+        self._futures_lock = Lock()
+
+    # collections are resolved on each access, so a queue created before fork uses the client of current process
+    @property
+    def db_samples(self):
+        return get_client(self.db_url)[self.db_name].samples
+
+    @property
+    def db_file_storage(self) -> gridfs.GridFS:
+        return get_file_storage(self.db_url, self.db_name)
+
+    def submit(self, sample_id: ObjectId, file_id: ObjectId, wav_bytes: bytes = None):
+        """
+        queue recognition of sample's speech
+        :param sample_id: ObjectId - id of sample's document
+        :param file_id: ObjectId - id of sample's audio file in GridFS
+        :param wav_bytes: bytes - sample's audio, if not given it will be read from GridFS
+        """
+        future = self._executor.submit(self._recognize, sample_id, file_id, wav_bytes)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard_future)
+
+    def requeue_pending(self) -> int:
+        """
+        queue all samples still waiting for recognition, which aren't claimed by any process,
+        eg. the ones left after restart of the app, it's called once when the app starts
+        :returns: number of queued samples
+        """
+        pending = list(self.db_samples.find(self._claimable_query(), {'id': 1}))
+        for sample_doc in pending:
+            self.submit(sample_doc['_id'], sample_doc['id'])
+        return len(pending)
+
+    def wait(self, timeout: float = None):
+        """
+        block until all queued recognitions are finished
+        :param timeout: float - maximal number of seconds to wait
+        """
+        with self._futures_lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+
+    def _discard_future(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def _claimable_query(self, sample_id: ObjectId = None) -> dict:
+        query = {
+            'recognizedSpeech': RECOGNITION_PENDING,
+            '$or': [{'recognitionLease': None}, {'recognitionLease': {'$lt': datetime.utcnow()}}]
+        }
+        if sample_id is not None:
+            query['_id'] = sample_id
+        return query
+
+    def _claim(self, sample_id: ObjectId) -> bool:
+        """
+        atomically claims a pending sample for recognition
+        :returns: True if the sample was claimed, False if it's claimed by another process,
+                  recognized or deleted
+        """
+        lease = datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+        doc = self.db_samples.find_one_and_update(
+            self._claimable_query(sample_id), {'$set': {'recognitionLease': lease}}, projection={'_id': 1})
+        return doc is not None
+
+    def _recognize(self, sample_id: ObjectId, file_id: ObjectId, wav_bytes: bytes = None):
+        """
+        recognizes speech and saves it in sample's document,
+        unless the sample was deleted, recognized or claimed by another process in the meantime
+        """
+        try:
+            if not self._claim(sample_id):
+                return
+        except errors.PyMongoError as e:
+            if self.show_logs:
+                print(f" * #WARNING: could not claim sample '{sample_id}' for speech recognition: {str(e)}")
+            return
+        try:
+            if wav_bytes is None:
+                wav_bytes = self.db_file_storage.get(file_id).read()
+            recognized_speech = self.recognizer.recognize(wav_bytes)
+        except NoFile:
+            # sample was deleted before it was recognized
+            return
+        except Exception as e:
+            if self.show_logs:
+                print(f" * #WARNING: could not recognize speech of sample '{sample_id}': {str(e)}")
+            recognized_speech = None
+        try:
+            self.db_samples.update_one(
+                {'_id': sample_id, 'recognizedSpeech': RECOGNITION_PENDING},
+                {'$set': {'recognizedSpeech': recognized_speech}, '$unset': {'recognitionLease': ''}})
+        except errors.PyMongoError as e:
+            if self.show_logs:
+                print(f" * #WARNING: could not save recognized speech of sample '{sample_id}': {str(e)}")
@@ -1,13 +1,20 @@
 import unittest
 import abc
+import datetime
 import glob
 import hashlib
+import pickle
+from unittest import mock
 
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 from gridfs import GridOut
 
-from sample_manager.SampleManager import UsernameException
+from sample_manager.SampleManager import SampleManager, UsernameException, DatabaseException
+from sample_manager.SampleHandle import SampleHandle
+from sample_manager.SpeechRecognitionQueue import RECOGNITION_PENDING
+from utils.speech_recognition_wrapper.recognizers import SpeechRecognizer
+from utils import db_clients
 from main import app
 
 
@@ -45,6 +52,7 @@ class TestSaveToDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
     def setUpClass(self):
         super().setUpClass()
         self.db_collection = self.sm.db_collection
+        self.db_samples = self.sm.db_samples
         self.db_fs = self.sm.db_file_storage
         self.db_tags = self.sm.db_tags
 
@@ -79,13 +87,15 @@ class TestSaveToDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.assertTrue(
             bool(db_out), "Query to database should not return empty result")
 
-        # new user document should contain sample in train set
-        train_samples = db_out["samples"]["train"]
+        # sample document should be created in train set
+        train_samples = list(self.db_samples.find({'userId': db_out['_id'], 'setType': "train"}))
         self.assertTrue(
             train_samples, "Could not find added sample in train set")
 
-        # new user document should contain recognizedSpeech field
-        self.assertTrue(train_samples[0]["recognizedSpeech"],
+        # speech should be recognized in the background
+        self.sm.speech_recognition_queue.wait()
+        recognized_speech = self.sm.get_recognized_speech(username, "train", "1.wav")
+        self.assertTrue(recognized_speech and recognized_speech != RECOGNITION_PENDING,
                         "Expected recognizedSpeech field to not be empty")
 
         with open(self.TEST_AUDIO_WAV_PATH, 'rb') as f:
@@ -99,9 +109,84 @@ class TestSaveToDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
 
         # should add another sample to train set
         db_out = self.db_collection.find_one({'name': username})
-        train_set = db_out["samples"]["train"]
+        train_set = list(self.db_samples.find({'userId': db_out['_id'], 'setType': "train"}))
         self.assertEqual(len(train_set), 2,
                          f"Expected to find 2 samples in train set but found {len(train_set)} instead")
+        self.assertEqual([sample['filename'] for sample in train_set], ['1.wav', '2.wav'],
+                         "Samples should be named with consecutive numbers")
+
+    def test_fnc_save_new_sample_corrupt_wav(self):
+        username = "Corrupt Wav"
+        # sample is saved even if its audio can't be decoded, features are computed on request
+        self.sm.save_new_sample(username, "train", b"RIFF" + b"\0" * 40, "audio/wav", fake=False, recognize=False)
+        self.assertEqual(self.sm.get_user_sample_list(username, "train"), ["1.wav"])
+
+    def test_fnc_save_new_samples(self):
+        username = "Bulk User"
+        with open(self.TEST_AUDIO_WAV_PATH, 'rb') as f:
+            wav_bytes = f.read()
+        with open(self.TEST_AUDIO_WEBM_PATH, 'rb') as f:
+            webm_bytes = f.read()
+        files = [("a.wav", wav_bytes, "audio/wav"),
+                 ("b.webm", webm_bytes, "audio/webm"),
+                 ("broken.webm", b"not an audio file", "audio/webm"),
+                 ("c.wav", wav_bytes, "audio/wav")]
+
+        out = self.sm.save_new_samples(username, "train", files, fake=False, recognize=False)
+
+        # there should be a result for every file, in the same order
+        self.assertEqual([result['file'] for result in out], [name for name, _, _ in files])
+        self.assertTrue(out[2]['error'], "Broken file should be reported as an error")
+        self.assertEqual([result['filename'] for result in out], ['1.wav', '2.wav', None, '3.wav'],
+                         "Valid files should be saved with consecutive names")
+
+        # saved samples should be readable like the ones saved one by one
+        self.assertEqual(self.sm.get_user_sample_list(username, "train"), ['1.wav', '2.wav', '3.wav'])
+        self.assertEqual(self.sm.get_samplefile(username, "train", '3.wav').read(), wav_bytes,
+                         "Sample saved in bulk differs from the orginal one")
+        self.assertEqual(self.sm._get_next_filename(username, "train"), '4.wav')
+
+    def test_fnc_recognize_speech_in_background(self):
+        class FailingRecognizer(SpeechRecognizer):
+            def recognize(self, wav_bytes):
+                raise ValueError("recognition failed")
+
+        username = "Recognition User"
+        queue = self.sm.speech_recognition_queue
+        with open(self.TEST_AUDIO_WAV_PATH, 'rb') as f:
+            file_bytes = f.read()
+
+        out = self.sm.save_new_sample(username, "train", file_bytes, "audio/wav", fake=False)
+        self.assertEqual(out, RECOGNITION_PENDING, "Speech should not be recognized during upload")
+        queue.wait()
+        self.assertEqual(self.sm.get_recognized_speech(username, "train", "1.wav"), queue.recognizer.recognize(b""),
+                         "Recognized speech should be saved after recognition is finished")
+
+        # failed recognition should not leave sample pending
+        recognizer, queue.recognizer = queue.recognizer, FailingRecognizer()
+        try:
+            self.sm.save_new_sample(username, "train", file_bytes, "audio/wav", fake=False)
+            queue.wait()
+        finally:
+            queue.recognizer = recognizer
+        self.assertIsNone(self.sm.get_recognized_speech(username, "train", "2.wav"))
+
+        # samples claimed by another process shouldn't be recognized again
+        lease = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+        self.db_samples.update_one({'filename': "2.wav"}, {'$set': {'recognizedSpeech': RECOGNITION_PENDING,
+                                                                    'recognitionLease': lease}})
+        self.assertEqual(queue.requeue_pending(), 0)
+        queue.submit(self.db_samples.find_one({'filename': "2.wav"})['_id'], None)
+        queue.wait()
+        self.assertEqual(self.sm.get_recognized_speech(username, "train", "2.wav"), RECOGNITION_PENDING)
+
+        # samples left pending, eg. after restart, should be recognized again once their lease expires
+        self.db_samples.update_one({'filename': "2.wav"}, {'$set': {'recognitionLease': datetime.datetime(2000, 1, 1)}})
+        self.assertEqual(queue.requeue_pending(), 1)
+        queue.wait()
+        self.assertEqual(self.sm.get_recognized_speech(username, "train", "2.wav"), recognizer.recognize(b""))
+
+        self.assertRaises(ValueError, self.sm.get_recognized_speech, username, "train", "100.wav")
 
     def test_fnc_save_file_to_db(self):
         with open(self.TEST_AUDIO_WAV_PATH, 'rb') as f:
@@ -251,6 +336,42 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.assertTrue(self.sm.is_db_available(),
                         "Database should be available but is_db_available() returned 'False'")
 
+    def test_fnc_shared_db_client(self):
+        # all storage classes should use the same pool of connections
+        jsp = self.config['JOB_STATUS_PROVIDER']
+        self.assertIs(self.sm.db_client, jsp._db_client,
+                      "SampleManager and JobStatusProvider should share MongoClient")
+
+        # status updaters should reuse one job status provider
+        updater_factory = self.config['JOB_STATUS_UPDATER_FACTORY']
+        self.assertIs(updater_factory(job_id='1')._jsp, updater_factory(job_id='2')._jsp,
+                      "Status updaters should share JobStatusProvider")
+
+    def test_fnc_db_client_after_fork(self):
+        # managers created before fork (eg. in config) should use clients of the process they are used in
+        parent_client = self.sm.db_client
+        # clients of the simulated child process are dropped after the test, parent's clients are kept
+        with mock.patch('utils.db_clients.os.getpid', return_value=-1), \
+                mock.patch.dict(db_clients._clients), mock.patch.dict(db_clients._file_storages), \
+                mock.patch.object(db_clients, '_clients_pid', db_clients._clients_pid):
+            self.assertIsNot(self.sm.db_client, parent_client,
+                             "SampleManager should not use MongoClient of parent process")
+            self.assertIs(self.sm.db_client, self.config['JOB_STATUS_PROVIDER']._db_client,
+                          "SampleManager and JobStatusProvider should share MongoClient after fork")
+            self.assertIs(self.sm.feature_store.db_file_storage, self.sm.db_file_storage,
+                          "SampleManager and FeatureStore should share GridFS after fork")
+
+    def test_fnc_configure_clients(self):
+        # clients opened before configuration (eg. by managers created in config) should be replaced
+        parent_client = self.sm.db_client
+        with mock.patch.dict(db_clients._client_options), mock.patch.dict(db_clients._clients), \
+                mock.patch.dict(db_clients._file_storages), mock.patch.object(parent_client, 'close') as close:
+            db_clients.configure_clients(max_pool_size=10)
+            close.assert_called_once_with()
+            self.assertIsNot(self.sm.db_client, parent_client,
+                             "SampleManager should use MongoClient created with new options")
+            self.assertEqual(db_clients._client_options['maxPoolSize'], 10)
+
     def test_fnc_get_all_usernames(self):
         out = self.sm.get_all_usernames()
 
@@ -330,7 +451,7 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
     def test_fnc_get_file_from_db(self):
         user_1_doc = self.db_collection.find_one(
             {'name': self.test_usernames[0]})
-        user_1_sample = user_1_doc["samples"]["train"][0]
+        user_1_sample = self.sm.db_samples.find_one({'userId': user_1_doc['_id'], 'setType': "train"})
 
         # should return GridOut
         out = self.sm._get_file_from_db(user_1_sample["id"])
@@ -390,6 +511,18 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.assertEqual(out, '11.wav',
                          f"Next proper name is 11.wav', got '{out}' instead")
 
+        # reserved name should not be given again
+        out = self.sm._get_next_filename(self.test_usernames[1], "test")
+        self.assertEqual(out, '12.wav',
+                         f"Name '11.wav' is already reserved, expected '12.wav', got '{out}' instead")
+
+        # counter of users created before counters existed should continue from their last sample
+        user_id = self.sm._get_user_mongo_id(self.test_usernames[0])
+        self.db_collection.update_one({'_id': user_id}, {'$unset': {'sampleCounters': ""}})
+        out = self.sm._get_next_filename(self.test_usernames[0], "test")
+        self.assertEqual(out, '3.wav',
+                         f"Counter should be initialized from existing samples, expected '3.wav', got '{out}' instead")
+
     def test_fnc_label_sample_dicts(self):
         user_num = 3
         dicts = [{'id': k} for k in range(5)]
@@ -430,7 +563,8 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
                          )
 
         for sample in samples:
-            self.assertEqual(type(sample), GridOut, 'Each sample should have GridOut type.')
+            self.assertEqual(type(sample), SampleHandle, 'Each sample should have SampleHandle type.')
+            self.assertGreater(len(sample.read()), 0, 'Each sample should contain non-empty audio bytes.')
         kwargs.update({'multilabel': False})
         samples, labels = self.sm.get_all_samples(**kwargs)
         self.assertEqual((type(samples), type(labels)), (dict, dict),
@@ -451,6 +585,90 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
                               'Each label can be either 0 or 1.'
                               )
 
+    def test_fnc_iter_samples(self):
+        samples, labels = self.sm.get_all_samples(purpose='test', multilabel=False, sample_type='wav')
+
+        # iterating in small batches should give the same samples as get_all_samples
+        out = list(self.sm.iter_samples(purpose='test', multilabel=False, batch_size=3))
+        self.assertEqual(len(out), sum(len(samples[name]) for name in samples),
+                         'iter_samples should yield every sample exactly once')
+        for name in self.test_usernames:
+            self.assertEqual([sample.id for user, sample, _ in out if user == name],
+                             [sample.id for sample in samples[name]],
+                             'iter_samples should keep the order of samples')
+            self.assertEqual([label for user, _, label in out if user == name], labels[name],
+                             'iter_samples should label samples as get_all_samples')
+
+        # preloaded audio should be the same as stored in GridFS
+        for _, sample, _ in out:
+            self.assertEqual(sample.read(), self.sm._get_file_from_db(sample.id).read(),
+                             'Preloaded sample bytes differ from the ones in file storage')
+
+    def test_fnc_pickle_sample_handle(self):
+        # handles sent to worker processes should give the same audio and features
+        for preload in (True, False):
+            _, sample, _ = next(self.sm.iter_samples(purpose='train', multilabel=False, preload=preload))
+            out = pickle.loads(pickle.dumps(sample))
+            self.assertEqual(out.id, sample.id, 'Unpickled handle should point to the same file')
+            self.assertEqual(out.read(), sample.read(), 'Unpickled handle should give the same audio')
+            self.assertTrue((out.get_features('normalized') == sample.get_features('normalized')).all(),
+                            'Unpickled handle should give the same features')
+
+    def test_fnc_compute_features_on_save(self):
+        user_doc = self.db_collection.find_one({'name': self.test_usernames[0]})
+        file_id = self.sm.db_samples.find_one({'userId': user_doc['_id'], 'setType': "train"})["id"]
+
+        # every default feature should be stored right after sample was saved
+        for feature_type in self.sm.feature_store.DEFAULT_FEATURES:
+            db_out = self.sm.feature_store.db_features.find_one({'fileId': file_id, 'type': feature_type})
+            self.assertTrue(db_out, f"Could not find '{feature_type}' features of saved sample")
+
+    def test_fnc_voiced_range_on_save(self):
+        user_doc = self.db_collection.find_one({'name': self.test_usernames[0]})
+        sample_doc = self.sm.db_samples.find_one({'userId': user_doc['_id'], 'setType': "train"})
+        voiced = sample_doc['voiced']
+        self.assertTrue(voiced, "Voiced range of saved sample should be recorded")
+        self.assertTrue(0 <= voiced['start'] < voiced['end'] <= voiced['totalLength'],
+                        f"Unexpected voiced range of saved sample: {voiced}")
+
+        # trimmed vectors are stored next to the untrimmed ones
+        store = self.sm.feature_store
+        out = store.get_features(sample_doc['id'], 'normalized', trim=True)
+        self.assertEqual(out.shape, (store.DEFAULT_FEATURES['normalized']['length'],),
+                         f"Unexpected shape of trimmed normalized features: {out.shape}")
+        self.assertEqual(store.db_features.count_documents({'fileId': sample_doc['id'], 'type': 'normalized'}), 2,
+                         "Trimmed normalized features should be stored next to the untrimmed ones")
+
+    def test_fnc_get_sample_features(self):
+        user_doc = self.db_collection.find_one({'name': self.test_usernames[0]})
+        file_id = self.sm.db_samples.find_one({'userId': user_doc['_id'], 'setType': "train"})["id"]
+        store = self.sm.feature_store
+
+        out = store.get_features(file_id, 'normalized')
+        self.assertEqual(out.shape, (store.DEFAULT_FEATURES['normalized']['length'],),
+                         f"Unexpected shape of normalized features: {out.shape}")
+
+        # changing parameters should compute only new features, old ones are kept
+        count_before = store.db_features.count_documents({'fileId': file_id, 'type': 'mfcc'})
+        out = store.get_features(file_id, 'mfcc', nfft=2048, numcep=20)
+        self.assertEqual(out.shape[1], 20, f"Expected 20 cepstral coefficients, got {out.shape[1]}")
+        count_after = store.db_features.count_documents({'fileId': file_id, 'type': 'mfcc'})
+        self.assertEqual(count_after, count_before + 1,
+                         "Features with new parameters should be stored next to the old ones")
+
+        # features stored by an older version of extraction should be computed again
+        old_key = '{"decoder": 2, "length": 16384}'
+        current_key = store._get_params_key(store.DEFAULT_FEATURES['normalized'])
+        store.db_features.update_one({'fileId': file_id, 'type': 'normalized', 'paramsKey': current_key},
+                                     {'$set': {'paramsKey': old_key}})
+        store.get_features(file_id, 'normalized')
+        self.assertEqual(store.db_features.count_documents({'fileId': file_id, 'paramsKey': current_key}), 1,
+                         "Features of an older version should not be used")
+        store.db_features.delete_many({'fileId': file_id, 'paramsKey': old_key})
+
+        # should throw ValueError for unknown feature type
+        self.assertRaises(ValueError, store.get_features, file_id, 'unknown_feature')
+
     def test_fnc_get_user_tags(self):
         # get and check
         out = self.sm.get_user_tags(self.test_usernames[0])
@@ -530,6 +748,55 @@ class TestReadFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.assertEqual(out["gender"], [{'value': 'male', 'count': 1}])
 
 
+class TestMigrateEmbeddedSamples(BaseAbstractSampleManagerTestsClass):
+    """ tests for migration of samples embedded in users' documents """
+
+    @classmethod
+    def setUpClass(self):
+        super().setUpClass()
+        self.migration_db_name = self.db_name + "_migration"
+        with open(self.TEST_AUDIO_WAV_PATH, 'rb') as f:
+            self.test_file_bytes = f.read()
+
+    @classmethod
+    def tearDownClass(self):
+        MongoClient(self.sm.db_url).drop_database(self.migration_db_name)
+        super().tearDownClass()
+
+    def test_fnc_migrate_embedded_samples(self):
+        sm = SampleManager(self.sm.db_url, self.migration_db_name, show_logs=False)
+        file_id = sm._save_file_to_db("1.wav", self.test_file_bytes)
+
+        # user document in the old format
+        old_doc = sm._get_sample_class_document_template("Old User")
+        old_doc['samples'] = {
+            'train': [sm._get_sample_file_document_template("1.wav", file_id, fake=False)],
+            'test': []
+        }
+        sm.db_samples.insert_one(old_doc)
+        self.assertTrue(sm._has_embedded_samples(), "Old format of samplebase should be detected")
+        with self.assertRaises(DatabaseException):
+            sm.check_samples_format()
+
+        self.assertEqual(sm.migrate_embedded_samples(), 1, "Expected exactly one sample to be migrated")
+        self.assertFalse(sm._has_embedded_samples(), "Samplebase should be in the new format after migration")
+        sm.check_samples_format()
+        self.assertEqual(sm.get_all_usernames(), ["Old User"])
+        self.assertEqual(sm.get_user_sample_list("Old User", "train"), ["1.wav"])
+        self.assertEqual(sm.get_samplefile("Old User", "train", "1.wav").read(), self.test_file_bytes,
+                         "Migrated sample should point to the same audio file")
+        self.assertEqual(sm.usernames_to_user_numbers(["Old User"]), [0],
+                         "Migrated user should be given a user number")
+        voiced = sm.db_samples.find_one({})['voiced']
+        self.assertIsNotNone(voiced, "Voiced range of migrated sample should be detected")
+        self.assertEqual(voiced, sm._get_voiced_range(self.test_file_bytes),
+                         "Voiced range of migrated sample should be detected")
+
+        # running migration again should not change anything
+        self.assertEqual(sm.migrate_embedded_samples(), 0, "Second migration should not migrate any sample")
+        self.assertEqual(sm.db_samples.count_documents({}), 1)
+
+
 class TestDeleteFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
     """ tests for functions realted to deleting from database """
 
@@ -554,10 +821,15 @@ class TestDeleteFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.sm.save_new_sample(
             user, set_type, self.test_file_bytes, "audio/wav", fake=False, recognize=False)
 
+        file_id = self.sm.get_samplefile(user, set_type, '1.wav')._id
         self.sm.delete_sample(user, set_type, '1.wav')
         all_train = self.sm.get_user_sample_list(user, set_type)
         self.assertEqual(all_train, ['2.wav'])
 
+        # features of deleted sample should be deleted as well
+        self.assertFalse(self.sm.feature_store.db_features.find_one({'fileId': file_id}),
+                         "Features of deleted sample should be removed from feature store")
+
         self.assertRaises(ValueError, self.sm.delete_sample, user, set_type, '1.wav')
 
     def test_fnc_delete_user(self):
@@ -582,6 +854,40 @@ class TestDeleteFromDatabaseFunctions(BaseAbstractSampleManagerTestsClass):
         self.assertRaises(ValueError, self.sm.delete_user, user_1)
         self.assertRaises(ValueError, self.sm.delete_user, user_2)
 
+    def test_fnc_user_numbers_stable_after_delete(self):
+        users = ["Number User 1", "Number User 2", "Number User 3"]
+        for user in users:
+            self.sm.create_user(user)
+        numbers = self.sm.usernames_to_user_numbers(users)
+        self.assertEqual(self.sm.user_numbers_to_usernames(numbers), users,
+                         "Mapping user numbers back should give the same usernames")
+
+        # deleting a user should not change numbers of other users
+        self.sm.delete_user(users[0])
+        self.assertEqual(self.sm.usernames_to_user_numbers(users[1:]), numbers[1:],
+                         "User numbers should not change after deleting another user")
+        self.assertRaises(ValueError, self.sm.usernames_to_user_numbers, users[:1])
+        self.assertRaises(IndexError, self.sm.user_numbers_to_usernames, numbers[:1])
+
+        # numbers of deleted users should not be reused
+        self.sm.create_user(users[0])
+        new_number = self.sm.usernames_to_user_numbers(users[:1])[0]
+        self.assertNotIn(new_number, numbers, "User numbers should never be reused")
+
+    def test_fnc_user_numbers_of_other_process(self):
+        # a manager of another process, with its own cache of user numbers
+        other_sm = SampleManager(self.sm.db_url, self.db_name, show_logs=False)
+        user = "Other Process User"
+        self.sm.create_user(user)
+        number = other_sm.usernames_to_user_numbers([user])[0]
+
+        self.sm.delete_user(user)
+        self.assertRaises(ValueError, other_sm.usernames_to_user_numbers, [user])
+        self.assertRaises(IndexError, other_sm.user_numbers_to_usernames, [number])
+
+        self.sm.create_user(user)
+        self.assertEqual(other_sm.user_numbers_to_usernames(self.sm.usernames_to_user_numbers([user])), [user])
+
     def test_fnc_delete_tag(self):
         user = "Delete Tag User"
         tag_1_name = "tag-1"
@@ -641,7 +947,7 @@ class TestSampleManager(BaseAbstractSampleManagerTestsClass):
     def test_fnc_get_sample_class_document_template(self):
         out = self.sm._get_sample_class_document_template("user")
         expected_fields = set(
-            ['name', 'nameNormalized', 'created', 'samples', 'tags'])
+            ['name', 'nameNormalized', 'created', 'tags'])
 
         self.assertEqual(set(out.keys()), expected_fields,
                          f"Expected fields: {expected_fields}, but got {out.keys()}")
@@ -0,0 +1,76 @@
+"""
+This script measures latency of SampleManager's read paths
+on a synthetic samplebase.
+Usage:
+    python benchmark_samples.py --users=1000 --samples=100 --queries=2000
+
+A separate database is created and dropped after the benchmark.
+All synthetic samples point to the same small audio file,
+so only metadata lookups are measured.
+"""
+
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+os.sys.path.append('..')
+from config import BaseConfig   # noqa
+from sample_manager.SampleManager import SampleManager   # noqa
+
+parser = argparse.ArgumentParser(
+    description="Measure latency of samplebase read paths.",
+    usage="pipenv shell && python benchmark_samples.py --users=1000 --samples=100"
+)
+parser.add_argument('--users', help='Number of synthetic users.', type=int, default=1000)
+parser.add_argument('--samples', help='Number of samples per user.', type=int, default=100)
+parser.add_argument('--queries', help='Number of measured calls of each method.', type=int, default=2000)
+parser.add_argument('--db', help='Name of the temporary database.', type=str, default='samplebase_benchmark')
+
+args = parser.parse_args()
+
+db_url = f"{BaseConfig.DATABASE_URL}:{BaseConfig.DATABASE_PORT}"
+sm = SampleManager(db_url, args.db, show_logs=False)
+sm.db_client.drop_database(args.db)
+sm = SampleManager(db_url, args.db, show_logs=False)
+
+print(f"populate {args.users} users with {args.samples} samples each...")
+file_id = sm._save_file_to_db("1.wav", b"RIFF" + bytes(1024), content_type="audio/wav")
+usernames = [f"Benchmark User {i}" for i in range(args.users)]
+for username in usernames:
+    user_id = sm.create_user(username)
+    sample_docs = []
+    for set_type in ['train', 'test']:
+        for i in range(args.samples // 2):
+            sample_doc = sm._get_sample_file_document_template(f"{i + 1}.wav", file_id, fake=bool(i % 2))
+            sample_doc.update({'userId': user_id, 'setType': set_type})
+            sample_docs.append(sample_doc)
+    if sample_docs:
+        sm.db_samples.insert_many(sample_docs)
+
+
+def random_sample():
+    return random.choice(usernames), random.choice(['train', 'test']), f"{random.randint(1, args.samples // 2)}.wav"
+
+
+benchmarks = {
+    'sample_exists': lambda: sm.sample_exists(*random_sample()),
+    'get_samplefile': lambda: sm.get_samplefile(*random_sample()),
+    'get_user_sample_list': lambda: sm.get_user_sample_list(random.choice(usernames), 'train'),
+    'get_user_summary': lambda: sm.get_user_summary(random.choice(usernames)),
+}
+
+print(f"{'method':<24}{'p50 [ms]':>10}{'p99 [ms]':>10}{'max [ms]':>10}")
+for name, call in benchmarks.items():
+    times = []
+    for _ in range(args.queries):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    p50, p99 = np.percentile(times, [50, 99])
+    print(f"{name:<24}{p50:>10.3f}{p99:>10.3f}{max(times):>10.3f}")
+
+sm.db_client.drop_database(args.db)
+print("fin...")
@@ -0,0 +1,77 @@
+"""
+This script measures throughput of decoding wav files with
+preprocessing.fast_wav_read, compared with the previous implementation,
+which read 64 frames at a time into a list of floats.
+Usage:
+    python benchmark_wav_decode.py --seconds=5 --repeats=20
+
+Synthetic noise is decoded, for each sample width.
+"""
+
+import argparse
+import os
+import time
+import wave
+from io import BytesIO
+
+import numpy as np
+
+os.sys.path.append('..')
+from algorithms.algorithms.preprocessing import fast_wav_read   # noqa
+
+parser = argparse.ArgumentParser(
+    description="Measure throughput of wav decoding.",
+    usage="pipenv shell && python benchmark_wav_decode.py --seconds=5"
+)
+parser.add_argument('--seconds', help='Length of decoded recordings.', type=float, default=5)
+parser.add_argument('--rate', help='Sample rate of decoded recordings.', type=int, default=16000)
+parser.add_argument('--repeats', help='Number of measured decodes of each recording.', type=int, default=20)
+
+args = parser.parse_args()
+
+
+def legacy_wav_read(file, chunk_size=64):
+    # np.fromstring is replaced with np.frombuffer (same semantics), as it's removed from new numpy
+    file = wave.open(file, 'rb')
+    data = []
+    frame = True
+    while frame:
+        frame = file.readframes(chunk_size)
+        tmp_data = np.frombuffer(frame, dtype='uint8')
+        data.extend((tmp_data + 128)/255.)
+    return data
+
+
+def make_wav(sample_width: int, channels: int) -> bytes:
+    frames = int(args.seconds * args.rate)
+    noise = np.random.randint(0, 256, size=frames * channels * sample_width, dtype=np.uint8)
+    buffer = BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(args.rate)
+        wav_file.writeframes(noise.tobytes())
+    return buffer.getvalue()
+
+
+def measure(decode, wav_bytes: bytes) -> float:
+    """
+    :returns: median time of a decode in ms
+    """
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        decode(BytesIO(wav_bytes))
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+print(f"{'format':<16}{'legacy [ms]':>12}{'new [ms]':>10}{'speedup':>10}{'new [MB/s]':>12}")
+for sample_width, channels in [(1, 1), (2, 1), (2, 2), (3, 1), (4, 1)]:
+    wav_bytes = make_wav(sample_width, channels)
+    legacy = measure(legacy_wav_read, wav_bytes)
+    new = measure(fast_wav_read, wav_bytes)
+    throughput = len(wav_bytes) / 2 ** 20 / (new / 1000)
+    name = f"{8 * sample_width}-bit x{channels}"
+    print(f"{name:<16}{legacy:>12.2f}{new:>10.2f}{legacy / new:>9.1f}x{throughput:>12.1f}")
+print("fin...")
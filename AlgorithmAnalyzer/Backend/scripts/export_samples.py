@@ -88,18 +88,22 @@ args = parser.parse_args()
 sample_manager = BaseConfig.SAMPLE_MANAGER
 
 for purpose in ['train', 'test']:
-    samples, labels = sample_manager.get_all_samples(purpose=purpose, multilabel=False, sample_type=args.type)
-    for user in samples:
+    # samples are streamed in batches, so the whole samplebase is never kept in memory
+    labels_strs = {}
+    for user, sample, label in sample_manager.iter_samples(purpose=purpose, multilabel=False):
         base_path = Path(args.path)
         path = base_path.joinpath(f'{user}/{purpose}')
-        path.mkdir(parents=True, exist_ok=True)
-        labels_str = ''
+        if user not in labels_strs:
+            path.mkdir(parents=True, exist_ok=True)
+            labels_strs[user] = []
+        i = len(labels_strs[user])
 
-        for i, sample in enumerate(samples[user]):
-            with open(path.joinpath(f'{i}.{args.type}'), 'wb') as f:
-                f.write(sample.read())
+        with open(path.joinpath(f'{i}.{args.type}'), 'wb') as f:
+            f.write(sample.read())
 
-            labels_str += f'{i}.{args.type}\t{labels[user][i]}\n'
+        labels_strs[user].append(f'{i}.{args.type}\t{label}\n')
 
+    for user, labels_str in labels_strs.items():
+        path = Path(args.path).joinpath(f'{user}/{purpose}')
         with open(path.joinpath('labels.txt'), 'w') as labels_file:
-                labels_file.write(labels_str)
+                labels_file.write(''.join(labels_str))
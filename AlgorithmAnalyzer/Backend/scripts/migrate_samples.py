@@ -0,0 +1,20 @@
+"""
+This script converts samplebase from the old format, where samples were
+embedded in users' documents, to separate 'users' and 'samples' collections.
+Usage:
+    python migrate_samples.py
+
+It is safe to run it many times, already migrated samples are skipped.
+Voiced ranges are detected for samples which don't have them yet.
+"""
+
+import os
+
+os.sys.path.append('..')
+from config import BaseConfig   # noqa
+
+sample_manager = BaseConfig.SAMPLE_MANAGER
+
+print("migrate samples...")
+migrated = sample_manager.migrate_embedded_samples()
+print(f"fin, migrated {migrated} samples")
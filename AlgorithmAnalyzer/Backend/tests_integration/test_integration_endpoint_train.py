@@ -1,16 +1,19 @@
 import glob
+import shutil
 import unittest
+import zipfile
 import json
 import abc
 from time import sleep
 from pathlib import Path
 from io import BytesIO
 
-import gridfs
 from flask_api import status
 from pymongo import MongoClient
 
 from main import app
+from config import BaseConfig
+from utils.db_clients import configure_clients
 from sample_manager.SampleManager import SampleManager
 from algorithms.tests.mocks import TEST_ALG_DICT
 
@@ -34,7 +37,6 @@ class BaseAbstractIntegrationTestsClass(unittest.TestCase, abc.ABC):
         cls.client = cls.app.test_client()
 
         cls.jsp._database.drop_collection('jobs')
-        cls.jsp._jobs = cls.jsp._database.jobs
 
     @classmethod
     def tearDownClass(cls):
@@ -64,8 +66,14 @@ class AudioAddSampleTests(BaseAbstractIntegrationTestsClass):
             self.assertEqual(r.json["username"], self.TEST_USERNAMES[0],
                              "wrong username returned for correct upload")
 
-            # check for recognized_speech
-            self.assertIn(r.json["recognized_speech"], ["trzynaście", 13, '13'],
+            # speech should be recognized in the background
+            self.assertEqual(r.json["recognized_speech"], "pending",
+                             "speech should not be recognized during upload")
+            self.sm.speech_recognition_queue.wait()
+            r_speech = self.client.get(f'/audio/train/{self.TEST_USERNAMES[0]}/1.wav/recognized_speech')
+            self.assertEqual(r_speech.status_code, status.HTTP_200_OK,
+                             "wrong status code for recognized speech")
+            self.assertIn(r_speech.json["recognized_speech"], ["trzynaście", 13, '13'],
                           "wrong recognized speech returned for trzynascie")
 
             # check for existence of new user in db
@@ -135,6 +143,64 @@ class AudioAddSampleTests(BaseAbstractIntegrationTestsClass):
             self.assertEqual(r.data, b'["Provided username contains special characters"]',
                              "wrong string")
 
+    def test_post_bulk_files(self):
+        """ test for happy path for bulk upload of many files and zip archive """
+        with open(self.TEST_AUDIO_PATH_TRZYNASCIE, 'rb') as f:
+            audio_bytes = f.read()
+        archive_bytes = BytesIO()
+        with zipfile.ZipFile(archive_bytes, 'w') as archive:
+            archive.writestr('1.webm', audio_bytes)
+            archive.writestr('2.webm', audio_bytes)
+        archive_bytes.seek(0)
+
+        r = self.client.post('/audio/train/bulk',
+                             data={"username": self.TEST_USERNAMES[0],
+                                   "file": [(BytesIO(audio_bytes), 'trzynascie.webm'),
+                                            (archive_bytes, 'samples.zip')]})
+
+        self.assertEqual(r.status_code, status.HTTP_201_CREATED,
+                         "wrong status code for bulk upload")
+        self.assertEqual([sample['file'] for sample in r.json['samples']],
+                         ['trzynascie.webm', '1.webm', '2.webm'],
+                         "there should be a result for every uploaded file")
+        for sample in r.json['samples']:
+            self.assertIsNone(sample['error'], f"unexpected error for file '{sample['file']}'")
+
+        self.assertEqual(self.sm.get_user_sample_list(self.TEST_USERNAMES[0], "train"),
+                         ['1.wav', '2.wav', '3.wav'],
+                         "all uploaded files should be saved in the train set")
+
+    def test_post_bulk_bad_archive(self):
+        """ test for bulk upload of invalid zip archive """
+        r = self.client.post('/audio/train/bulk',
+                             data={"username": self.TEST_USERNAMES[0],
+                                   "file": (BytesIO(b"not a zip"), 'samples.zip')})
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST,
+                         "wrong status code for invalid zip archive")
+
+    def test_post_bulk_archive_too_large(self):
+        """ test for bulk upload of zip archives exceeding limits, which shouldn't be extracted """
+        def make_archive(files):
+            archive_bytes = BytesIO()
+            with zipfile.ZipFile(archive_bytes, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for name, data in files:
+                    archive.writestr(name, data)
+            archive_bytes.seek(0)
+            return archive_bytes
+
+        max_file_size = self.app.config['BULK_UPLOAD_MAX_FILE_SIZE']
+        # compresses to a few kilobytes
+        bomb = make_archive([('1.wav', bytes(max_file_size + 1))])
+        too_many = make_archive([(f'{i}.wav', b'') for i in range(self.app.config['BULK_UPLOAD_MAX_FILES'] + 1)])
+        for archive_bytes in (bomb, too_many):
+            r = self.client.post('/audio/train/bulk',
+                                 data={"username": self.TEST_USERNAMES[0],
+                                       "file": (archive_bytes, 'samples.zip')})
+            self.assertEqual(r.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                             "wrong status code for too large zip archive")
+        self.assertFalse(self.sm.user_exists(self.TEST_USERNAMES[0]),
+                         "nothing should be saved from rejected archives")
+
 
 class DeleteTests(BaseAbstractIntegrationTestsClass):
 
@@ -661,18 +727,21 @@ class NoDbTests(BaseAbstractIntegrationTestsClass):
         super().setUpClass()
 
         temp_sm = SampleManager(cls.sm.db_url, cls.db_name, show_logs=False)
+        # the client is resolved from db_url on each access, so the manager now uses an unavailable database
+        configure_clients(server_selection_timeout_ms=500)
         temp_sm.db_url = "_____:36363"
-        temp_sm.db_client = MongoClient(
-            temp_sm.db_url, serverSelectionTimeoutMS=500)
-        temp_sm.db_database = temp_sm.db_client["unknown_collection"]
-        temp_sm.db_collection = temp_sm.db_database.samples
-        temp_sm.db_file_storage = gridfs.GridFS(temp_sm.db_database)
+        temp_sm.db_name = "unknown_collection"
 
         assert not temp_sm.is_db_available(
         ), f"Database '{temp_sm.db_url}' should not be available"
 
         cls.app.config['SAMPLE_MANAGER'] = temp_sm
 
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        configure_clients(server_selection_timeout_ms=BaseConfig.DATABASE_TIMEOUT_MS)
+
     def test_no_db_post_sample(self):
         with open(self.TEST_AUDIO_PATH_TRZYNASCIE, 'rb') as f:
             r = self.client.post('/audio/train',
@@ -736,11 +805,7 @@ class AlgorithmsTests(BaseAbstractIntegrationTestsClass):
 
     def tearDown(self):
         for alg_name in self.alg_list:
-            path = Path('./algorithms/saved_models/' + alg_name)
-            for subpath in path.rglob('*'):
-                subpath.rmdir()
-            if path.exists():
-                path.rmdir()
+            shutil.rmtree('./algorithms/saved_models/' + alg_name, ignore_errors=True)
 
     def _train_algorithm(self, name):
         params = TEST_ALG_DICT[name].get_parameters()
@@ -757,6 +822,14 @@ class AlgorithmsTests(BaseAbstractIntegrationTestsClass):
         sleep(.1)
         return r
 
+    def _wait_for_job(self, job_id, timeout=5.):
+        for _ in range(int(timeout / .1)):
+            job_status = self.client.get(f'/jobs/{job_id}').json
+            if job_status['finished']:
+                return job_status
+            sleep(.1)
+        self.fail(f"Job {job_id} didn't finish in {timeout}s")
+
     def test_get_algorithms_names(self):
         self.assertEqual(
             self.client.get('/algorithms').json, {
@@ -906,6 +979,27 @@ class AlgorithmsTests(BaseAbstractIntegrationTestsClass):
                          "Should't pass with parameter value notin accepted values."
                          )
 
+    def test_train_algorithm_incremental(self):
+        name = "second_mock"
+        data = {'parameters': {'param1': 1, 'param2': 'c'}, 'incremental': 'yes'}
+        r = self.client.post(f'/algorithms/train/{name}',
+                             data=json.dumps(data),
+                             content_type='application/json'
+                             )
+        self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(r.data, b'Incremental should be a boolean.')
+
+        data['incremental'] = True
+        r = self.client.post(f'/algorithms/train/{name}',
+                             data=json.dumps(data),
+                             content_type='application/json'
+                             )
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        job_status = self._wait_for_job(r.json['job_id'])
+        self.assertIsNone(job_status['error'])
+        manifest = self.am.model_store.read_manifest(f'./algorithms/saved_models/{name}')
+        self.assertEqual(manifest['parameters'], {'param1': 1, 'param2': 'c'})
+
     def test_predict_algorithm(self):
         username = self.TEST_USERNAMES[1]
         for name in self.valid_algs:
@@ -993,11 +1087,20 @@ class AlgorithmsTests(BaseAbstractIntegrationTestsClass):
                 json=data
             )
             self.assertEqual(r.status_code, status.HTTP_200_OK)
+            self.assertIn('job_id', r.json)
+
+            # result should be stored in the status of finished job
+            job_status = self._wait_for_job(r.json['job_id'])
+            self.assertIsNone(job_status['error'])
+            self.assertEqual(job_status['progress'], 1)
+            self.assertEqual(job_status['data'], {'algorithm': name, 'type': 'test', 'users': users})
+            result = job_status['result']
             if name == 'second_mock':
-                self.assertIn('matrix', r.json)
-                self.assertEqual(r.json['users'], users)
+                self.assertIn('matrix', result)
+                self.assertEqual(result['users'], users)
             else:
-                self.assertNotIn('matrix', r.json)
+                self.assertNotIn('matrix', result)
+                self.assertTrue(all(row[0] in users for row in result))
 
     def test_train_algorithm_raising_algorithmexception(self):
         r = self._train_algorithm(self.exception_raiser)
@@ -1063,7 +1166,7 @@ class TestJobsEndpoints(BaseAbstractIntegrationTestsClass):
         )
         self.jsp.delete_job_status(jid)
 
-    def test_get_job_status_endpoint_on_finished_deletes(self):
+    def test_get_job_status_endpoint_on_finished_keeps_status(self):
         jid = self.jsp.create_job_status(data={'d': 'somedata'})
         self.jsp.update_job_status(jid, progress=1, finished=True)
         res = self.client.get(f'/jobs/{jid}')
@@ -1075,11 +1178,36 @@ class TestJobsEndpoints(BaseAbstractIntegrationTestsClass):
                 'error': None, 'data': {'d': 'somedata'}
             }
         )
+        # finished statuses are removed by the database after FINISHED_JOBS_TTL, not on read
         res = self.client.get(f'/jobs/{jid}')
-        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.json['finished'])
+        self.jsp.delete_job_status(jid)
 
     def test_delete_job_status_endpoint(self):
         jid = self.jsp.create_job_status(data={'d': 'somedata'})
-        self.client.delete(f'/jobs/{jid}')
+        # job which isn't running is cancelled at once
+        res = self.client.delete(f'/jobs/{jid}')
+        self.assertEqual(res.data, b"Job cancelled.")
+        res = self.client.get(f'/jobs/{jid}')
+        self.assertEqual(
+            res.json,
+            {
+                'finished': True, 'progress': 0, 'cancelled': True,
+                'error': "The job was cancelled.", 'data': {'d': 'somedata'}
+            }
+        )
+        # finished job is deleted
+        jid = self.jsp.create_job_status(data={'d': 'somedata'})
+        self.jsp.update_job_status(jid, progress=1, finished=True)
+        res = self.client.delete(f'/jobs/{jid}')
+        self.assertEqual(res.data, b"Job deleted.")
         res = self.client.get(f'/jobs/{jid}')
         self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cancel_queued_job(self):
+        jid = self.jsp.create_job_status(data={'d': 'somedata'})
+        self.app.config['JOB_QUEUE'].enqueue(jid, 'train', 'first_mock', {'parameters': {'some_name': 1}})
+        self.client.delete(f'/jobs/{jid}')
+        self.assertEqual(self.app.config['JOB_QUEUE'].get_state(jid), 'cancelled')
+        self.assertTrue(self.client.get(f'/jobs/{jid}').json['cancelled'])
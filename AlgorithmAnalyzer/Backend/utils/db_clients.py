@@ -0,0 +1,91 @@
+import os
+from threading import Lock
+
+import gridfs
+from pymongo import MongoClient
+
+# this file provides one pooled MongoClient per database url, shared by all storage classes,
+# MongoClient is thread-safe, but it must not be used after fork, so each process gets its own clients
+
+# options used for new clients, can be changed with configure_clients
+_client_options = {
+    'maxPoolSize': 50,
+    'serverSelectionTimeoutMS': 5000,
+    'connectTimeoutMS': 5000,
+    'socketTimeoutMS': 30000,
+}
+
+_clients = {}
+# (db_url, db_name) -> GridFS, GridFS objects are cached, because each one checks its indexes on first write
+_file_storages = {}
+_clients_pid = None
+_clients_lock = Lock()
+
+
+def configure_clients(max_pool_size: int = None, server_selection_timeout_ms: int = None,
+                      connect_timeout_ms: int = None, socket_timeout_ms: int = None):
+    """
+    change options of clients, clients already opened by current process are closed,
+    so they are created again with new options on next use
+    :param max_pool_size: int - maximal number of connections of a single client
+    :param server_selection_timeout_ms: int - time after which unavailable database is reported
+    :param connect_timeout_ms: int - timeout of opening a new connection
+    :param socket_timeout_ms: int - timeout of a single database operation
+    """
+    options = {
+        'maxPoolSize': max_pool_size,
+        'serverSelectionTimeoutMS': server_selection_timeout_ms,
+        'connectTimeoutMS': connect_timeout_ms,
+        'socketTimeoutMS': socket_timeout_ms,
+    }
+    with _clients_lock:
+        _client_options.update({key: value for key, value in options.items() if value is not None})
+        _close_clients()
+
+
+def _close_clients():
+    # callers must hold _clients_lock
+    if _clients_pid == os.getpid():
+        for client in _clients.values():
+            client.close()
+    _clients.clear()
+    _file_storages.clear()
+
+
+def get_client(db_url: str) -> MongoClient:
+    """
+    get shared client of database, it is created on first use in each process
+    :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
+    """
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # clients inherited from parent process can't be used after fork
+            _clients.clear()
+            _file_storages.clear()
+            _clients_pid = os.getpid()
+        if db_url not in _clients:
+            _clients[db_url] = MongoClient(db_url, connect=False, **_client_options)
+        return _clients[db_url]
+
+
+def get_file_storage(db_url: str, db_name: str) -> gridfs.GridFS:
+    """
+    get shared GridFS of database, using the client returned by get_client
+    :param db_url: str - url to MongoDB database, it can contain port eg: 'localhost:27017'
+    :param db_name: str - database name
+    """
+    client = get_client(db_url)
+    with _clients_lock:
+        key = (db_url, db_name)
+        if key not in _file_storages:
+            _file_storages[key] = gridfs.GridFS(client[db_name])
+        return _file_storages[key]
+
+
+def close_clients():
+    """
+    close all clients of current process, eg. on app shutdown
+    """
+    with _clients_lock:
+        _close_clients()
@@ -0,0 +1,44 @@
+from abc import ABCMeta, abstractmethod
+from io import BytesIO
+from typing import Optional
+
+from .speech_to_text_wrapper import recognize_speech_from_bytesIO
+
+
+class SpeechRecognizer(metaclass=ABCMeta):
+    """
+    Interface of speech recognition engines used to fill
+    samples' recognized speech in the background.
+    """
+
+    @abstractmethod
+    def recognize(self, wav_bytes: bytes) -> Optional[str]:
+        """
+        :param wav_bytes: bytes - audio as wav
+        :returns: recognized text or None, if speech could not be recognized
+        """
+
+
+class OnlineSpeechRecognizer(SpeechRecognizer):
+    """
+    Recognizes speech with online services (Google, Bing as a fallback).
+    """
+
+    def __init__(self, language: str = "pl-PL"):
+        self.language = language
+
+    def recognize(self, wav_bytes: bytes) -> Optional[str]:
+        return recognize_speech_from_bytesIO(BytesIO(wav_bytes), language=self.language)
+
+
+class StaticSpeechRecognizer(SpeechRecognizer):
+    """
+    Local stand-in recognizer, which gives the same text for every sample,
+    used in tests and in deployments without access to online services.
+    """
+
+    def __init__(self, text: Optional[str] = None):
+        self.text = text
+
+    def recognize(self, wav_bytes: bytes) -> Optional[str]:
+        return self.text
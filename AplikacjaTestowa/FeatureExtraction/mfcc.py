@@ -1,7 +1,15 @@
 
+import math
+from multiprocessing import Pool, RawArray
+
 import numpy as np
 from sklearn import preprocessing
 import python_speech_features as psf
+from python_speech_features.sigproc import round_half_up
+
+WINLEN = 0.025
+WINSTEP = 0.01
+NUMCEP = 13
 
 
 def calculate_mfcc_point(sample_rate, signal):
@@ -9,7 +17,7 @@ def calculate_mfcc_point(sample_rate, signal):
     calculates mfcc features of single data point
     """
     # TODO: find better parameters
-    return psf.mfcc(signal, samplerate=sample_rate, winlen=0.025, winstep=0.01, numcep=13,
+    return psf.mfcc(signal, samplerate=sample_rate, winlen=WINLEN, winstep=WINSTEP, numcep=NUMCEP,
              nfilt=26, nfft=512, lowfreq=0, highfreq=None, preemph=0.97,
              ceplifter=22, appendEnergy=True)
 
@@ -27,14 +35,100 @@ def calculate_mfcc_list(sound_list):
     return mfccs
 
 
-def calculate_mfcc_dict(data, verbose=False):
+def num_frames(sample_rate, signal):
+    """
+    number of rows of mfcc features of a data point, the same as computed by psf
+    """
+    frame_len = int(round_half_up(WINLEN * sample_rate))
+    frame_step = int(round_half_up(WINSTEP * sample_rate))
+    if len(signal) <= frame_len:
+        return 1
+    return 1 + int(math.ceil((len(signal) - frame_len) / frame_step))
+
+
+# data points and the output buffer shared by worker processes, set by _init_worker
+_shared = None
+
+
+def _init_worker(points, buffer):
+    global _shared
+    _shared = points, np.frombuffer(buffer, dtype=np.float64)
+
+
+def _calculate_shard(shard):
+    """
+    calculates mfcc of a shard of data points and writes them to the shared buffer
+    :param shard list of (index of data point, its offset in the buffer):
+    :return list of (index of data point, None or error message):
+    """
+    points, out = _shared
+    results = []
+    for num, offset in shard:
+        rate, signal = points[num]
+        try:
+            mfcc = preprocessing.scale(calculate_mfcc_point(rate, signal))
+            if mfcc.shape != (num_frames(rate, signal), NUMCEP):
+                raise ValueError("unexpected shape of mfcc: {}".format(mfcc.shape))
+            out[offset:offset + mfcc.size] = mfcc.ravel()
+            results.append((num, None))
+        except Exception as e:
+            results.append((num, str(e)))
+    return results
+
+
+def calculate_mfcc_dict_parallel(data, workers, verbose=False):
+    """
+    calculates mfcc features like calculate_mfcc_dict, with a pool of processes,
+    data points are split into shards, inherited by workers (they're not pickled when processes are forked)
+    and workers write features directly into a shared buffer, so no arrays are pickled back,
+    data points which could not be processed are skipped, keeping the order of the rest
+    :param data the dictionary containing data:
+    :param workers number of processes:
+    :param verbose True iff console output should be given:
+    :return dict with features being mfcc vectors:
+    """
+    ids = list(data)
+    points = [point for id in ids for point in data[id]]
+    offsets = np.cumsum([0] + [num_frames(rate, signal) * NUMCEP for rate, signal in points])
+    buffer = RawArray('d', int(offsets[-1]))
+    # a few shards per worker, so they're balanced when data points have different lengths
+    shard_size = max(1, -(-len(points) // (workers * 4)))
+    shards = [
+        [(num, int(offsets[num])) for num in range(start, min(start + shard_size, len(points)))]
+        for start in range(0, len(points), shard_size)
+    ]
+    errors = {}
+    with Pool(workers, initializer=_init_worker, initargs=(points, buffer)) as pool:
+        for results in pool.imap_unordered(_calculate_shard, shards):
+            errors.update(results)
+
+    out = np.frombuffer(buffer, dtype=np.float64)
+    num = 0
+    for id in ids:
+        if verbose:
+            print("calculating mfcc of {}".format(id))
+        mfccs = []
+        for _ in data[id]:
+            if errors[num] is not None:
+                print("mfcc of {} could not have been calculated because of an exception: {}".format(id, errors[num]))
+            else:
+                mfccs.append(out[offsets[num]:offsets[num + 1]].reshape(-1, NUMCEP))
+            num += 1
+        data[id] = mfccs
+    return data
+
+
+def calculate_mfcc_dict(data, verbose=False, workers=None):
     """
     calculates mfcc features of the whole data kept in a dict
     that is returned from get_data in DataPreparation.load_data
     :param data the dictionary containing data:
     :param verbose True iff console output should be given:
+    :param workers if given, features are calculated by this many processes (see calculate_mfcc_dict_parallel):
     :return dict with features being mfcc vectors:
     """
+    if workers and workers > 1:
+        return calculate_mfcc_dict_parallel(data, workers, verbose)
     for id in data:
         if verbose:
             print("calculating mfcc of {}".format(id))
@@ -56,13 +150,13 @@ def mfcc_dict_to_matrix(data):
     return np.stack(X, axis=1).T, np.array(y)
 
 
-def calculate_mfcc(data, verbose=False):
+def calculate_mfcc(data, verbose=False, workers=None):
     """
     the main function of the module, that calculates matrices of mfcc features
     applies directly to result of get_data from DataPreparation.load_data
 
     """
-    data = calculate_mfcc_dict(data, verbose)
+    data = calculate_mfcc_dict(data, verbose, workers)
     return mfcc_dict_to_matrix(data)
 
 